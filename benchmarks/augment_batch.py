@@ -0,0 +1,53 @@
+"""
+Compares the array-native batch path of the segmentation augmentations (`AugmentOp._augment_batch`)
+with the per-image list path (`AugmentOp._augment_pair`) on images of the same shape.
+
+Usage: python benchmarks/augment_batch.py [--num_images 200] [--size 256] [--repeats 5]
+"""
+from __future__ import absolute_import
+import argparse
+import time
+import numpy as np
+from makiflow.augmentation.segmentation import Data, FlipAugment, RotateAugment, ElasticAugment, AffineAugment
+
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_images', type=int, default=200)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    imgs = [rng.randint(0, 256, size=(args.size, args.size, 3), dtype=np.uint8) for _ in range(args.num_images)]
+    masks = [rng.randint(0, 5, size=(args.size, args.size), dtype=np.uint8) for _ in range(args.num_images)]
+    data = Data(imgs, masks)
+
+    ops = {
+        'FlipAugment (3 flips)': FlipAugment(
+            [FlipAugment.FLIP_HORIZONTALLY, FlipAugment.FLIP_VERTICALLY, FlipAugment.FLIP_HV]
+        ),
+        'RotateAugment (2 rotations)': RotateAugment(
+            [RotateAugment.ROTATE_90_CLOCKWISE, RotateAugment.ROTATE_180]
+        ),
+        'ElasticAugment (2 maps)': ElasticAugment(num_maps=2, seed=0),
+        'AffineAugment (2 matrices)': AffineAugment(num_matrices=2, seed=0),
+    }
+    for name, op in ops.items():
+        op = op(data)
+        batch_time = best_time(lambda: op._get_data_batch(imgs, masks), args.repeats)
+        list_time = best_time(lambda: op._get_data_list(imgs, masks), args.repeats)
+        print('{}: batch {:0.1f} ms, list {:0.1f} ms'.format(name, batch_time * 1000, list_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Compares the step time of the hard negative mining used by `SSDModel.fit_scan`:
+the old per-sample `tf.scan` over `tf.nn.top_k` and the current batched `top_k`
+(`makiflow.models.ssd.ssd_model.hard_negative_loss`).
+
+Usage: python benchmarks/ssd_scan_loss.py [--batch_sz 32] [--total_predictions 8732] [--iterations 100]
+"""
+from __future__ import absolute_import
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+from makiflow.models.ssd.ssd_model import hard_negative_loss
+
+
+def scan_hard_negative_loss(confidence_loss, loc_loss_masks, neg_samples_ratio, batch_sz):
+    # The implementation `fit_scan` used before the batched top_k
+    num_positives = tf.reduce_sum(loc_loss_masks)
+    num_negatives = tf.cast(num_positives * neg_samples_ratio, dtype=tf.float32)
+    negative_confidence_loss = confidence_loss * (1.0 - loc_loss_masks)
+    num_negatives_per_batch = tf.cast(num_negatives / batch_sz, dtype=tf.int32)
+
+    def sort_neg_losses_for_each_batch(_, batch_loss):
+        top_k_negative_confidence_loss, _ = tf.nn.top_k(batch_loss, k=num_negatives_per_batch)
+        return tf.reduce_sum(top_k_negative_confidence_loss)
+
+    neg_conf_losses = tf.scan(
+        fn=sort_neg_losses_for_each_batch,
+        elems=negative_confidence_loss,
+        infer_shape=False,
+        initializer=1.0
+    )
+    return tf.reduce_sum(neg_conf_losses) / num_negatives
+
+
+def time_step(session, step_op, feed_dict, iterations):
+    # Warm up
+    for _ in range(5):
+        session.run(step_op, feed_dict=feed_dict)
+    start = time.time()
+    for _ in range(iterations):
+        session.run(step_op, feed_dict=feed_dict)
+    return (time.time() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sz', type=int, default=32)
+    parser.add_argument('--total_predictions', type=int, default=8732)
+    parser.add_argument('--num_positives', type=int, default=20)
+    parser.add_argument('--neg_samples_ratio', type=float, default=3.0)
+    parser.add_argument('--iterations', type=int, default=100)
+    args = parser.parse_args()
+
+    logits = tf.Variable(
+        np.random.randn(args.batch_sz, args.total_predictions).astype(np.float32), name='logits'
+    )
+    confidence_loss = tf.nn.softplus(logits)
+    loc_loss_masks = tf.placeholder(tf.float32, shape=[args.batch_sz, args.total_predictions])
+    neg_samples_ratio = tf.placeholder(tf.float32, shape=[])
+    losses = {
+        'tf.scan': scan_hard_negative_loss(confidence_loss, loc_loss_masks, neg_samples_ratio, args.batch_sz),
+        'batched top_k': hard_negative_loss(confidence_loss, loc_loss_masks, neg_samples_ratio)
+    }
+    # A training step: the loss and its gradients
+    step_ops = {name: [loss, tf.gradients(loss, logits)] for name, loss in losses.items()}
+
+    masks = np.zeros((args.batch_sz, args.total_predictions), dtype=np.float32)
+    for mask in masks:
+        mask[np.random.choice(args.total_predictions, args.num_positives, replace=False)] = 1.0
+    feed_dict = {loc_loss_masks: masks, neg_samples_ratio: args.neg_samples_ratio}
+
+    with tf.Session() as session:
+        session.run(tf.variables_initializer([logits]))
+        for name, step_op in step_ops.items():
+            step_time = time_step(session, step_op, feed_dict, args.iterations)
+            print('{}: {:0.3f} ms/step'.format(name, step_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
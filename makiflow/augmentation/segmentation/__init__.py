@@ -1,5 +1,9 @@
 from __future__ import absolute_import
 from makiflow.augmentation.segmentation.augment_ops import ElasticAugment, AffineAugment, FlipAugment, RotateAugment
-from makiflow.augmentation.segmentation.data_provider import Data
+from makiflow.augmentation.segmentation.data_provider import Data, LazyData
+from makiflow.augmentation.segmentation.elastic_maps import ElasticMapBank
+from makiflow.augmentation.segmentation.stream import shuffle_stream, save_stream, save_stream_to_record
+from makiflow.augmentation.segmentation.parallel import ParallelExecutor
+from makiflow.augmentation.segmentation.composition import WarpComposition
 from makiflow.augmentation.segmentation.image_mask_cutter import ImageCutter
 from makiflow.augmentation.segmentation.balancing import *
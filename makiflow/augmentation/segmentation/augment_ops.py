@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 from makiflow.augmentation.segmentation.base import AugmentOp, Augmentor
-from scipy.ndimage import gaussian_filter
+from makiflow.augmentation.segmentation.elastic_maps import generate_displacement, displacement_to_map
 import numpy as np
 import cv2
 
@@ -19,6 +19,19 @@ BORDER_MODE = {
 }
 
 
+def _apply_per_image(arr, func, *args, **kwargs):
+    # Applies the OpenCV function to every image in the stack writing the results
+    # into a single preallocated array.
+    out = None
+    for i in range(len(arr)):
+        res = func(arr[i], *args, **kwargs)
+        if out is None:
+            out = np.empty((len(arr),) + res.shape[:2] + arr.shape[3:], dtype=res.dtype)
+        # OpenCV drops the trailing single channel dimension, so the result is reshaped
+        out[i] = res.reshape(out.shape[1:])
+    return out
+
+
 class FlipAugment(AugmentOp):
 
     FLIP_HORIZONTALLY = 1
@@ -43,26 +56,37 @@ class FlipAugment(AugmentOp):
         self.flip_type_list = flip_type_list
         self.keep_old_data = keep_old_data
 
-    def get_data(self):
-        """
-        Starts augmentation process.
-        Returns
-        -------
-        two arrays
-            Augmented images and masks.
-        """
-        imgs, masks = self._data.get_data()
-
+    def _get_matrices(self, shape):
+        # Returns list of (3x3 matrix, output shape) equivalent to the flips
+        h, w = shape[:2]
+        flip_matrices = {
+            FlipAugment.FLIP_HORIZONTALLY: [[-1, 0, w - 1], [0, 1, 0], [0, 0, 1]],
+            FlipAugment.FLIP_VERTICALLY: [[1, 0, 0], [0, -1, h - 1], [0, 0, 1]],
+            FlipAugment.FLIP_HV: [[-1, 0, w - 1], [0, -1, h - 1], [0, 0, 1]]
+        }
+        return [
+            (np.array(flip_matrices[flip_type], dtype=np.float64), (h, w))
+            for flip_type in self.flip_type_list
+        ]
+
+    def _augment_batch(self, imgs, masks):
+        # Flips of the stacked arrays are zero-copy views
+        flip_slices = {
+            FlipAugment.FLIP_HORIZONTALLY: (slice(None), slice(None), slice(None, None, -1)),
+            FlipAugment.FLIP_VERTICALLY: (slice(None), slice(None, None, -1)),
+            FlipAugment.FLIP_HV: (slice(None), slice(None, None, -1), slice(None, None, -1))
+        }
         new_imgs, new_masks = [], []
-        for img, mask in zip(imgs, masks):
-            for flip_type in self.flip_type_list:
-                new_imgs.append(cv2.flip(img, flip_type))
-                new_masks.append(cv2.flip(mask, flip_type))
-
-        if self.keep_old_data:
-            new_imgs += imgs
-            new_masks += masks
+        for flip_type in self.flip_type_list:
+            new_imgs.append(imgs[flip_slices[flip_type]])
+            new_masks.append(masks[flip_slices[flip_type]])
+        return new_imgs, new_masks
 
+    def _augment_pair(self, img, mask):
+        new_imgs, new_masks = [], []
+        for flip_type in self.flip_type_list:
+            new_imgs.append(cv2.flip(img, flip_type))
+            new_masks.append(cv2.flip(mask, flip_type))
         return new_imgs, new_masks
 
     def __call__(self, data: Augmentor):
@@ -94,26 +118,38 @@ class RotateAugment(AugmentOp):
         self.rotate_type_list = rotate_type_list
         self.keep_old_data = keep_old_data
 
-    def get_data(self):
-        """
-        Starts augmentation process.
-        Returns
-        -------
-        two arrays
-            Augmented images and masks.
-        """
-        imgs, masks = self._data.get_data()
-
+    def _get_matrices(self, shape):
+        # Returns list of (3x3 matrix, output shape) equivalent to the rotations
+        h, w = shape[:2]
+        rotate_matrices = {
+            RotateAugment.ROTATE_90_CLOCKWISE: ([[0, -1, h - 1], [1, 0, 0], [0, 0, 1]], (w, h)),
+            RotateAugment.ROTATE_90_COUNTERCLOCKWISE: ([[0, 1, 0], [-1, 0, w - 1], [0, 0, 1]], (w, h)),
+            RotateAugment.ROTATE_180: ([[-1, 0, w - 1], [0, -1, h - 1], [0, 0, 1]], (h, w))
+        }
+        matrices = []
+        for rotate_type in self.rotate_type_list:
+            M, out_shape = rotate_matrices[rotate_type]
+            matrices.append((np.array(M, dtype=np.float64), out_shape))
+        return matrices
+
+    def _augment_batch(self, imgs, masks):
+        # Rotations of the stacked arrays are zero-copy views
+        rot90_k = {
+            RotateAugment.ROTATE_90_CLOCKWISE: -1,
+            RotateAugment.ROTATE_90_COUNTERCLOCKWISE: 1,
+            RotateAugment.ROTATE_180: 2
+        }
         new_imgs, new_masks = [], []
-        for img, mask in zip(imgs, masks):
-            for rotate_type in self.rotate_type_list:
-                new_imgs.append(cv2.rotate(img, rotate_type))
-                new_masks.append(cv2.rotate(mask, rotate_type))
-
-        if self.keep_old_data:
-            new_imgs += imgs
-            new_masks += masks
+        for rotate_type in self.rotate_type_list:
+            new_imgs.append(np.rot90(imgs, k=rot90_k[rotate_type], axes=(1, 2)))
+            new_masks.append(np.rot90(masks, k=rot90_k[rotate_type], axes=(1, 2)))
+        return new_imgs, new_masks
 
+    def _augment_pair(self, img, mask):
+        new_imgs, new_masks = [], []
+        for rotate_type in self.rotate_type_list:
+            new_imgs.append(cv2.rotate(img, rotate_type))
+            new_masks.append(cv2.rotate(mask, rotate_type))
         return new_imgs, new_masks
 
     def __call__(self, data: Augmentor):
@@ -125,7 +161,7 @@ class ElasticAugment(AugmentOp):
     def __init__(
             self, alpha=500, std=8, num_maps=10, noise_invert_scale=5, seed=None,
             img_inter='linear', mask_inter='nearest', border_mode='reflect',
-            keep_old_data=True
+            keep_old_data=True, map_bank=None
     ):
         """
         Performs elastic transformation.
@@ -157,8 +193,12 @@ class ElasticAugment(AugmentOp):
             'isolated', 'replicate', 'reflect_101'.
         keep_old_data : bool
             Set to false if you don't want to include unaugmented images into the final data set.
+        map_bank : ElasticMapBank (optional)
+            If specified, the maps are sampled from the bank instead of being generated from scratch.
+            In this case `alpha`, `std`, `noise_invert_scale` and `seed` of the bank are used.
         """
         super().__init__()
+        self.map_bank = map_bank
         self.alpha = alpha
         self.std = std
         self.num_maps = num_maps
@@ -186,61 +226,40 @@ class ElasticAugment(AugmentOp):
 
     def _generate_maps(self):
         # List of tuples (xmap, ymap)
+        if self.map_bank is not None:
+            self._maps = self.map_bank.sample_maps(self.num_maps, self._img_shape)
+            return
+
         self._maps = []
+        field_shape = (
+            self._img_shape[0] // self.noise_invert_scale,
+            self._img_shape[1] // self.noise_invert_scale
+        )
         for _ in range(self.num_maps):
-            dx = gaussian_filter(
-                (
-                        self.random_state.rand(
-                            self._img_shape[0] // self.noise_invert_scale,
-                            self._img_shape[1] // self.noise_invert_scale
-                        ) * 2 - 1
-                ),
-                self.std,
-                mode='nearest'
-            ) * self.alpha
-            dy = gaussian_filter(
-                (
-                        self.random_state.rand(
-                            self._img_shape[0] // self.noise_invert_scale,
-                            self._img_shape[1] // self.noise_invert_scale
-                        ) * 2 - 1
-                ),
-                self.std,
-                mode='nearest'
-            ) * self.alpha
-            dx = cv2.resize(dx, (self._img_shape[1], self._img_shape[0]))
-            dy = cv2.resize(dy, (self._img_shape[1], self._img_shape[0]))
-
-            x, y = np.meshgrid(np.arange(self._img_shape[1]), np.arange(self._img_shape[0]))
-            mapx = np.float32(x + dx)
-            mapy = np.float32(y + dy)
-            self._maps += [(mapx, mapy)]
-
-    def get_data(self):
-        """
-        Starts augmentation process.
-        Returns
-        -------
-        two arrays
-            Augmented images and masks.
-        """
-        imgs, masks = self._data.get_data()
+            dx, dy = generate_displacement(self.random_state, field_shape, self.std, self.alpha)
+            self._maps += [displacement_to_map(dx, dy, self._img_shape)]
 
+    def _augment_batch(self, imgs, masks):
         new_imgs, new_masks = [], []
-        for img, mask in zip(imgs, masks):
-            for mapx, mapy in self._maps:
-                new_imgs.append(
-                    cv2.remap(
-                        img, mapx, mapy, interpolation=self.img_inter, borderMode=self.border_mode
-                    )
-                )
-                new_masks.append(
-                    cv2.remap(mask, mapx, mapy, interpolation=self.mask_inter, borderMode=self.border_mode))
-
-        if self.keep_old_data:
-            new_imgs += imgs
-            new_masks += masks
+        for mapx, mapy in self._maps:
+            new_imgs.append(_apply_per_image(
+                imgs, cv2.remap, mapx, mapy, interpolation=self.img_inter, borderMode=self.border_mode
+            ))
+            new_masks.append(_apply_per_image(
+                masks, cv2.remap, mapx, mapy, interpolation=self.mask_inter, borderMode=self.border_mode
+            ))
+        return new_imgs, new_masks
 
+    def _augment_pair(self, img, mask):
+        new_imgs, new_masks = [], []
+        for mapx, mapy in self._maps:
+            new_imgs.append(
+                cv2.remap(
+                    img, mapx, mapy, interpolation=self.img_inter, borderMode=self.border_mode
+                )
+            )
+            new_masks.append(
+                cv2.remap(mask, mapx, mapy, interpolation=self.mask_inter, borderMode=self.border_mode))
         return new_imgs, new_masks
 
     def __call__(self, data: Augmentor):
@@ -308,30 +327,40 @@ class AffineAugment(AugmentOp):
             M = cv2.getAffineTransform(pts1, pts2)
             self.mxs.append(M)
 
-    def get_data(self):
-        imgs, masks = self._data.get_data()
+    def _get_matrices(self, shape):
+        # Returns list of (3x3 matrix, output shape). The output shape is always the shape
+        # of the images passed into the augmentor.
+        out_shape = tuple(self._img_shape[:2])
+        return [(np.vstack([M, [0, 0, 1]]).astype(np.float64), out_shape) for M in self.mxs]
 
+    def _augment_batch(self, imgs, masks):
         shape_size = self._img_shape[:2]
         new_imgs, new_masks = [], []
-        for img, mask in zip(imgs, masks):
-            for M in self.mxs:
-                new_imgs.append(
-                    cv2.warpAffine(
-                        img, M, shape_size[::-1], borderMode=self.border_mode,
-                        flags=self.img_inter
-                    )
+        for M in self.mxs:
+            new_imgs.append(_apply_per_image(
+                imgs, cv2.warpAffine, M, shape_size[::-1], borderMode=self.border_mode, flags=self.img_inter
+            ))
+            new_masks.append(_apply_per_image(
+                masks, cv2.warpAffine, M, shape_size[::-1], borderMode=self.border_mode, flags=self.mask_inter
+            ))
+        return new_imgs, new_masks
+
+    def _augment_pair(self, img, mask):
+        shape_size = self._img_shape[:2]
+        new_imgs, new_masks = [], []
+        for M in self.mxs:
+            new_imgs.append(
+                cv2.warpAffine(
+                    img, M, shape_size[::-1], borderMode=self.border_mode,
+                    flags=self.img_inter
                 )
-                new_masks.append(
-                    cv2.warpAffine(
-                        mask, M, shape_size[::-1], borderMode=self.border_mode,
-                        flags=self.mask_inter
-                    )
+            )
+            new_masks.append(
+                cv2.warpAffine(
+                    mask, M, shape_size[::-1], borderMode=self.border_mode,
+                    flags=self.mask_inter
                 )
-
-        if self.keep_old_data:
-            new_imgs += imgs
-            new_masks += masks
-
+            )
         return new_imgs, new_masks
 
     def __call__(self, data: Augmentor):
@@ -1,5 +1,8 @@
 from __future__ import absolute_import
 from makiflow.augmentation.segmentation.balancing.hc_scanner import HCScanner
+from makiflow.augmentation.segmentation.balancing.hc_index import HCIndex
 from makiflow.augmentation.segmentation.balancing.gd_balancer import GDBalancer
+from makiflow.augmentation.segmentation.balancing.lbfgs_balancer import LBFGSBalancer
 from makiflow.augmentation.segmentation.balancing.gdbb_builder import GD2BBuilder
+from makiflow.augmentation.segmentation.balancing.balanced_generator import BalancedPathGenerator
 del absolute_import
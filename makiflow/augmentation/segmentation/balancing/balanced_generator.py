@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+import numpy as np
+import pandas as pd
+from makiflow.models.segmentation.gen_base import PathGenerator
+
+
+class BalancedPathGenerator(PathGenerator):
+    def __init__(self, masks_hcvg, balance_config, mask_image, seed=None):
+        """
+        Samples paths on the fly so that the HCV groups appear in the stream
+        with the frequencies prescribed by the balance config. It is a streaming replacement
+        for GD2BBuilder: nothing is written to disk, use TF-side augmentation (see map_methods)
+        instead of the materialised elastic copies.
+        NOTE: HCVG - Has Class Vector Group.
+
+        Parameters
+        ----------
+        masks_hcvg : str or dict
+            str case: path to the csv file with pairs { mask path : HCVG id } (see HCScanner.save_info).
+            dict case: HCScanner.masks_hcvg.
+        balance_config : str or dict
+            str case: path to the csv file with pairs { HCVG id : cardinality } (see GDBalancer.save_cardinalities).
+            dict case: contains the same pairs.
+        mask_image : str or dict
+            str case: path to csv file contains pairs { path_to_mask : path_to_image }.
+            dict case: contains the same pairs.
+        seed : int (optional)
+            Seed for the random generator.
+        """
+        self._random_state = np.random.RandomState(seed)
+        self._setup_groups(masks_hcvg, mask_image)
+        self._setup_probabilities(balance_config)
+
+    def _setup_groups(self, masks_hcvg, mask_image):
+        HCVG = 'hcvg'
+        IMAGE = 'image'
+        if isinstance(masks_hcvg, str):
+            masks_hcvg = pd.DataFrame.from_csv(masks_hcvg)[HCVG].to_dict()
+        if isinstance(mask_image, str):
+            mask_image = pd.DataFrame.from_csv(mask_image)[IMAGE].to_dict()
+
+        # { HCVG id : [(image path, mask path)] }
+        self._groups = {}
+        for mask_path, hcvg in masks_hcvg.items():
+            self._groups.setdefault(int(hcvg), []).append((mask_image[mask_path], mask_path))
+
+    def _setup_probabilities(self, balance_config):
+        if isinstance(balance_config, str):
+            balance_config = pd.DataFrame.from_csv(balance_config)['0'].to_dict()
+
+        self._group_ids = []
+        cardinalities = []
+        for hcvg, cardinality in balance_config.items():
+            hcvg = int(hcvg)
+            if hcvg not in self._groups:
+                print(f'Group {hcvg} has no masks and will be skipped.')
+                continue
+            self._group_ids.append(hcvg)
+            cardinalities.append(cardinality)
+        cardinalities = np.asarray(cardinalities, dtype=np.float64)
+        self._probabilities = cardinalities / cardinalities.sum()
+
+    def get_group_probabilities(self):
+        """
+        Returns
+        -------
+        dict
+            Contains pairs { HCVG id : probability of the group to be sampled }.
+        """
+        return dict(zip(self._group_ids, self._probabilities))
+
+    def next_element(self):
+        # Within a group the elements are taken in shuffled order without replacement,
+        # so all the group members are used evenly just like in GD2BBuilder.
+        orders = {}
+        positions = {}
+        while True:
+            group_inds = self._random_state.choice(len(self._group_ids), size=1024, p=self._probabilities)
+            for group_ind in group_inds:
+                hcvg = self._group_ids[group_ind]
+                group = self._groups[hcvg]
+                pos = positions.get(hcvg, len(group))
+                if pos == len(group):
+                    orders[hcvg] = self._random_state.permutation(len(group))
+                    pos = 0
+                image_path, mask_path = group[orders[hcvg][pos]]
+                positions[hcvg] = pos + 1
+                yield {
+                    PathGenerator.image: image_path,
+                    PathGenerator.mask: mask_path
+                }
@@ -2,7 +2,7 @@ from __future__ import absolute_import
 import tensorflow as tf
 import numpy as np
 import pandas as pd
-from makiflow.augmentation.segmentation.balancing.utils import hcv_to_num
+from makiflow.augmentation.segmentation.balancing.utils import save_cardinalities, get_percentage
 
 
 def vec_len(vec):
@@ -177,17 +177,10 @@ class GDBalancer:
                 print(self.get_percentage())
 
     def save_cardinalities(self, path):
-        cardinalities = self.get_weights()
-        cardinalities = cardinalities.reshape(-1)
-        cardinalities = np.round(cardinalities).astype(np.int32)
-        config = {}
-        for i in range(len(cardinalities)):
-            config[hcv_to_num(self.hcv_groups[i])] = cardinalities[i]
-        pd.DataFrame.from_dict(config, orient='index').to_csv(path)
+        save_cardinalities(path, self.hcv_groups, self.get_weights())
 
     def get_percentage(self):
-        percentage = self.get_scaled_vecs() / self.get_vec_num()
-        return np.round(percentage, decimals=2) * 100
+        return get_percentage(self.get_scaled_vecs(), self.get_vec_num())
 
     def get_weights(self):
         return self.sess.run(self.cardinalities)
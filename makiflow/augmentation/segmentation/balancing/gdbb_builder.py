@@ -2,10 +2,45 @@ from __future__ import absolute_import
 import numpy as np
 import pandas as pd
 import cv2
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
 from makiflow.augmentation.segmentation import ElasticAugment, Data
 import os
 
 
+class OutputFormat:
+    BMP = 'bmp'
+    # Compressed lossless images
+    PNG = 'png'
+    # Raw numpy arrays
+    NPY = 'npy'
+    # Compressed numpy arrays
+    NPZ = 'npz'
+
+
+def _write_sample(path_no_ext, sample, output_format, png_compression):
+    if output_format == OutputFormat.NPY:
+        np.save(path_no_ext + '.npy', sample)
+    elif output_format == OutputFormat.NPZ:
+        np.savez_compressed(path_no_ext + '.npz', sample)
+    elif output_format == OutputFormat.PNG:
+        cv2.imwrite(path_no_ext + '.png', sample, [cv2.IMWRITE_PNG_COMPRESSION, png_compression])
+    else:
+        cv2.imwrite(path_no_ext + f'.{output_format}', sample)
+
+
+def _group_seed(seed, group_ind):
+    if seed is None:
+        return None
+    return (seed + group_ind) % 2**32
+
+
+def _build_group(builder, group_ind, hcv_group, seed, path_to_save, output_format, png_compression, write_threads):
+    builder._seed_group(group_ind, seed)
+    builder._build_group(hcv_group, path_to_save, output_format, png_compression, write_threads)
+    return hcv_group
+
+
 class GD2BBuilder:
     def __init__(self, path_to_hc_list, path_to_balance_config, path_to_mi, resize=None):
         """
@@ -23,34 +58,37 @@ class GD2BBuilder:
         """
         self._hc_list = pd.DataFrame.from_csv(path_to_hc_list)
         self._balance_c = pd.DataFrame.from_csv(path_to_balance_config)
-        self._load_masks_images(path_to_mi, resize)
+        self._resize = resize
+        self._load_masks_images(path_to_mi)
         self._group_images_masks_by_id()
         self._aug = None
+        self._aug_map_bank = None
 
     # noinspection PyAttributeOutsideInit
-    def _load_masks_images(self, path_to_mi, resize):
-        print('Loading masks and images.')
+    def _load_masks_images(self, path_to_mi):
+        # Only the paths are kept, the images are loaded group by group while building the batch
         IMAGE = 'image'
         mi = pd.DataFrame.from_csv(path_to_mi)
+        self._mask_image = mi[IMAGE].to_dict()
 
-        self._images_masks = {}
-        for mask_name, row in mi.iterrows():
-            image = cv2.imread(row[IMAGE])
-            mask = cv2.imread(mask_name)
-            if resize is not None:
-                image = cv2.resize(image, resize, interpolation=cv2.INTER_CUBIC)
-                mask = cv2.resize(mask, resize, interpolation=cv2.INTER_NEAREST)
-
-            self._images_masks[mask_name] = (image, mask)
-        print('Finished.')
+    def _load_image_mask(self, mask_name):
+        image = cv2.imread(self._mask_image[mask_name])
+        mask = cv2.imread(mask_name)
+        if self._resize is not None:
+            image = cv2.resize(image, self._resize, interpolation=cv2.INTER_CUBIC)
+            mask = cv2.resize(mask, self._resize, interpolation=cv2.INTER_NEAREST)
+        return image, mask
 
     def _group_images_masks_by_id(self):
         print('Group masks and images by their ids.')
         HCVG = 'hcvg'
+        # { HCVG id : [mask name] }
         self._groups = {}
-        for row_ind, row in self._hc_list.iterrows():
-            self._groups[row[HCVG]] = [self._images_masks[row_ind]] + self._groups.get(row[HCVG], [])
+        for mask_name, hcvg in self._hc_list[HCVG].items():
+            self._groups.setdefault(hcvg, []).append(mask_name)
         for hcvg in self._groups:
+            # Keep the order the groups were originally built in
+            self._groups[hcvg].reverse()
             print(f'{hcvg} cardinality is {len(self._groups[hcvg])}')
         print('Finished.')
 
@@ -58,8 +96,34 @@ class GD2BBuilder:
     def set_elastic_aug_params(
             self, img_shape,
             alpha=500, std=8, noise_invert_scale=5,
-            img_inter='linear', mask_inter='nearest', border_mode='reflect'
+            img_inter='linear', mask_inter='nearest', border_mode='reflect', map_bank=None
     ):
+        """
+        Sets the parameters of the elastic augmentation applied to the images of a group
+        each time the group wraps around. See ElasticAugment for more details.
+
+        Parameters
+        ----------
+        img_shape : tuple
+            Shape of the images. Use OpenCV order for dimensionalities: (height, width, depth).
+        alpha : int
+            Affects curvature.
+        std : int
+            Affects curvature.
+        noise_invert_scale : int
+            Bigger the `noise_invert_scale`, less 'aggressive' the deformation is.
+        img_inter : str
+            Image interpolation type. Can be 'nearest', 'linear' or 'cubic'.
+        mask_inter : str
+            Mask interpolation type. Can be 'nearest', 'linear' or 'cubic'.
+        border_mode : str
+            Border mode applied to transformed image. Can be 'reflect', 'constant',
+            'isolated', 'replicate', 'reflect_101'.
+        map_bank : ElasticMapBank (optional)
+            If specified, the elastic maps are taken from the bank instead of being
+            regenerated each time a group wraps around.
+        """
+        self._aug_map_bank = map_bank
         self._aug_alpha = alpha
         self._aug_std = std
         self._aug_noise_invert_scale = noise_invert_scale
@@ -74,37 +138,104 @@ class GD2BBuilder:
             std=self._aug_std,
             num_maps=1,
             noise_invert_scale=self._aug_noise_invert_scale,
+            # Drawn from the global generator, so that the maps are reproducible given the group seed
+            seed=np.random.randint(2**31),
             img_inter=self._aug_img_inter,
             mask_inter=self._aug_mask_inter,
-            border_mode=self._aug_border_mode
+            border_mode=self._aug_border_mode,
+            map_bank=self._aug_map_bank
         )
         self._aug.setup_augmentor(self._img_shape)
 
-    def create_batch(self, path_to_save):
+    def create_batch(
+            self, path_to_save, num_workers=1, output_format=OutputFormat.BMP, png_compression=3, write_threads=2,
+            seed=None
+    ):
         """
+        Parameters
+        ----------
         path_to_save : str
             Path to the folder where the results of the data processing will be saved.
             Example: '.../balanced_batch'.
+        num_workers : int
+            Number of processes balancing the groups in parallel. Only the images of the groups
+            being processed are held in memory.
+        output_format : str
+            Format of the saved images and masks. Options are in `OutputFormat`:
+            - 'bmp' - uncompressed images;
+            - 'png' - compressed lossless images;
+            - 'npy' - raw numpy arrays;
+            - 'npz' - compressed numpy arrays.
+        png_compression : int
+            PNG compression level from 0 to 9.
+        write_threads : int
+            Number of threads writing the files in background, so that the augmentation
+            doesn't wait for the disk.
+        seed : int (optional)
+            Group `i` seeds `np.random` with `seed + i`, and the sampling of the map bank with
+            `map_bank.seed + i` (or `seed + i` if the bank has no seed). So the result is reproducible
+            and doesn't depend on `num_workers`. If None, the groups are seeded randomly.
         """
-        for hcv_group in self._groups:
-            imgs, masks = self._balance_group(hcv_group)
-            self._save_imgs(imgs, masks, hcv_group, path_to_save)
-            print(f'{hcv_group} ready')
+        if self._aug_map_bank is not None:
+            # Generate the fields once here, otherwise every worker would generate its own set
+            self._aug_map_bank.get_fields(self._img_shape)
+
+        if num_workers == 1:
+            for group_ind, hcv_group in enumerate(self._groups):
+                self._seed_group(group_ind, seed)
+                self._build_group(hcv_group, path_to_save, output_format, png_compression, write_threads)
+                print(f'{hcv_group} ready')
+            return
+
+        args = [
+            (self, group_ind, hcv_group, seed, path_to_save, output_format, png_compression, write_threads)
+            for group_ind, hcv_group in enumerate(self._groups)
+        ]
+        with mp.Pool(num_workers) as pool:
+            for hcv_group in pool.starmap(_build_group, args):
+                print(f'{hcv_group} ready')
+
+    def _seed_group(self, group_ind, seed):
+        # Every pool task gets its own pickled copy of the builder with the same random states,
+        # so each group is seeded by its index. The map bank keeps its fields, only the sampling is reseeded
+        np.random.seed(_group_seed(seed, group_ind))
+        if self._aug_map_bank is not None:
+            bank_seed = self._aug_map_bank.seed if self._aug_map_bank.seed is not None else seed
+            self._aug_map_bank.reseed(_group_seed(bank_seed, group_ind))
+
+    def _build_group(self, hcv_group, path_to_save, output_format, png_compression, write_threads):
+        masks_path = os.path.join(path_to_save, 'masks')
+        imgs_path = os.path.join(path_to_save, 'images')
+        os.makedirs(masks_path, exist_ok=True)
+        os.makedirs(imgs_path, exist_ok=True)
+        with ThreadPoolExecutor(write_threads) as writer:
+            pending = []
+            for i, (img, mask) in enumerate(self._balance_group(hcv_group)):
+                pending.append(writer.submit(
+                    _write_sample, os.path.join(masks_path, f'{hcv_group}_{i}'), mask, output_format, png_compression
+                ))
+                pending.append(writer.submit(
+                    _write_sample, os.path.join(imgs_path, f'{hcv_group}_{i}'), img, output_format, png_compression
+                ))
+                # Bound the number of images waiting to be written
+                if len(pending) > 4 * write_threads:
+                    pending.pop(0).result()
+            for future in pending:
+                future.result()
 
     def _balance_group(self, hcv_group):
+        # Yields the augmented images one by one. Only the original images of the group are held in memory.
         print(f'Balancing group {hcv_group}...')
-        imgs, masks = [], []
+        group = [self._load_image_mask(mask_name) for mask_name in self._groups[hcv_group]]
         img_ind = 0
         aug_updates = 0
         hcvg_cardinality = self._balance_c['0'][hcv_group]
         while hcvg_cardinality > 0:
-            im, mask = self._groups[hcv_group][img_ind]
-            im, mask = self._augment(im, mask)
-            imgs.append(im)
-            masks.append(mask)
+            im, mask = group[img_ind]
+            yield self._augment(im, mask)
             hcvg_cardinality -= 1
             img_ind += 1
-            if img_ind == len(self._groups[hcv_group]):
+            if img_ind == len(group):
                 img_ind = 0
                 self._create_augment()
                 aug_updates += 1
@@ -112,16 +243,6 @@ class GD2BBuilder:
         self._aug = None
         print(f'Augmentor updated {aug_updates} times.')
         print(f'Finished.')
-        return imgs, masks
-
-    def _save_imgs(self, imgs, masks, hcv_group, path_to_save):
-        masks_path = os.path.join(path_to_save, 'masks')
-        imgs_path = os.path.join(path_to_save, 'images')
-        os.makedirs(masks_path, exist_ok=True)
-        os.makedirs(imgs_path, exist_ok=True)
-        for i, (img, mask) in enumerate(zip(imgs, masks)):
-            cv2.imwrite(masks_path+f'/{hcv_group}_{i}.bmp', mask)
-            cv2.imwrite(imgs_path + f'/{hcv_group}_{i}.bmp', img)
 
     def _augment(self, im, mask):
         if self._aug is None:
@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+import numpy as np
+import pandas as pd
+from makiflow.augmentation.segmentation.balancing.utils import nums_to_hcvs
+
+# Number of set bits in each byte value
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8).reshape(-1, 1), axis=1).sum(axis=1)
+
+
+class HCIndex:
+    def __init__(self, masks_hcvg, num_classes):
+        """
+        In-memory index over the HCV groups. For each class it stores a bitset of the masks containing
+        this class, packed 8 masks per byte. Subset queries are answered with bitwise operations
+        on the bitsets, so they take milliseconds even for millions of masks.
+        NOTE: HCVG - Has Class Vector Group.
+
+        Parameters
+        ----------
+        masks_hcvg : str or dict
+            str case: path to the csv file with pairs { mask path : HCVG id } (see HCScanner.save_info).
+            dict case: HCScanner.masks_hcvg.
+        num_classes : int
+            Number of classes.
+        """
+        HCVG = 'hcvg'
+        if isinstance(masks_hcvg, str):
+            masks_hcvg = pd.DataFrame.from_csv(masks_hcvg)[HCVG].to_dict()
+
+        self.num_classes = num_classes
+        self.mask_names = np.array(list(masks_hcvg.keys()))
+        self.hcvgs = np.array([int(hcvg) for hcvg in masks_hcvg.values()], dtype=np.uint64)
+        # [num_masks, num_classes]
+        hcvs = nums_to_hcvs(self.hcvgs, num_classes)
+        # [num_classes, ceil(num_masks / 8)]
+        self._bitsets = np.packbits(hcvs.T.astype(bool), axis=1)
+
+    def __len__(self):
+        return len(self.mask_names)
+
+    def _bitset(self, include=(), exclude=()):
+        bitset = np.packbits(np.ones(len(self), dtype=bool))
+        for class_id in include:
+            bitset &= self._bitsets[class_id]
+        for class_id in exclude:
+            bitset &= ~self._bitsets[class_id]
+        return bitset
+
+    def query_indices(self, include=(), exclude=()):
+        """
+        Finds the masks that contain all the `include` classes and none of the `exclude` classes.
+
+        Parameters
+        ----------
+        include : list
+            Classes the masks must contain.
+        exclude : list
+            Classes the masks must not contain.
+
+        Returns
+        -------
+        ndarray
+            Indices of the masks (in the order of `mask_names`).
+        """
+        bits = np.unpackbits(self._bitset(include, exclude), count=len(self))
+        return np.nonzero(bits)[0]
+
+    def query(self, include=(), exclude=()):
+        """
+        Same as `query_indices`, but returns the names of the masks.
+        Example: index.query(include=[3], exclude=[5]) - all the masks containing class 3 but not class 5.
+        """
+        return self.mask_names[self.query_indices(include, exclude)]
+
+    def count(self, include=(), exclude=()):
+        """
+        Returns the number of masks found by `query` without unpacking the bitsets.
+        """
+        return int(_POPCOUNT[self._bitset(include, exclude)].sum())
+
+    def class_frequency(self):
+        """
+        Returns
+        -------
+        ndarray
+            Array of shape [num_classes]. The ith element is the number of masks containing class i.
+        """
+        return _POPCOUNT[self._bitsets].sum(axis=1)
+
+    def class_ratio(self):
+        """
+        Returns
+        -------
+        ndarray
+            Array of shape [num_classes]. The ith element is the fraction of masks containing class i.
+            Has the same meaning as `pi_vec` of the balancers.
+        """
+        return self.class_frequency() / len(self)
+
+    def group_cardinalities(self):
+        """
+        Returns
+        -------
+        dict
+            Contains pairs { HCVG id : number of masks in the group }.
+        """
+        hcvgs, counts = np.unique(self.hcvgs, return_counts=True)
+        return {int(hcvg): int(count) for hcvg, count in zip(hcvgs, counts)}
+
+    def group_indices(self):
+        """
+        Returns
+        -------
+        dict
+            Contains pairs { HCVG id : indices of the group's masks }.
+        """
+        order = np.argsort(self.hcvgs, kind='stable')
+        hcvgs, starts = np.unique(self.hcvgs[order], return_index=True)
+        return {int(hcvg): inds for hcvg, inds in zip(hcvgs, np.split(order, starts[1:]))}
@@ -1,48 +1,124 @@
 from __future__ import absolute_import
-from makiflow.augmentation.segmentation.balancing.utils import hcv_to_num, get_unique, to_hc_vec
-import numpy as np
+from makiflow.augmentation.segmentation.balancing.utils import hcv_to_num, hcvs_to_nums, mask_to_hc_vec
+import multiprocessing as mp
+import csv
 import cv2
 import pandas as pd
 
 
+def _scan_mask_file(args):
+    path, num_classes = args
+    mask = cv2.imread(path)
+    if mask is None:
+        raise ValueError(f'Cannot read mask {path}')
+    return path, mask_to_hc_vec(mask, num_classes)
+
+
 # Has-Class Scanner
 class HCScanner:
-    def __init__(self, masks, num_classes):
+    def __init__(self, masks, num_classes, num_workers=None, chunksize=64):
         """
         Parameters
         ----------
         masks: dictionary or list
             Dictionary case: contains pairs 'mask name : mask'.
-            List case: contains paths to the masks.
+            List case: contains paths to the masks. The masks are read during the scan
+            in a pool of processes and aren't kept in memory.
+        num_classes : int
+            Number of classes.
+        num_workers : int
+            Number of processes reading the masks. Defaults to the number of CPUs.
+        chunksize : int
+            Number of masks sent to a worker at once.
         """
+        self._mask_paths = None
+        self.masks = None
         if isinstance(masks, list):
-            self.__load_masks(masks)
+            self._mask_paths = masks
         else:
             self.masks = masks
         self.num_classes = num_classes
+        self.num_workers = num_workers
+        self.chunksize = chunksize
+
+    def _iterate_hc_vecs(self):
+        # Yields pairs (mask name, HC vector)
+        if self.masks is not None:
+            for mask_name in self.masks:
+                yield mask_name, mask_to_hc_vec(self.masks[mask_name], self.num_classes)
+            return
+
+        with mp.Pool(self.num_workers) as pool:
+            args = ((path, self.num_classes) for path in self._mask_paths)
+            for mask_name, hc_vec in pool.imap(_scan_mask_file, args, chunksize=self.chunksize):
+                yield mask_name, hc_vec
+
+    def _iterate_hc_ids(self):
+        # Yields triples (mask name, HC vector, HC vector group). The vectors are packed into
+        # the group ids `chunksize` at a time
+        chunk = []
+        for pair in self._iterate_hc_vecs():
+            chunk.append(pair)
+            if len(chunk) == self.chunksize:
+                yield from self._pack_chunk(chunk)
+                chunk = []
+        yield from self._pack_chunk(chunk)
+
+    def _pack_chunk(self, chunk):
+        if len(chunk) == 0:
+            return
+        if self.num_classes < 64:
+            hc_ids = [int(hc_id) for hc_id in hcvs_to_nums([hc_vec for _, hc_vec in chunk])]
+        else:
+            hc_ids = [hcv_to_num(hc_vec) for _, hc_vec in chunk]
+        for (mask_name, hc_vec), hc_id in zip(chunk, hc_ids):
+            yield mask_name, hc_vec, hc_id
 
-    def __load_masks(self, paths):
-        self.masks = {}
-        for path in paths:
-            self.masks[path] = cv2.imread(path)
+    def scan(self, masks_hcvg_path=None):
+        """
+        Scans the masks.
 
-    def scan(self):
+        Parameters
+        ----------
+        masks_hcvg_path : str (optional)
+            If specified, pairs { mask name : HC vector group } are written to this csv file
+            as soon as they are computed instead of being kept in `masks_hcvg`.
+            Use it for large data sets, so that only the group counts stay in memory.
+        """
         # { Mask's name : HC vector group }
         self.masks_hcvg = {}
         # { HC vector group : number of vectors }
         self.hcv_groups = {}
         self.uniq_hcv = {}
-        for mask_name in self.masks:
-            classes = np.unique(self.masks[mask_name])
-            hc_vec = to_hc_vec(self.num_classes, classes)
-            hc_id = hcv_to_num(hc_vec)
+        self._masks_hcvg_saved = masks_hcvg_path is not None
 
-            self.masks_hcvg[mask_name] = hc_id
-            self.hcv_groups[hc_id] = 1 + self.hcv_groups.get(hc_id, 0)
-            if self.hcv_groups[hc_id] == 1:
-                self.uniq_hcv[hc_id] = hc_vec
+        csv_file = None
+        if masks_hcvg_path is not None:
+            csv_file = open(masks_hcvg_path, mode='w', newline='')
+            writer = csv.writer(csv_file)
+            # The same layout as the one pandas produces in `save_info`
+            writer.writerow(['', 'hcvg'])
 
-    def save_info(self, uniq_hvc_path, masks_hcvg_path):
+        try:
+            for mask_name, hc_vec, hc_id in self._iterate_hc_ids():
+                if csv_file is not None:
+                    writer.writerow([mask_name, hc_id])
+                else:
+                    self.masks_hcvg[mask_name] = hc_id
+                self.hcv_groups[hc_id] = 1 + self.hcv_groups.get(hc_id, 0)
+                if self.hcv_groups[hc_id] == 1:
+                    self.uniq_hcv[hc_id] = hc_vec
+        finally:
+            if csv_file is not None:
+                csv_file.close()
+
+    def save_info(self, uniq_hvc_path, masks_hcvg_path=None):
+        """
+        Saves the unique HC vectors and the pairs { mask name : HC vector group }.
+        `masks_hcvg_path` can be omitted if the pairs were already written during the scan.
+        """
         pd.DataFrame.from_dict(self.uniq_hcv, orient='index').to_csv(uniq_hvc_path)
-        pd.DataFrame.from_dict(self.masks_hcvg, orient='index', columns=['hcvg']).to_csv(masks_hcvg_path)
+        if masks_hcvg_path is not None:
+            assert not self._masks_hcvg_saved, 'The groups were written to a file during the scan.'
+            pd.DataFrame.from_dict(self.masks_hcvg, orient='index', columns=['hcvg']).to_csv(masks_hcvg_path)
         print('Saved!')
@@ -0,0 +1,190 @@
+from __future__ import absolute_import
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from makiflow.augmentation.segmentation.balancing.utils import save_cardinalities, get_percentage
+
+
+def _ratio_grad(h, c, total):
+    # Chain rule for p = c / sum(c): returns d(f)/d(c) given h = d(f)/d(p)
+    return h / total - np.dot(h, c) / total**2
+
+
+# noinspection PyAttributeOutsideInit
+class LBFGSBalancer:
+    def __init__(
+            self, hcv_groups, initial_c, objective='alpha', min_c=5.0, max_c=10000.0
+    ):
+        """
+        Solves the same problem as GDBalancer, but with the bounded quasi-Newton method (L-BFGS-B)
+        using analytic gradients computed in NumPy. No TensorFlow session is needed and there is no
+        learning rate to tune. The regularizers, `reset` and the results accessors are the same as in GDBalancer,
+        but `optimize` takes no optimizer and there is no `set_session`.
+        NOTE: HCVG - Has Class Vector Group.
+        Parameters
+        ----------
+        hcv_groups : str or ndarray
+            str case: path to csv file with HCVGs.
+            ndarray case: array of HCVGs.
+        objective : str
+            The objective function of the algorithm. Options:
+            - alpha - normalize LAMBA vector by the sum of HCVGs' cardinalities.
+            - geo - normalize LAMBA vector as a normal vector.
+        min_c : float
+            Minimum cardinality.
+        max_c : float
+            Maximum cardinality.
+        initial_c : ndarray
+            Ndarray of shape (number of cardinalities). Initial cardinalities of the HCVGs.
+        """
+        self.min_amount = min_c
+        self.max_amount = max_c
+        self._setup_initial_values(hcv_groups)
+
+        self.initial_c = initial_c
+        self.reset(initial_c, objective)
+
+    def _setup_initial_values(self, hcv_groups):
+        if isinstance(hcv_groups, str):
+            # `hv_groups` is a path to config file
+            df = pd.DataFrame.from_csv(hcv_groups)
+            hcv_groups = df.get_values()
+        self.hcv_groups = hcv_groups
+        # [num_classes, num_groups]
+        self.vecs = np.asarray(hcv_groups, dtype=np.float64).T
+
+    def reset(self, initial_c=None, objective='alpha'):
+        """
+        Parameters
+        ----------
+        initial_c : ndarray
+            Ndarray of shape (number of cardinalities). Initial cardinalities of the HCVGs.
+        objective : str
+            The objective function of the algorithm. Options:
+            - alpha - normalize LAMBA vector by the sum of HCVGs' cardinalities.
+            - geo - normalize LAMBA vector as a normal vector.
+        """
+        if initial_c is None:
+            initial_c = self.initial_c
+
+        self.cardinalities = np.clip(
+            np.asarray(initial_c, dtype=np.float64).reshape(-1), self.min_amount, self.max_amount
+        )
+        if objective not in ('alpha', 'geo'):
+            print('Unknowm objective. Call `reset` with the correct one.')
+        self.objective = objective
+        # List of functions c -> (value, gradient, deviation vector)
+        self._regs = []
+
+    def show_deviation(self):
+        if len(self._regs) == 0:
+            return None
+        _, _, deviation_vec = self._regs[-1](self.cardinalities)
+        return deviation_vec.reshape(-1, 1)
+
+    def add_reg1(self, alpha, initial_cardinalities):
+        init_c = np.asarray(initial_cardinalities, dtype=np.float64).reshape(-1)
+
+        def reg1(c):
+            deviation_vec = c / init_c - 1.0
+            return alpha * np.dot(deviation_vec, deviation_vec), alpha * 2.0 * deviation_vec / init_c, deviation_vec
+
+        self._regs.append(reg1)
+
+    def add_reg2(self, alpha, initial_cardinalities):
+        init_c = np.asarray(initial_cardinalities, dtype=np.float64).reshape(-1)
+        init_c = init_c / np.sum(init_c)
+
+        def reg2(c):
+            total = np.sum(c)
+            deviation_vec = (init_c - c / total) * 100.0
+            h = -200.0 * deviation_vec
+            return alpha * np.dot(deviation_vec, deviation_vec), alpha * _ratio_grad(h, c, total), deviation_vec
+
+        self._regs.append(reg2)
+
+    def add_reg3(self, alpha, initial_cardinalities):
+        init_c = np.asarray(initial_cardinalities, dtype=np.float64).reshape(-1)
+        init_c = init_c / np.sum(init_c)
+
+        def reg3(c):
+            total = np.sum(c)
+            deviation_vec = c / total / init_c - 1.0
+            h = 2.0 * deviation_vec / init_c
+            return alpha * np.dot(deviation_vec, deviation_vec), alpha * _ratio_grad(h, c, total), deviation_vec
+
+        self._regs.append(reg3)
+
+    def _objective(self, c, pi_vec):
+        scaled = self.vecs.dot(c)
+        if self.objective == 'alpha':
+            total = np.sum(c)
+            diff = scaled / total - pi_vec
+            dist = np.linalg.norm(diff)
+            g = diff / max(dist, 1e-12)
+            grad = self.vecs.T.dot(g) / total - np.dot(g, scaled) / total**2
+        else:
+            scaled_len = np.linalg.norm(scaled)
+            norm_vec = scaled / scaled_len
+            diff = norm_vec - pi_vec
+            dist = np.linalg.norm(diff)
+            g = diff / max(dist, 1e-12)
+            grad = self.vecs.T.dot((g - norm_vec * np.dot(norm_vec, g)) / scaled_len)
+
+        value = dist
+        for reg in self._regs:
+            reg_value, reg_grad, _ = reg(c)
+            value += reg_value
+            grad = grad + reg_grad
+        return value, grad
+
+    def optimize(self, pi_vec, iterations=1000, print_period=None, tol=1e-12):
+        """
+        Perform the algorithm on the initial cardinalities.
+
+        Parameters
+        ----------
+        pi_vec : ndarray
+            Optimal class ratio vector. Ndarray of shape (num_classes).
+            ith element in `pi_vec` stands for number of HCVs that has class i
+            divided by total number of HCVs.
+        iterations : int
+            Maximum number of iterations to perform.
+        print_period : int
+            After each `print_period` iterations supplementary info will be printed.
+        tol : float
+            The optimization stops when the relative reduction of the objective is less than `tol`.
+        """
+        pi_vec = np.asarray(pi_vec, dtype=np.float64).reshape(-1)
+        iteration = [0]
+
+        def callback(c):
+            iteration[0] += 1
+            if print_period is not None and iteration[0] % print_period == 0:
+                print(self._objective(c, pi_vec)[0])
+
+        result = minimize(
+            self._objective, self.cardinalities, args=(pi_vec,), jac=True, method='L-BFGS-B',
+            bounds=[(self.min_amount, self.max_amount)] * len(self.cardinalities),
+            options={'maxiter': iterations, 'ftol': tol}, callback=callback
+        )
+        self.cardinalities = result.x
+        if print_period is not None:
+            print(result.fun)
+            print(self.get_percentage())
+        return result.fun
+
+    def save_cardinalities(self, path):
+        save_cardinalities(path, self.hcv_groups, self.get_weights())
+
+    def get_percentage(self):
+        return get_percentage(self.get_scaled_vecs(), self.get_vec_num())
+
+    def get_weights(self):
+        return self.cardinalities.reshape(-1, 1).astype(np.float32)
+
+    def get_scaled_vecs(self):
+        return self.vecs.dot(self.cardinalities).reshape(-1, 1)
+
+    def get_vec_num(self):
+        return np.sum(self.cardinalities)
@@ -1,18 +1,71 @@
 import numpy as np
+import pandas as pd
 
 
 def hcv_to_num(bin_vec):
+    bin_vec = np.asarray(bin_vec)
+    if len(bin_vec) < 64:
+        return int(np.dot(bin_vec.astype(np.uint64), _bit_weights(len(bin_vec))))
+    # Python ints for the vectors that don't fit into 64 bits
     num = 0
     for i in range(len(bin_vec)):
         num += int(2**i * bin_vec[i])
     return num
 
 
+def hcvs_to_nums(bin_vecs):
+    """
+    Vectorised version of `hcv_to_num`. Packs each row of `bin_vecs` into an integer bitset.
+    Only vectors of less than 64 classes are supported.
+
+    Parameters
+    ----------
+    bin_vecs : ndarray
+        Array of shape [num_vecs, num_classes].
+
+    Returns
+    -------
+    ndarray
+        Array of shape [num_vecs] of np.uint64.
+    """
+    bin_vecs = np.asarray(bin_vecs)
+    assert bin_vecs.shape[1] < 64, 'Only vectors of less than 64 classes are supported.'
+    return bin_vecs.astype(np.uint64).dot(_bit_weights(bin_vecs.shape[1]))
+
+
+def nums_to_hcvs(nums, num_classes):
+    """
+    Unpacks integer bitsets into HC vectors. Inverse of `hcvs_to_nums`.
+
+    Returns
+    -------
+    ndarray
+        Array of shape [len(nums), num_classes] of np.uint8.
+    """
+    nums = np.asarray(nums, dtype=np.uint64).reshape(-1, 1)
+    return ((nums >> np.arange(num_classes, dtype=np.uint64)) & np.uint64(1)).astype(np.uint8)
+
+
+def _bit_weights(num_bits):
+    return np.left_shift(np.uint64(1), np.arange(num_bits, dtype=np.uint64))
+
+
 def to_hc_vec(num_classes, classes):
     vec = np.zeros(num_classes, dtype=np.uint8)
     vec[classes] = 1
     return vec
 
+
+def mask_to_hc_vec(mask, num_classes):
+    """
+    Computes the HC vector of the mask using `np.bincount`, which is much faster than `np.unique`.
+    """
+    counts = np.bincount(np.asarray(mask).ravel(), minlength=num_classes)
+    if len(counts) > num_classes:
+        raise ValueError(f'Mask contains class {len(counts) - 1}, but there are only {num_classes} classes.')
+    return (counts > 0).astype(np.uint8)
+
+
 def get_unique(arr):
     uniq = {}
     uniq_vecs = []
@@ -23,3 +76,32 @@ def get_unique(arr):
             uniq_vecs += [vec]
     return np.array(uniq_vecs), uniq
 
+
+
+def save_cardinalities(path, hcv_groups, cardinalities):
+    """
+    Saves the balance config { HCV number : cardinality } to a csv file.
+    Shared by the balancers.
+
+    Parameters
+    ----------
+    path : str
+        Path to the csv file.
+    hcv_groups : ndarray
+        Array of HCVGs.
+    cardinalities : ndarray
+        Cardinalities of the HCVGs. They are rounded to integers.
+    """
+    cardinalities = np.round(np.asarray(cardinalities).reshape(-1)).astype(np.int32)
+    config = {}
+    for i in range(len(cardinalities)):
+        config[hcv_to_num(hcv_groups[i])] = cardinalities[i]
+    pd.DataFrame.from_dict(config, orient='index').to_csv(path)
+
+
+def get_percentage(scaled_vecs, vec_num):
+    """
+    Returns the percentage of HCVs that have each of the classes.
+    """
+    percentage = scaled_vecs / vec_num
+    return np.round(percentage, decimals=2) * 100
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+import numpy as np
 
 
 class Augmentor(ABC):
@@ -10,6 +11,15 @@ class Augmentor(ABC):
     def get_data(self):
         pass
 
+    def iterate(self):
+        """
+        Lazily yields (image, mask) pairs. Unlike `get_data` only one pair at a time
+        is held in memory, so long augmentation chains run in constant memory.
+        """
+        imgs, masks = self.get_data()
+        for img, mask in zip(imgs, masks):
+            yield img, mask
+
     def _get_shape(self):
         return self._img_shape
 
@@ -21,3 +31,105 @@ class AugmentOp(Augmentor):
         self._img_shape = data._get_shape()
         return self
 
+    @abstractmethod
+    def _augment_pair(self, img, mask):
+        """
+        Returns lists of augmented versions of the given image and mask.
+        """
+        pass
+
+    def _augment_batch(self, imgs, masks):
+        """
+        Array-native version of `_augment_pair`. Takes stacked images and masks of shape
+        (N, H, W, C) and returns lists of augmented stacks of the same shape or None if the
+        operation doesn't support it.
+        """
+        return None
+
+    def get_data(self):
+        """
+        Starts augmentation process.
+        Returns
+        -------
+        two arrays
+            Augmented images and masks.
+        """
+        imgs, masks = self._data.get_data()
+
+        if is_homogeneous(imgs) and is_homogeneous(masks):
+            result = self._get_data_batch(imgs, masks)
+            if result is not None:
+                return result
+
+        return self._get_data_list(imgs, masks)
+
+    def _get_data_list(self, imgs, masks):
+        # Processes the images one by one
+        new_imgs, new_masks = [], []
+        for img, mask in zip(imgs, masks):
+            aug_imgs, aug_masks = self._augment_pair(img, mask)
+            new_imgs += aug_imgs
+            new_masks += aug_masks
+
+        if self.keep_old_data:
+            new_imgs += list(imgs)
+            new_masks += list(masks)
+
+        return new_imgs, new_masks
+
+    def _get_data_batch(self, imgs, masks):
+        # Fast path for images of the same shape. The data is processed as (N, H, W, C) arrays.
+        # The order of the results is the same as in the list path.
+        result = self._augment_batch(np.asarray(imgs), np.asarray(masks))
+        if result is None:
+            return None
+        aug_imgs, aug_masks = result
+        # The stacks may be views (flips, rotations), so the results are views as well
+        new_imgs = [aug[i] for i in range(len(imgs)) for aug in aug_imgs]
+        new_masks = [aug[i] for i in range(len(masks)) for aug in aug_masks]
+        if self.keep_old_data:
+            new_imgs += list(imgs)
+            new_masks += list(masks)
+        return new_imgs, new_masks
+
+    def iterate(self):
+        """
+        Lazily yields (image, mask) pairs. Note that if `keep_old_data` is True,
+        the original pair is yielded right after its augmented versions rather than
+        at the end of the data set as in `get_data`.
+        """
+        for img, mask in self._data.iterate():
+            aug_imgs, aug_masks = self._augment_pair(img, mask)
+            for aug_img, aug_mask in zip(aug_imgs, aug_masks):
+                yield aug_img, aug_mask
+
+            if self.keep_old_data:
+                yield img, mask
+
+
+
+def is_homogeneous(arrs):
+    """
+    Checks whether `arrs` can be treated as a single (N, H, W, ...) array.
+    """
+    if isinstance(arrs, np.ndarray):
+        return arrs.ndim >= 3
+    if len(arrs) == 0 or not isinstance(arrs[0], np.ndarray):
+        return False
+    shape, dtype = arrs[0].shape, arrs[0].dtype
+    for arr in arrs:
+        if not isinstance(arr, np.ndarray) or arr.shape != shape or arr.dtype != dtype:
+            return False
+    return True
+
+
+def unroll_chain(augmentor: Augmentor):
+    """
+    Unrolls the chain Op_n(...Op_1(Data)...) into [Op_1, ..., Op_n] and the data source.
+    """
+    ops = []
+    while isinstance(augmentor, AugmentOp):
+        ops.append(augmentor)
+        augmentor = augmentor._data
+    ops.reverse()
+    return ops, augmentor
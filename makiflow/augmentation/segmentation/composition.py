@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+import numpy as np
+import cv2
+from makiflow.augmentation.segmentation.base import AugmentOp, Augmentor, unroll_chain
+from makiflow.augmentation.segmentation.augment_ops import FlipAugment, RotateAugment, AffineAugment
+
+
+class WarpComposition(AugmentOp):
+    GEOMETRIC_OPS = (FlipAugment, RotateAugment, AffineAugment)
+
+    def __init__(self, augmentor: Augmentor):
+        """
+        Merges a chain of geometric augmentations (FlipAugment, RotateAugment, AffineAugment)
+        into a single affine matrix per output sample. Each image (mask) is then warped only once
+        instead of being resampled at every stage of the chain, what saves both memory and time
+        and avoids accumulating the interpolation error.
+        Produces the same samples in the same order as `augmentor.iterate()`.
+        The interpolation and border settings are taken from the last AffineAugment in the chain.
+
+        Parameters
+        ----------
+        augmentor : Augmentor
+            The last operation of the augmentation chain.
+        """
+        super().__init__()
+        ops, source = unroll_chain(augmentor)
+        for op in ops:
+            if not isinstance(op, WarpComposition.GEOMETRIC_OPS):
+                raise ValueError(f'{op.__class__.__name__} is not a geometric augmentation and cannot be composed.')
+        self._ops = ops
+        # { image shape : composed transforms }
+        self._transforms = {}
+        self.keep_old_data = False
+        self.img_inter = cv2.INTER_NEAREST
+        self.mask_inter = cv2.INTER_NEAREST
+        self.border_mode = cv2.BORDER_REFLECT101
+        for op in ops:
+            if isinstance(op, AffineAugment):
+                self.img_inter = op.img_inter
+                self.mask_inter = op.mask_inter
+                self.border_mode = op.border_mode
+        self(source)
+
+    def _compose(self, shape):
+        # List of tuples (3x3 matrix, output shape) in the order of `iterate`
+        shape = tuple(shape[:2])
+        if shape in self._transforms:
+            return self._transforms[shape]
+
+        transforms = [(np.eye(3), tuple(shape[:2]))]
+        for op in self._ops:
+            new_transforms = []
+            for T, t_shape in transforms:
+                for M, m_shape in op._get_matrices(t_shape):
+                    new_transforms.append((M.dot(T), m_shape))
+                if op.keep_old_data:
+                    new_transforms.append((T, t_shape))
+            transforms = new_transforms
+        self._transforms[shape] = transforms
+        return transforms
+
+    def _augment_pair(self, img, mask):
+        new_imgs, new_masks = [], []
+        for T, (h, w) in self._compose(img.shape):
+            if (h, w) == img.shape[:2] and np.array_equal(T, np.eye(3)):
+                # Unaugmented sample
+                new_imgs.append(img)
+                new_masks.append(mask)
+                continue
+            img_inter = self.img_inter
+            if np.array_equal(T, np.round(T)):
+                # Flips and rotations only move pixels, so the interpolation isn't needed
+                img_inter = cv2.INTER_NEAREST
+            new_imgs.append(
+                cv2.warpAffine(img, T[:2], (w, h), flags=img_inter, borderMode=self.border_mode)
+            )
+            new_masks.append(
+                cv2.warpAffine(mask, T[:2], (w, h), flags=self.mask_inter, borderMode=self.border_mode)
+            )
+        return new_imgs, new_masks
+
+    def __call__(self, data: Augmentor):
+        super().__call__(data)
+        return self
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 from makiflow.augmentation.segmentation.base import Augmentor
+import cv2
 
 
 class Data(Augmentor):
@@ -12,3 +13,31 @@ class Data(Augmentor):
     def get_data(self):
         return self.images, self.masks
 
+
+class LazyData(Augmentor):
+    def __init__(self, image_paths, mask_paths):
+        """
+        Data source that reads images and masks from disk only when they are needed.
+        Use it with `iterate` to run augmentation chains in constant memory.
+        Parameters
+        ----------
+        image_paths : list
+            Paths to the images.
+        mask_paths : list
+            Paths to the corresponding masks.
+        """
+        super().__init__()
+        self.image_paths = image_paths
+        self.mask_paths = mask_paths
+        self._img_shape = cv2.imread(image_paths[0]).shape
+
+    def get_data(self):
+        images, masks = [], []
+        for img, mask in self.iterate():
+            images.append(img)
+            masks.append(mask)
+        return images, masks
+
+    def iterate(self):
+        for image_path, mask_path in zip(self.image_paths, self.mask_paths):
+            yield cv2.imread(image_path), cv2.imread(mask_path)
@@ -0,0 +1,212 @@
+from __future__ import absolute_import
+from collections import OrderedDict
+from scipy.ndimage import gaussian_filter
+import numpy as np
+import cv2
+
+
+def generate_displacement(random_state, field_shape, std, alpha):
+    """
+    Generates a low resolution displacement field for the elastic transformation.
+
+    Parameters
+    ----------
+    random_state : np.random.RandomState
+        Source of the noise.
+    field_shape : tuple
+        (height, width) of the field.
+    std : int
+        Std of the gaussian filter applied to the noise.
+    alpha : int
+        Scale of the displacement.
+
+    Returns
+    -------
+    np.ndarray
+        Displacement along the x axis.
+    np.ndarray
+        Displacement along the y axis.
+    """
+    dx = gaussian_filter(
+        (random_state.rand(*field_shape) * 2 - 1),
+        std,
+        mode='nearest'
+    ) * alpha
+    dy = gaussian_filter(
+        (random_state.rand(*field_shape) * 2 - 1),
+        std,
+        mode='nearest'
+    ) * alpha
+    return dx, dy
+
+
+def displacement_to_map(dx, dy, img_shape):
+    """
+    Upsamples the displacement field to the image size and converts it into the maps
+    used by `cv2.remap`.
+
+    Parameters
+    ----------
+    dx : np.ndarray
+        Displacement along the x axis.
+    dy : np.ndarray
+        Displacement along the y axis.
+    img_shape : tuple
+        Shape of the image. Use OpenCV order for dimensionalities: (height, width, depth).
+
+    Returns
+    -------
+    np.ndarray
+        mapx of shape (height, width), float32.
+    np.ndarray
+        mapy of shape (height, width), float32.
+    """
+    dx = cv2.resize(np.asarray(dx, dtype=np.float32), (img_shape[1], img_shape[0]))
+    dy = cv2.resize(np.asarray(dy, dtype=np.float32), (img_shape[1], img_shape[0]))
+
+    x, y = np.meshgrid(np.arange(img_shape[1], dtype=np.float32), np.arange(img_shape[0], dtype=np.float32))
+    mapx = x + dx
+    mapy = y + dy
+    return mapx, mapy
+
+
+class ElasticMapBank:
+    def __init__(
+            self, size=100, alpha=500, std=8, noise_invert_scale=5, seed=None,
+            cache_size=16, dtype=np.float16
+    ):
+        """
+        Stores elastic transformation maps in a compact form: only the low resolution displacement
+        fields are kept, they are upsampled to the image size on use. Upsampled maps are cached
+        in a LRU cache. The bank can be saved to disk and reused by other processes and runs.
+
+        Parameters
+        ----------
+        size : int
+            Number of displacement fields in the bank (per image size).
+        alpha : int
+            Affects curvature. See ElasticAugment.
+        std : int
+            Affects curvature. See ElasticAugment.
+        noise_invert_scale : int
+            The displacement fields are of size
+            (img_h // `noise_invert_scale`, img_w // `noise_invert_scale`). See ElasticAugment.
+        seed : int (optional)
+            Seed for the random generator.
+        cache_size : int
+            Maximum number of the upsampled maps held in memory.
+        dtype : np.dtype
+            Dtype of the stored displacement fields.
+        """
+        self.size = size
+        self.alpha = alpha
+        self.std = std
+        self.noise_invert_scale = noise_invert_scale
+        self.cache_size = cache_size
+        self.dtype = dtype
+        self.seed = seed
+        self.random_state = np.random.RandomState(seed)
+        # { field shape : array of shape [size, 2, field_h, field_w] }
+        self._fields = {}
+        self._cache = OrderedDict()
+
+    def _field_shape(self, img_shape):
+        return img_shape[0] // self.noise_invert_scale, img_shape[1] // self.noise_invert_scale
+
+    def get_fields(self, img_shape):
+        """
+        Returns the displacement fields for the given image shape. The fields are generated
+        on the first request.
+        """
+        field_shape = self._field_shape(img_shape)
+        fields = self._fields.get(field_shape)
+        if fields is None:
+            fields = np.empty((self.size, 2) + field_shape, dtype=self.dtype)
+            for i in range(self.size):
+                fields[i] = generate_displacement(self.random_state, field_shape, self.std, self.alpha)
+            self._fields[field_shape] = fields
+        return fields
+
+    def get_map(self, ind, img_shape):
+        """
+        Parameters
+        ----------
+        ind : int
+            Index of the map in the bank.
+        img_shape : tuple
+            Shape of the image. Use OpenCV order for dimensionalities: (height, width, depth).
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+            mapx and mapy for `cv2.remap`.
+        """
+        key = (ind, tuple(img_shape[:2]))
+        maps = self._cache.get(key)
+        if maps is not None:
+            self._cache.move_to_end(key)
+            return maps
+
+        dx, dy = self.get_fields(img_shape)[ind]
+        maps = displacement_to_map(dx, dy, img_shape)
+        self._cache[key] = maps
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return maps
+
+    def sample_maps(self, num_maps, img_shape):
+        """
+        Returns `num_maps` randomly chosen maps from the bank. The maps are distinct if the bank
+        has enough of them, otherwise they are sampled with replacement.
+        """
+        inds = self.random_state.choice(self.size, size=num_maps, replace=num_maps > self.size)
+        return [self.get_map(ind, img_shape) for ind in inds]
+
+    def reseed(self, seed=None):
+        """
+        Resets the random generator used for sampling and generating new fields. Call it in every
+        worker process sharing a copy of the bank, otherwise all the copies draw the same maps.
+        """
+        self.random_state = np.random.RandomState(seed)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def save(self, path):
+        """
+        Saves the displacement fields and the parameters of the bank into a .npz file.
+        """
+        fields = {}
+        for i, (field_shape, field) in enumerate(self._fields.items()):
+            fields[f'fields_{i}'] = field
+        np.savez(
+            path,
+            params=np.array([self.size, self.alpha, self.std, self.noise_invert_scale], dtype=np.float64),
+            **fields
+        )
+
+    @staticmethod
+    def load(path, seed=None, cache_size=16):
+        """
+        Loads the bank saved with `save`.
+
+        Parameters
+        ----------
+        path : str
+            Path to the .npz file.
+        seed : int (optional)
+            Seed for the random generator used for sampling and generating new fields.
+        cache_size : int
+            Maximum number of the upsampled maps held in memory.
+        """
+        data = np.load(path)
+        size, alpha, std, noise_invert_scale = data['params']
+        fields = [data[key] for key in data.files if key.startswith('fields_')]
+        dtype = fields[0].dtype if len(fields) > 0 else np.float16
+        bank = ElasticMapBank(
+            size=int(size), alpha=alpha, std=std, noise_invert_scale=int(noise_invert_scale),
+            seed=seed, cache_size=cache_size, dtype=dtype
+        )
+        for field in fields:
+            bank._fields[field.shape[2:]] = field
+        return bank
@@ -1,4 +1,68 @@
 import cv2
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class WindowDataset:
+    def __init__(self, images, masks, positions, window_h, window_w):
+        """
+        Lazily indexed set of windows. Windows are views of the (resized) source images,
+        so no pixel data is copied until the windows are used.
+        Use ImageCutter.image_and_mask_windows to create it.
+
+        Parameters
+        ----------
+        images : list
+            Source images (one per image and scale).
+        masks : list
+            Source masks (one per image and scale).
+        positions : np.ndarray
+            Array of shape [num_windows, 3]. Each row is (source index, top, left).
+        window_h : int
+            Window height.
+        window_w : int
+            Window width.
+        """
+        self.images = images
+        self.masks = masks
+        self.positions = positions
+        self.window_h = window_h
+        self.window_w = window_w
+        # Strided views of all the windows of each source, indexed by the top left corner
+        self._image_views = [ImageCutter.window_views(img, window_h, window_w) for img in images]
+        self._mask_views = [ImageCutter.window_views(mask, window_h, window_w) for mask in masks]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, ind):
+        src, up, left = self.positions[ind]
+        return self._image_views[src][up, left], self._mask_views[src][up, left]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def count_positives(self, background=0):
+        """
+        Counts pixels that don't belong to the `background` class in every window.
+        Computed for all the windows at once using integral images.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape [num_windows].
+        """
+        counts = np.empty(len(self.positions), dtype=np.int64)
+        for src, mask in enumerate(self.masks):
+            src_inds = np.nonzero(self.positions[:, 0] == src)[0]
+            if len(src_inds) == 0:
+                continue
+            counts[src_inds] = ImageCutter.count_positives(
+                mask, self.positions[src_inds, 1], self.positions[src_inds, 2],
+                self.window_h, self.window_w, background
+            )
+        return counts
 
 
 class ImageCutter:
@@ -27,6 +91,8 @@ class ImageCutter:
             are resized to (previous_width * scale_factor, previous_height * scale_factor).
         postprocessing : func
             Post processing function, using on cropped image (may be function what calculate num positives pixels).
+            Use `image_and_mask_windows` with `WindowDataset.count_positives` to count positives for
+            all the windows at once.
         use_all_px : bool
             If True, all pixels of image would be in output lists.
 
@@ -37,69 +103,53 @@ class ImageCutter:
             2. cropped masks
             3. additional list (result of post processing)
         """
+        windows = ImageCutter.image_and_mask_windows(
+            images, masks, window_h, window_w, step_x, step_y, scale_factor, use_all_px
+        )
+        cropped_images = []
+        cropped_masks = []
+        additional_list = []
+        for crop_img, crop_mask in windows:
+            cropped_images.append(crop_img)
+            cropped_masks.append(crop_mask)
+            if postprocessing is not None:
+                additional_list.append(postprocessing(crop_img, crop_mask))
+
+        return cropped_images, cropped_masks, additional_list
+
+    @staticmethod
+    def image_and_mask_windows(images, masks, window_h, window_w, step_x, step_y, scale_factor, use_all_px=True):
+        """
+        Same as `image_and_mask_cutter`, but returns a lazily indexed WindowDataset.
+        Windows go in the same order as the crops returned by `image_and_mask_cutter`.
+
+        Returns
+        -------
+        WindowDataset
+        """
         assert (0 < scale_factor < 1)
         assert (len(images) > 0)
         assert (len(images) == len(masks))
         assert (window_h > 0 and window_w > 0 and step_x > 0 and step_y > 0)
 
-        cropped_images = []
-        cropped_masks = []
-        additional_list = []
-        dx = 0
-        dy = 0
-
-        for index, (img, mask) in enumerate(zip(images, masks)):
+        src_images = []
+        src_masks = []
+        positions = []
+        for img, mask in zip(images, masks):
             assert (img.shape[:2] == mask.shape[:2])
             current_height, current_width = img.shape[:2]
 
             while current_height > window_h and current_width > window_w:
-
-                for dy in range(int((current_height - window_h) / step_y)):
-                    for dx in range(int((current_width - window_w) / step_x)):
-                        crop_img, crop_mask = ImageCutter.crop_img_and_mask(
-                            img,
-                            mask,
-                            dy * step_y, dy * step_y + window_h, dx * step_x, dx * step_x + window_w)
-                        cropped_images.append(crop_img)
-                        cropped_masks.append(crop_mask)
-                        if postprocessing is not None:
-                            additional_list.append(postprocessing(crop_img, crop_mask))
-
-                if use_all_px:
-                    overlap_y = dy * step_y + window_h != current_height
-                    overlap_x = dx * step_x + window_w != current_width
-                    if overlap_y:
-                        for dx in range(int((current_width - window_w) / step_x)):
-                            crop_img, crop_mask = ImageCutter.crop_img_and_mask(
-                                img,
-                                mask,
-                                current_height - window_h, current_height, dx * step_x, dx * step_x + window_w)
-                            cropped_images.append(crop_img)
-                            cropped_masks.append(crop_mask)
-
-                            if postprocessing is not None:
-                                additional_list.append(postprocessing(crop_img, crop_mask))
-                    if overlap_x:
-                        for dy in range(int((current_height - window_h) / step_y)):
-                            crop_img, crop_mask = ImageCutter.crop_img_and_mask(
-                                img,
-                                mask,
-                                dy * step_y, dy * step_y + window_h, current_width - window_w, current_width)
-                            cropped_images.append(crop_img)
-                            cropped_masks.append(crop_mask)
-
-                            if postprocessing is not None:
-                                additional_list.append(postprocessing(crop_img, crop_mask))
-                    if overlap_x and overlap_y:
-                        crop_img, crop_mask = ImageCutter.crop_img_and_mask(
-                            img,
-                            mask,
-                            current_height - window_h, current_height, current_width - window_w, current_width)
-                        cropped_images.append(crop_img)
-                        cropped_masks.append(crop_mask)
-
-                        if postprocessing is not None:
-                            additional_list.append(postprocessing(crop_img, crop_mask))
+                ys, xs = ImageCutter.get_window_positions(
+                    current_height, current_width, window_h, window_w, step_x, step_y, use_all_px
+                )
+                src_positions = np.empty((len(ys), 3), dtype=np.int64)
+                src_positions[:, 0] = len(src_images)
+                src_positions[:, 1] = ys
+                src_positions[:, 2] = xs
+                positions.append(src_positions)
+                src_images.append(img)
+                src_masks.append(mask)
 
                 img = cv2.resize(
                     img, (int(current_width * scale_factor), int(current_height * scale_factor)),
@@ -112,7 +162,101 @@ class ImageCutter:
 
                 current_height, current_width = img.shape[:2]
 
-        return cropped_images, cropped_masks, additional_list
+        if len(positions) > 0:
+            positions = np.concatenate(positions, axis=0)
+        else:
+            positions = np.empty((0, 3), dtype=np.int64)
+        return WindowDataset(src_images, src_masks, positions, window_h, window_w)
+
+    @staticmethod
+    def get_window_positions(height, width, window_h, window_w, step_x, step_y, use_all_px=True):
+        """
+        Computes top left corners of the sliding windows.
+        The regular grid goes first (row by row), then (if `use_all_px` is True) the windows
+        adjacent to the bottom border, the windows adjacent to the right border and the corner one.
+        If the image is too small for a single grid row (column), the border windows are
+        always added. Older versions decided it using the grid of the previous scale.
+
+        Returns
+        -------
+        np.ndarray
+            Top coordinates of the windows.
+        np.ndarray
+            Left coordinates of the windows.
+        """
+        grid_ys = np.arange(int((height - window_h) / step_y)) * step_y
+        grid_xs = np.arange(int((width - window_w) / step_x)) * step_x
+        ys_parts = [np.repeat(grid_ys, len(grid_xs))]
+        xs_parts = [np.tile(grid_xs, len(grid_ys))]
+
+        if use_all_px:
+            overlap_y = len(grid_ys) == 0 or grid_ys[-1] + window_h != height
+            overlap_x = len(grid_xs) == 0 or grid_xs[-1] + window_w != width
+            if overlap_y:
+                ys_parts.append(np.full(len(grid_xs), height - window_h))
+                xs_parts.append(grid_xs)
+            if overlap_x:
+                ys_parts.append(grid_ys)
+                xs_parts.append(np.full(len(grid_ys), width - window_w))
+            if overlap_x and overlap_y:
+                ys_parts.append(np.array([height - window_h]))
+                xs_parts.append(np.array([width - window_w]))
+
+        return np.concatenate(ys_parts).astype(np.int64), np.concatenate(xs_parts).astype(np.int64)
+
+    @staticmethod
+    def window_views(img, window_h, window_w):
+        """
+        Returns all the windows of `img` as a single strided view. No data is copied.
+        The window with the top left corner (y, x) is `views[y, x]`.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape [H - window_h + 1, W - window_w + 1, window_h, window_w, ...].
+        """
+        # [H - window_h + 1, W - window_w + 1, ..., window_h, window_w]
+        windows = sliding_window_view(img, (window_h, window_w), axis=(0, 1))
+        # Move the window axes right after the position axes
+        return np.moveaxis(windows, (-2, -1), (2, 3))
+
+    @staticmethod
+    def count_positives(mask, ys, xs, window_h, window_w, background=0):
+        """
+        Counts pixels that don't belong to the `background` class in the windows of `mask`.
+        If the mask has several channels, the first one is used.
+
+        Parameters
+        ----------
+        mask : np.ndarray
+            The mask.
+        ys : np.ndarray
+            Top coordinates of the windows.
+        xs : np.ndarray
+            Left coordinates of the windows.
+        window_h : int
+            Window height.
+        window_w : int
+            Window width.
+        background : int
+            Index of the negative class.
+
+        Returns
+        -------
+        np.ndarray
+            Number of positives for each window.
+        """
+        if mask.ndim == 3:
+            mask = mask[:, :, 0]
+        # Integral image with a zero row and column at the beginning
+        integral = cv2.integral((mask != background).view(np.uint8))
+        ys = np.asarray(ys)
+        xs = np.asarray(xs)
+        counts = (
+                integral[ys + window_h, xs + window_w] - integral[ys, xs + window_w]
+                - integral[ys + window_h, xs] + integral[ys, xs]
+        )
+        return counts.astype(np.int64)
 
     @staticmethod
     def crop_img_and_mask(img, mask, up, down, left, right):
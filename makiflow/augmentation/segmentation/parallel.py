@@ -0,0 +1,157 @@
+from __future__ import absolute_import
+import copy
+import ctypes
+import multiprocessing as mp
+import numpy as np
+from makiflow.augmentation.segmentation.base import Augmentor, unroll_chain
+from makiflow.augmentation.segmentation.augment_ops import ElasticAugment
+
+
+def _to_shared(arr):
+    # Copies `arr` into a shared memory buffer. The buffer can be passed to child processes
+    # on their creation without pickling the data.
+    raw = mp.RawArray(ctypes.c_uint8, max(arr.nbytes, 1))
+    _from_shared(raw, arr.dtype, arr.shape)[...] = arr
+    return raw
+
+
+def _from_shared(raw, dtype, shape):
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _augment_pair(ops, img, mask):
+    # Runs the chain on a single pair. The order of the results is the same as in `iterate`.
+    pairs = [(img, mask)]
+    for op in ops:
+        new_pairs = []
+        for p_img, p_mask in pairs:
+            aug_imgs, aug_masks = op._augment_pair(p_img, p_mask)
+            new_pairs += list(zip(aug_imgs, aug_masks))
+            if op.keep_old_data:
+                new_pairs.append((p_img, p_mask))
+        pairs = new_pairs
+    return pairs
+
+
+# Worker state. It is set once per worker process by `_init_worker`.
+_worker = {}
+
+
+def _init_worker(ops, shared_maps, src, dst, outputs_per_pair):
+    for op, maps in zip(ops, shared_maps):
+        if maps is not None:
+            raw, shape = maps
+            maps = _from_shared(raw, np.float32, shape)
+            op._maps = [(mapx, mapy) for mapx, mapy in maps]
+
+    _worker['ops'] = ops
+    _worker['src'] = [_from_shared(*arr_info) for arr_info in src]
+    _worker['dst'] = [_from_shared(*arr_info) for arr_info in dst]
+    _worker['outputs_per_pair'] = outputs_per_pair
+
+
+def _process_shard(shard):
+    start, end = shard
+    imgs, masks = _worker['src']
+    out_imgs, out_masks = _worker['dst']
+    k = _worker['outputs_per_pair']
+    for i in range(start, end):
+        for j, (img, mask) in enumerate(_augment_pair(_worker['ops'], imgs[i], masks[i])):
+            out_imgs[i * k + j] = img
+            out_masks[i * k + j] = mask
+
+
+class ParallelExecutor:
+    def __init__(self, num_workers=None, shards_per_worker=4):
+        """
+        Runs an augmentation chain in a pool of worker processes.
+        The input images, the elastic maps and the results are kept in shared memory,
+        so neither of them is pickled when sent to the workers.
+        All the images (masks) must have the same shape and all the augmentations in the chain
+        must produce images of the same shape.
+
+        Parameters
+        ----------
+        num_workers : int
+            Number of worker processes. Defaults to the number of CPUs.
+        shards_per_worker : int
+            The data is split into `num_workers` * `shards_per_worker` shards
+            to balance the workload between the workers.
+        """
+        self.num_workers = num_workers if num_workers is not None else mp.cpu_count()
+        self.shards_per_worker = shards_per_worker
+
+    def run(self, augmentor: Augmentor):
+        """
+        Performs the augmentation. The results are the same as those of
+        `augmentor.iterate()`, i.e. if `keep_old_data` is True the original images follow their
+        augmented versions.
+
+        Parameters
+        ----------
+        augmentor : Augmentor
+            The last operation of the augmentation chain.
+
+        Returns
+        -------
+        np.ndarray
+            Augmented images. The array is backed by shared memory.
+        np.ndarray
+            Augmented masks. The array is backed by shared memory.
+        """
+        ops, source = unroll_chain(augmentor)
+        imgs, masks = source.get_data()
+        imgs = np.asarray(imgs)
+        masks = np.asarray(masks)
+        if imgs.dtype == np.object_ or masks.dtype == np.object_:
+            raise ValueError('All the images (masks) must have the same shape.')
+
+        # Find out the number and the shape of the outputs using the first pair
+        sample = _augment_pair(ops, imgs[0], masks[0])
+        k = len(sample)
+        out_img_shape = (len(imgs) * k,) + sample[0][0].shape
+        out_mask_shape = (len(masks) * k,) + sample[0][1].shape
+        for img, mask in sample:
+            if img.shape != sample[0][0].shape or mask.shape != sample[0][1].shape:
+                raise ValueError('The augmentations must produce images (masks) of the same shape.')
+
+        src = [
+            (_to_shared(imgs), imgs.dtype, imgs.shape),
+            (_to_shared(masks), masks.dtype, masks.shape)
+        ]
+        del imgs, masks
+        out_imgs_raw = mp.RawArray(ctypes.c_uint8, int(np.prod(out_img_shape)) * sample[0][0].itemsize)
+        out_masks_raw = mp.RawArray(ctypes.c_uint8, int(np.prod(out_mask_shape)) * sample[0][1].itemsize)
+        dst = [
+            (out_imgs_raw, sample[0][0].dtype, out_img_shape),
+            (out_masks_raw, sample[0][1].dtype, out_mask_shape)
+        ]
+
+        worker_ops, shared_maps = self._prepare_ops(ops)
+        num_pairs = src[0][2][0]
+        num_shards = min(num_pairs, self.num_workers * self.shards_per_worker)
+        bounds = np.linspace(0, num_pairs, num_shards + 1).astype(np.int64)
+        shards = [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+        with mp.Pool(
+                self.num_workers, initializer=_init_worker,
+                initargs=(worker_ops, shared_maps, src, dst, k)
+        ) as pool:
+            pool.map(_process_shard, shards)
+
+        return _from_shared(*dst[0]), _from_shared(*dst[1])
+
+    def _prepare_ops(self, ops):
+        # Copies of the operations are sent to the workers. The elastic maps are moved
+        # into shared memory, the data sources are detached so that they aren't pickled.
+        worker_ops, shared_maps = [], []
+        for op in ops:
+            worker_op = copy.copy(op)
+            worker_op._data = None
+            maps = None
+            if isinstance(op, ElasticAugment):
+                np_maps = np.asarray(op._maps, dtype=np.float32)
+                maps = (_to_shared(np_maps), np_maps.shape)
+                worker_op._maps = None
+            worker_ops.append(worker_op)
+            shared_maps.append(maps)
+        return worker_ops, shared_maps
@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+import os
+import numpy as np
+import cv2
+import tensorflow as tf
+
+
+class RecordField:
+    image = 'image'
+    mask = 'mask'
+
+
+def shuffle_stream(pairs, buffer_size, seed=None):
+    """
+    Shuffles a stream of (image, mask) pairs using a bounded buffer.
+    Only `buffer_size` pairs are held in memory at once, thus the shuffling is
+    approximate just like in `tf.data.Dataset.shuffle`.
+
+    Parameters
+    ----------
+    pairs : iterable
+        Stream of (image, mask) pairs. Example: `augmentor.iterate()`.
+    buffer_size : int
+        Size of the shuffle buffer.
+    seed : int (optional)
+        Seed for the random generator.
+    """
+    random_state = np.random.RandomState(seed)
+    buffer = []
+    for pair in pairs:
+        if len(buffer) < buffer_size:
+            buffer.append(pair)
+            continue
+        ind = random_state.randint(buffer_size)
+        yield buffer[ind]
+        buffer[ind] = pair
+
+    random_state.shuffle(buffer)
+    for pair in buffer:
+        yield pair
+
+
+def save_stream(pairs, path_to_save, prefix='', ext='bmp'):
+    """
+    Writes a stream of (image, mask) pairs straight to disk.
+    Images and masks are saved in the `images` and `masks` folders respectively.
+
+    Parameters
+    ----------
+    pairs : iterable
+        Stream of (image, mask) pairs. Example: `augmentor.iterate()`.
+    path_to_save : str
+        Path to the folder where the data will be saved.
+    prefix : str
+        Prefix of the file names.
+    ext : str
+        Extension of the files. Defines the image format.
+
+    Returns
+    -------
+    int
+        Number of the saved pairs.
+    """
+    masks_path = os.path.join(path_to_save, 'masks')
+    imgs_path = os.path.join(path_to_save, 'images')
+    os.makedirs(masks_path, exist_ok=True)
+    os.makedirs(imgs_path, exist_ok=True)
+    counter = 0
+    for img, mask in pairs:
+        cv2.imwrite(os.path.join(masks_path, f'{prefix}{counter}.{ext}'), mask)
+        cv2.imwrite(os.path.join(imgs_path, f'{prefix}{counter}.{ext}'), img)
+        counter += 1
+    return counter
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def save_stream_to_record(pairs, path_to_record, ext='.png'):
+    """
+    Writes a stream of (image, mask) pairs into a TFRecord file. Images and masks are
+    stored encoded under the `RecordField.image` and `RecordField.mask` keys, so they can be
+    decoded with `tf.image.decode_image`.
+
+    Parameters
+    ----------
+    pairs : iterable
+        Stream of (image, mask) pairs. Example: `augmentor.iterate()`.
+    path_to_record : str
+        Path to the record file.
+    ext : str
+        Encoding format. Use lossless formats ('.png', '.bmp') for the masks to stay correct.
+
+    Returns
+    -------
+    int
+        Number of the saved pairs.
+    """
+    counter = 0
+    with tf.io.TFRecordWriter(path_to_record) as writer:
+        for img, mask in pairs:
+            _, img_bytes = cv2.imencode(ext, img)
+            _, mask_bytes = cv2.imencode(ext, mask)
+            example = tf.train.Example(features=tf.train.Features(feature={
+                RecordField.image: _bytes_feature(img_bytes.tobytes()),
+                RecordField.mask: _bytes_feature(mask_bytes.tobytes())
+            }))
+            writer.write(example.SerializeToString())
+            counter += 1
+    return counter
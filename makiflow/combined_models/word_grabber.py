@@ -3,15 +3,23 @@ from makiflow.save_recover.builder import Builder
 # NON-MAXIMUM SUPRESSION
 from makiflow.models.ssd.ssd_utils import nms
 from makiflow.tools.image_cutter import ImageCutter
+from threading import Thread, Event
+from queue import Queue
 import cv2
 # For cutting out pieces of images with text
 import numpy as np
 
 
+# Marks the end of the stream in the queues between the stages of `WordGrabber.process_pages`
+_END = None
+
+
 class WordGrabber:
     # Used for the preparing input images to the SSD
     SSD_X_STEP = 150
     SSD_Y_STEP = 150
+    # Max number of pages waiting in the queues between the stages
+    QUEUE_SIZE = 2
 
 
     def __init__(self, path_to_textrec, path_to_ssd):
@@ -40,7 +48,7 @@ class WordGrabber:
         self.text_rec_model = Builder.text_recognizer_from_json(self.text_rec_json, batch_size=batch_sz_text_rec)
         self.text_rec_input_shape = self.text_rec_model.input_shape
 
-        self.ssd_model = Builder.ssd_from_json(self.ssd_json, batch_size=batch_sz_text_rec)
+        self.ssd_model = Builder.ssd_from_json(self.ssd_json, batch_size=batch_sz_ssd)
         self.ssd_input_shape = self.ssd_model.input_shape
     
 
@@ -70,73 +78,201 @@ class WordGrabber:
         Returns
         -------
         tuple
-            Contains two lists: list with bounding boxes and list with predicted text in
-            the matching bounding box.
+            Contains two lists: list with predicted text and list with the matching
+            bounding boxes.
+        """
+        bboxes = self.__detect_words(image)
+        text_rec_input, bboxes = self.__prepare_crops(image, bboxes)
+        recognized_text = [None] * len(text_rec_input)
+        # Crops of close widths go into the same batch, so the batches are padded less
+        order = np.argsort([len(crop) for crop in text_rec_input], kind='stable')
+        for i in range(0, len(order), self.text_rec_model.batch_sz):
+            batch_indices = order[i: i + self.text_rec_model.batch_sz]
+            texts = self.__recognize_batch([text_rec_input[ind] for ind in batch_indices])
+            for ind, text in zip(batch_indices, texts):
+                recognized_text[ind] = text
+        return (recognized_text, bboxes)
+
+
+    def process_pages(self, images):
+        """
+        Same as `process`, but for a sequence of pages. The stages run in separate threads connected
+        with bounded queues: detection of the words, cutting and preparing the crops and recognition.
+        So the SSD works on the next page while the crops of the previous one are being recognized.
+        Crops of different pages are grouped together in order to feed full batches to the recognizer.
+        Parameters
+        ----------
+        images : iterable
+            Pages to process. Can be a generator, the pages are read as soon as there is room in the queues.
+        Returns
+        -------
+        list
+            Contains tuples (list with predicted text, list with bounding boxes), one for each page.
         """
+        detected = Queue(maxsize=WordGrabber.QUEUE_SIZE)
+        prepared = Queue(maxsize=WordGrabber.QUEUE_SIZE)
+        errors = []
+        # Set when the recognition fails, so that the other stages stop
+        stop = Event()
+
+        def detect():
+            try:
+                for image in images:
+                    if stop.is_set():
+                        break
+                    detected.put((image, self.__detect_words(image)))
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                detected.put(_END)
+
+        def prepare():
+            try:
+                while True:
+                    item = detected.get()
+                    if item is _END:
+                        break
+                    if not stop.is_set():
+                        prepared.put(self.__prepare_crops(*item))
+            except Exception as ex:
+                errors.append(ex)
+                # Unblock the detection stage
+                while detected.get() is not _END:
+                    pass
+            finally:
+                prepared.put(_END)
+
+        stages = [Thread(target=detect, daemon=True), Thread(target=prepare, daemon=True)]
+        for stage in stages:
+            stage.start()
+
+        # Recognition runs in the calling thread
+        results = []
+        # Crops waiting for the recognizer: (page index, crop index, crop)
+        pending = []
+        batch_sz = self.text_rec_model.batch_sz
+        finished = False
+        try:
+            while True:
+                item = prepared.get()
+                if item is _END:
+                    finished = True
+                    break
+                text_rec_input, bboxes = item
+                results.append(([None] * len(bboxes), bboxes))
+                pending += [(len(results) - 1, i, crop) for i, crop in enumerate(text_rec_input)]
+                while len(pending) >= batch_sz:
+                    self.__recognize_pending(pending[:batch_sz], results)
+                    pending = pending[batch_sz:]
+            if len(pending) > 0:
+                self.__recognize_pending(pending, results)
+        finally:
+            if not finished:
+                # Unblock the other stages, otherwise they hang on the full queues holding the pages
+                stop.set()
+                while prepared.get() is not _END:
+                    pass
+
+        for stage in stages:
+            stage.join()
+        if len(errors) != 0:
+            raise errors[0]
+        return results
+
+
+    def __recognize_pending(self, pending, results):
+        texts = self.__recognize_batch([crop for _, _, crop in pending])
+        for (page_ind, crop_ind, _), text in zip(pending, texts):
+            results[page_ind][0][crop_ind] = text
+
+
+    def __detect_words(self, image):
         images_to_feed, offsets = self.__prepare_image_for_ssd(image)
         predictions = self.__get_ssd_predictions(images_to_feed, offsets)
-        # Perform Non-Maximum Supression
-        bboxes_for_text = self.__filter_ssd_predictions(predictions)
+        # Perform Non-Maximum Supression over the whole page at once
+        return self.__filter_ssd_predictions(predictions)
+
+
+    def __prepare_crops(self, image, bboxes):
+        # Clip the boxes to the page and drop empty ones
+        bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+        bboxes[:, [0, 2]] = np.clip(bboxes[:, [0, 2]], 0, image.shape[1])
+        bboxes[:, [1, 3]] = np.clip(bboxes[:, [1, 3]], 0, image.shape[0])
+        bboxes = bboxes[(bboxes[:, 2] - bboxes[:, 0] >= 1) & (bboxes[:, 3] - bboxes[:, 1] >= 1)]
         # Get bounded images with detected text
-        images_for_text_rec = ImageCutter.get_bounded_texts(image, bboxes_for_text)
-        # Prepare the images
-        text_rec_input = self.__prepare_text_rec_input(images_for_text_rec)
-        
-        # RECOGNIZE GIVEN IMAGES
-        recognized_text = []
-        for image in text_rec_input:
-            text = self.text_rec_model.infer_batch([image])
-            recognized_text += text
-        return (recognized_text, predictions[1])
+        images_for_text_rec = ImageCutter.get_bounded_texts(image, bboxes)
+        return self.__prepare_text_rec_input(images_for_text_rec), bboxes.tolist()
+
+
+    def __recognize_batch(self, text_rec_input):
+        # The recognizer takes only full batches, so the last one is padded with narrow blank images
+        batch_sz = self.text_rec_model.batch_sz
+        n_images = len(text_rec_input)
+        if n_images == 0:
+            return []
+        blank = np.ones((1, *self.text_rec_input_shape[2:]), dtype=np.float32)
+        batch = list(text_rec_input) + [blank] * (batch_sz - n_images)
+        return self.text_rec_model.infer_batch(batch)[:n_images]
 
 
     def __prepare_image_for_ssd(self, image):
         ssd_image_shape = self.ssd_input_shape[1:-1]
         # IT DOES NOT HANDLE THE CASE WHEN FEEDED IMAGE IS LESS THAN THE SSD INPUT SIZE
         pieces, offsets = ImageCutter.get_ssd_input(image, ssd_image_shape, WordGrabber.SSD_X_STEP, WordGrabber.SSD_Y_STEP)
-        # Normalize each image
-        for i in range(len(pieces)):
-            pieces[i] = pieces[i] / 255
-        return pieces, offsets
+        # Normalize all the pieces at once
+        pieces = np.asarray(pieces, dtype=np.float32) / 255
+        return pieces, np.asarray(offsets, dtype=np.float32).reshape(-1, 2)
 
     
     def __get_ssd_predictions(self, images_to_feed, offsets):
-        # Will accumulate predictions for each image
+        # Will accumulate predictions for the whole page
         all_confidences = []
         all_bboxes = []
-        for image in images_to_feed:
-            confidences, bboxes = self.ssd_model.predict([image])
-            # Correct all the coordinates
-            for i in range(len(bboxes)):
-                bboxes[i][0] += offsets[i][0]
-                bboxes[i][1] += offsets[i][1]
-                bboxes[i][2] += offsets[i][0]
-                bboxes[i][3] += offsets[i][1]
-            
-            all_confidences.append(confidences)
-            all_bboxes.append(bboxes)
-        return [np.vstack(all_confidences), np.vstack(all_bboxes)]
+        batch_sz = self.ssd_model.batch_sz
+        for i in range(0, len(images_to_feed), batch_sz):
+            batch = images_to_feed[i: i + batch_sz]
+            n_pieces = len(batch)
+            if n_pieces < batch_sz:
+                # The SSD takes only full batches
+                padding = np.zeros((batch_sz - n_pieces,) + batch.shape[1:], dtype=np.float32)
+                batch = np.concatenate([batch, padding])
+            confidences, bboxes = self.ssd_model.predict(batch)
+            confidences, bboxes = confidences[:n_pieces], bboxes[:n_pieces]
+            # Correct all the coordinates: [n_pieces, 1, 4] offsets of (x1, y1, x2, y2)
+            bboxes = bboxes + np.tile(offsets[i: i + n_pieces], 2)[:, None, :]
+            # Only the confident predictions take part in NMS, so drop the rest right away
+            conf_values = np.max(confidences, axis=2)
+            conf_classes = np.argmax(confidences, axis=2)
+            keep = (conf_values > self.nms_conf_trashhold) & (conf_classes != 0)
+            all_confidences.append(confidences[keep])
+            all_bboxes.append(bboxes[keep])
+        if len(all_confidences) == 0:
+            return [np.zeros((0, self.ssd_model.dcs[0].class_number)), np.zeros((0, 4))]
+        return [np.concatenate(all_confidences), np.concatenate(all_bboxes)]
             
 
     def __filter_ssd_predictions(self, predictions):
-        bboxes, _, _ = nms(predictions[1][0], predictions[0][0], self.nms_conf_trashhold, self.nms_iou_trashhold)
+        bboxes, _, _ = nms(predictions[1], predictions[0], self.nms_conf_trashhold, self.nms_iou_trashhold)
         return bboxes
     
 
     def __prepare_text_rec_input(self, images_for_text_rec):
-        # Resize all the images to `text_rec_input_size`
+        # Fit all the images into `text_rec_input_size` keeping their own width.
+        # The recognizer pads the batches to the width it needs itself
         prepared_images = []
-        text_rec_input_size = self.text_rec_input_shape[1:-1]
+        max_width, height = self.text_rec_input_shape[1:-1]
         for image in images_for_text_rec:
-            new_size = (text_rec_input_size[1], text_rec_input_size[0])
             image = image[:, :, 0]
             im_shape = image.shape
-            if im_shape[0] > text_rec_input_size[1] or im_shape[1] > text_rec_input_size[0]:
+            if im_shape[0] > height or im_shape[1] > max_width:
+                # Shrink keeping the aspect ratio
+                scale = min(height / im_shape[0], max_width / im_shape[1])
+                new_size = (max(int(im_shape[1] * scale), 1), max(int(im_shape[0] * scale), 1))
                 image = cv2.resize(image, new_size)
             image = image.transpose([1, 0])
             im_shape = image.shape
-            holder = np.ones((text_rec_input_size[0], text_rec_input_size[1], 1)) # 1 is for gray scaled image
-            holder[0:im_shape[0], :im_shape[1], 0] = image
+            holder = np.ones((im_shape[0], height, 1)) # 1 is for gray scaled image
+            holder[:, :im_shape[1], 0] = image
             prepared_images.append(holder)
         return prepared_images
             
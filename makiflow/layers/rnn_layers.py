@@ -198,8 +198,7 @@ class RNNBlock(MakiLayer):
                 between static and dynamic is that in case of static TensorFlow builds static graph and the RNN
                 will always go through each time step in the sequence. In case of dynamic TensorFlow will be
                 creating RNN `in a while loop`, that is to say that using dynamic RNN you can pass sequences of 
-                variable length, but you have to provide list of sequences' lengthes. Currently API for using
-                dynamic RNNs is not provided.
+                variable length, but you have to provide list of sequences' lengthes (see `forward`).
             bidirectional : boolean
                 Influences whether the layer will be bidirectional.
         """
@@ -222,14 +221,19 @@ class RNNBlock(MakiLayer):
 
 
     
-    def forward(self, X, is_training=False):
+    def forward(self, X, is_training=False, sequence_length=None):
+        # `sequence_length` - true lengths of the sequences in the batch, used only by the dynamic RNNs.
+        # The steps past the length are skipped and their outputs are zeros.
         if self.cell_type == CellType.Bidir_Dynamic:
-            return bidirectional_dynamic_rnn(cell_fw=self.stacked_cells, cell_bw=self.stacked_cells, inputs=X, dtype=tf.float32)
+            return bidirectional_dynamic_rnn(
+                cell_fw=self.stacked_cells, cell_bw=self.stacked_cells, inputs=X,
+                sequence_length=sequence_length, dtype=tf.float32
+            )
         elif self.cell_type == CellType.Bidir_Static:
             X = tf.unstack(X, num=self.seq_length, axis=1)
             return static_bidirectional_rnn(cell_fw=self.stacked_cells, cell_bw=self.stacked_cells, inputs=X, dtype=tf.float32)
         elif self.cell_type == CellType.Dynamic:
-            return dynamic_rnn(self.stacked_cells, X, dtype=tf.float32)
+            return dynamic_rnn(self.stacked_cells, X, sequence_length=sequence_length, dtype=tf.float32)
         elif self.cell_type == CellType.Static:
             X = tf.unstack(X, num=self.seq_length, axis=1)
             return static_rnn(self.stacked_cells, X, dtype=tf.float32)
@@ -1,4 +1,5 @@
 from __future__ import absolute_import
 from makiflow.metrics.metrics import categorical_dice_coeff, v_dice_coeff, confusion_mat
+from makiflow.metrics.metrics import categorical_dice_sums, dices_from_sums, plot_confusion_mat
 from makiflow.metrics.utils import one_hot
 del absolute_import
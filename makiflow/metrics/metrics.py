@@ -32,6 +32,32 @@ def categorical_dice_coeff(P, L, use_argmax=False, ind_norm=True):
         on some images.
     """
     batch_sz = len(P)
+    class_dices, class_counts = categorical_dice_sums(P, L, use_argmax=use_argmax)
+    return dices_from_sums(class_dices, class_counts, batch_sz, ind_norm=ind_norm)
+
+
+def categorical_dice_sums(P, L, use_argmax=False):
+    """
+    Calculates sums of per-sample dices for each class. The sums can be accumulated
+    over batches, so that V-Dice can be computed without holding all the predictions in memory.
+    Parameters
+    ----------
+    P : np.ndarray
+        Predictions of a segmentator. Array of shape [batch_sz, W, H, num_classes].
+    L : np.ndarray
+        Labels for the segmentator. Array of shape [batch_sz, W, H]
+    use_argmax : bool
+        Converts the segmentator's predictions to one-hot format.
+        Example: [0.4, 0.1, 0.5] -> [0., 0., 1.]
+
+    Returns
+    -------
+    np.ndarray
+        Sums of the dices for each class.
+    np.ndarray
+        Number of samples that contributed to the corresponding sums.
+    """
+    batch_sz = len(P)
     L = np.asarray(L)
     P = np.asarray(P)
     num_classes = P.shape[-1]
@@ -43,7 +69,7 @@ def categorical_dice_coeff(P, L, use_argmax=False, ind_norm=True):
     L = L.reshape(batch_sz, -1)
 
     class_dices = np.zeros(num_classes)
-    class_counts = np.zeros(num_classes) + EPSILON  # Smoothing to avoid division by zero
+    class_counts = np.zeros(num_classes)
     for i in range(batch_sz):
         sample_actual = L[i]
         sample_pred = P[i]
@@ -54,9 +80,27 @@ def categorical_dice_coeff(P, L, use_argmax=False, ind_norm=True):
                 continue
             class_dices[j] += binary_dice(sub_confs, sub_actual)
             class_counts[j] += 1
+    return class_dices, class_counts
+
 
-    v_dice, dices = class_dices.mean() / batch_sz, class_dices / batch_sz
+def dices_from_sums(class_dices, class_counts, num_samples, ind_norm=True):
+    """
+    Computes V-Dice from the sums returned by `categorical_dice_sums`.
+    Parameters
+    ----------
+    class_dices : np.ndarray
+        Sums of the dices for each class.
+    class_counts : np.ndarray
+        Number of samples that contributed to the corresponding sums.
+    num_samples : int
+        Total number of samples.
+    ind_norm : bool
+        Normalize each dice separately. Useful in case some classes don't appear
+        on some images.
+    """
+    v_dice, dices = class_dices.mean() / num_samples, class_dices / num_samples
     if ind_norm:
+        class_counts = class_counts + EPSILON  # Smoothing to avoid division by zero
         v_dice, dices = (class_dices / class_counts).mean(), class_dices / class_counts
     return v_dice, dices
 
@@ -160,7 +204,33 @@ def confusion_mat(
     mat = np.asarray(confusion_matrix(l, p), dtype=np.float32)
     del p
     del l
-    
+    return plot_confusion_mat(mat, normalize=normalize, save_path=save_path, dpi=dpi, annot=annot)
+
+
+def plot_confusion_mat(mat, normalize=[0, 1], save_path=None, dpi=150, annot=True):
+    """
+    Normalizes and saves an already computed confusion matrix. Useful when the matrix
+    is accumulated over batches.
+    Parameters
+    ----------
+    mat : np.ndarray
+        Unnormalized confusion matrix.
+    normalize : list
+        List of axes. The matrix will be normalized along these axes.
+        Leave the list empty if you unnormalized matrix.
+    save_path : str
+        Saving path for the confusion matrix picture.
+    dpi : int
+        Affects the size of the saved confusion matrix picture.
+    annot : bool
+        Set to true if you want to see actual numbers (classes) on the matrix picture.
+
+    Returns
+    -------
+    list
+        Confusion matrices.
+    """
+    mat = np.asarray(mat, dtype=np.float32)
     assert(len(normalize) < 3)
     
     if len(normalize) == 2:
@@ -44,16 +44,36 @@ class DecoderType:
 	WordBeamSearch = 2
 
 class TextRecognizer:
-    def __init__(self, cnn_layers, rnn_layers, input_shape, chars, max_seq_length, decoder_type=DecoderType.BeamSearch, name='MakiRecognizer'):
+    # Value the images are padded with up to the width of the batch
+    PAD_VALUE = 1.0
+
+    def __init__(self, cnn_layers, rnn_layers, input_shape, chars, max_seq_length, decoder_type=DecoderType.BeamSearch, name='MakiRecognizer',
+                 width_buckets=None):
+        """
+        Images are fed with the shape [width, height, channels]. Their width may vary up to `input_shape[1]`:
+        each batch is padded only to the smallest of the `width_buckets` fitting its widest image, and the RNN
+        and CTC see only the true length of each sequence. The width of an image maps to the sequence length
+        as `input_shape[1]` maps to `max_seq_length`.
+        Parameters
+        ----------
+        width_buckets : list
+            Widths the batches are padded to. By default 4 buckets evenly spread up to `input_shape[1]`.
+        """
         self.name = str(name)
         self.batch_sz = input_shape[0]
         self.cnn_layers = cnn_layers
         self.rnn_layers = rnn_layers
         self.input_shape = input_shape
-        self.input_image = tf.placeholder(tf.float32, shape=input_shape, name='image')
+        # The width is dynamic, so the batches of short words are not padded to the max width
+        self.input_image = tf.placeholder(tf.float32, shape=[input_shape[0], None, *input_shape[2:]], name='image')
         self.chars = chars
         self.max_seq_length = max_seq_length
         self.decoder_type = decoder_type
+        if width_buckets is None:
+            step = max(input_shape[1] // max_seq_length, 1)
+            width_buckets = np.minimum(np.ceil(input_shape[1] * np.arange(1, 5) / 4 / step) * step, input_shape[1])
+        self.width_buckets = sorted(set(int(width) for width in width_buckets))
+        assert self.width_buckets[-1] == input_shape[1], 'The largest width bucket must be equal to input_shape[1].'
         self.setup_cnn()
         self.setup_rnn()
         self.setupCTC()
@@ -117,7 +137,8 @@ class TextRecognizer:
             'input_shape': self.input_shape,
             'chars': self.chars,
             'max_seq_length': self.max_seq_length,
-            'decoder_type': self.decoder_type
+            'decoder_type': self.decoder_type,
+            'width_buckets': self.width_buckets
         }
         cnn_layers_dict = {
             'cnn_layers': []
@@ -150,10 +171,13 @@ class TextRecognizer:
 
     def setup_rnn(self):
         rnn_input = tf.squeeze(self.cnn_out, axis=[2])
-        self.rnn_block = RNNBlock(rnn_layers=self.rnn_layers, seq_length=self.cnn_out.shape[1], dynamic=True, bidirectional=True)
+        # True lengths of the sequences, the padding steps are skipped by the RNN and CTC
+        self.seqLen = tf.placeholder(tf.int32, [self.batch_sz])
+        self.clippedSeqLen = tf.minimum(self.seqLen, tf.shape(rnn_input)[1])
+        self.rnn_block = RNNBlock(rnn_layers=self.rnn_layers, seq_length=self.max_seq_length, dynamic=True, bidirectional=True)
         # bidirectional RNN
         # BxTxF -> BxTx2H
-        ((fw, bw), _) = self.rnn_block.forward(rnn_input)
+        ((fw, bw), _) = self.rnn_block.forward(rnn_input, sequence_length=self.clippedSeqLen)
         # BxTxH + BxTxH -> BxTx2H -> BxTx1X2H
         concat = tf.expand_dims(tf.concat([fw, bw], 2), 2)
         # Get the number of cells of the last RNN layer
@@ -171,16 +195,62 @@ class TextRecognizer:
         self.gtTexts = tf.SparseTensor(tf.placeholder(tf.int64, shape=[None, 2]) , tf.placeholder(tf.int32, [None]), tf.placeholder(tf.int64, [2]))
 
         # calc loss for batch
-        self.seqLen = tf.placeholder(tf.int32, [self.batch_sz])
-        self.loss = tf.reduce_mean(tf.nn.ctc_loss(labels=self.gtTexts, inputs=self.ctcIn3dTBC, sequence_length=self.seqLen, ctc_merge_repeated=True))
+        self.loss = tf.reduce_mean(tf.nn.ctc_loss(labels=self.gtTexts, inputs=self.ctcIn3dTBC, sequence_length=self.clippedSeqLen, ctc_merge_repeated=True))
 
         if self.decoder_type == DecoderType.BestPath:
-            self.decoder = tf.nn.ctc_greedy_decoder(inputs=self.ctcIn3dTBC, sequence_length=self.seqLen)
+            self.decoder = tf.nn.ctc_greedy_decoder(inputs=self.ctcIn3dTBC, sequence_length=self.clippedSeqLen)
         elif self.decoder_type == DecoderType.BeamSearch:
-            self.decoder = tf.nn.ctc_beam_search_decoder(inputs=self.ctcIn3dTBC, sequence_length=self.seqLen, beam_width=100, merge_repeated=False)
+            self.decoder = tf.nn.ctc_beam_search_decoder(inputs=self.ctcIn3dTBC, sequence_length=self.clippedSeqLen, beam_width=100, merge_repeated=False)
         else:
             print('This decoder type is not implemented yet. BeamSearch decorder will be used instead.')
-            self.decoder_ = tf.nn.ctc_beam_search_decoder(inputs=self.ctcIn3dTBC, sequence_length=self.seqLen, beam_width=100, merge_repeated=False)
+            self.decoder_ = tf.nn.ctc_beam_search_decoder(inputs=self.ctcIn3dTBC, sequence_length=self.clippedSeqLen, beam_width=100, merge_repeated=False)
+
+
+    def get_seq_lengths(self, widths):
+        """
+        Returns lengths of the output sequences for the images of the given widths.
+        """
+        seq_lengths = np.ceil(np.asarray(widths) * self.max_seq_length / self.input_shape[1])
+        return np.clip(seq_lengths, 1, self.max_seq_length).astype(np.int32)
+
+
+    def pad_batch(self, imgs):
+        """
+        Pads the images to the smallest width bucket fitting the widest of them.
+        Parameters
+        ----------
+        imgs : list
+            Images of the shape [width, height, channels]. The width may vary.
+        Returns
+        -------
+        batch : numpy ndarray
+            Array of shape [len(imgs), bucket width, height, channels].
+        seq_lengths : numpy ndarray
+            True lengths of the sequences.
+        """
+        widths = [len(img) for img in imgs]
+        assert max(widths) <= self.width_buckets[-1], \
+            'Images must not be wider than {}.'.format(self.width_buckets[-1])
+        bucket_width = self.width_buckets[np.searchsorted(self.width_buckets, max(widths))]
+        batch = np.full(
+            [len(imgs), bucket_width, *self.input_shape[2:]], TextRecognizer.PAD_VALUE, dtype=np.float32
+        )
+        for i, img in enumerate(imgs):
+            batch[i, :len(img)] = img
+        return batch, self.get_seq_lengths(widths)
+
+
+    def _bucketed_batches(self, X, Y):
+        # Shuffles the data and groups the images of close widths into the same batches
+        widths = np.array([len(x) for x in X])
+        order = shuffle(np.arange(len(X)))
+        buckets = np.searchsorted(self.width_buckets, widths[order])
+        order = order[np.argsort(buckets, kind='stable')]
+        batches = [order[j*self.batch_sz:(j+1)*self.batch_sz] for j in range(len(X) // self.batch_sz)]
+        # Batches of different widths go in random order
+        np.random.shuffle(batches)
+        for batch in batches:
+            yield [X[ind] for ind in batch], [Y[ind] for ind in batch]
 
 
     def fit(self, Xtrain, Ytrain, Xtest, Ytest, optimizer, epochs=10, test_period=1):
@@ -188,7 +258,7 @@ class TextRecognizer:
         Parameters
         ----------
         Xtrain : list
-            List of training images.
+            List of training images of the shape [width, height, channels]. The width may vary.
         Ytrain : list
             List of ground truth training texts. All texts will be then converted to sparse tensors.
         Xtest : list
@@ -210,20 +280,17 @@ class TextRecognizer:
             losses = []
             n_batches = len(Xtrain) // self.batch_sz
             for i in range(epochs):
-                Xtrain, Ytrain = shuffle(Xtrain, Ytrain)
-                
-                iterator = range(n_batches)
+                iterator = tqdm(self._bucketed_batches(Xtrain, Ytrain), total=n_batches)
                 batch_loss = 0
-                for j in tqdm(iterator):
-                    Xbatch = Xtrain[j*self.batch_sz:(j+1)*self.batch_sz]
-                    Ybatch = Ytrain[j*self.batch_sz:(j+1)*self.batch_sz]
+                for Xbatch, Ybatch in iterator:
+                    Xbatch, seq_lengths = self.pad_batch(Xbatch)
                     Ybatch = toSparse(Ybatch, self.chars)
                     _, l = self.session.run(
                         [train_op, self.loss],
                         feed_dict={
                                 self.gtTexts: Ybatch,
                                 self.input_image: Xbatch,
-                                self.seqLen: [self.max_seq_length]*self.batch_sz
+                                self.seqLen: seq_lengths
                             }
                     )
                     batch_loss += l
@@ -281,7 +348,7 @@ class TextRecognizer:
         Parameters
         ----------
         imgs : list
-            Images to recognize.
+            Images to recognize of the shape [width, height, channels]. The width may vary.
             WARNING! NUMBER OF THE IMAGES IN THE LIST MUST BE EQUAL THE BATCH SIZE!
         Returns
         -------
@@ -290,7 +357,8 @@ class TextRecognizer:
         """
         
         # decode, optionally save RNN output
-        feedDict = {self.input_image : imgs, self.seqLen : [self.max_seq_length] * self.batch_sz}
+        batch, seq_lengths = self.pad_batch(imgs)
+        feedDict = {self.input_image : batch, self.seqLen : seq_lengths}
         evalRes = self.session.run([self.decoder, self.ctcIn3dTBC], feedDict)
         decoded = evalRes[0]
         texts = self.decoder_output_to_text(decoded)
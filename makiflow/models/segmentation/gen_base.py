@@ -55,6 +55,16 @@ class GenLayer(MakiTensor):
     def get_name(self):
         return self._name
 
+    # noinspection PyMethodMayBeStatic
+    def has_validation(self):
+        return False
+
+    def switch_to_train(self, session):
+        pass
+
+    def switch_to_val(self, session):
+        raise RuntimeError(f'{self.__class__.__name__} does not provide a validation stream.')
+
     # noinspection PyMethodMayBeStatic
     def get_params(self):
         return []
@@ -4,9 +4,13 @@ from makiflow.models.segmentation.gen_base import PathGenerator, MapMethod, GenL
 
 
 class InputGenLayer(GenLayer):
+    TRAIN = 'train'
+    VAL = 'val'
+
     def __init__(
             self, prefetch_size, batch_size, path_generator: PathGenerator, name,
-            map_operation: MapMethod, num_parallel_calls=None
+            map_operation: MapMethod, num_parallel_calls=None,
+            val_path_generator: PathGenerator = None, val_map_operation: MapMethod = None
     ):
         """
 
@@ -26,16 +30,35 @@ class InputGenLayer(GenLayer):
         num_parallel_calls : int
             Represents the number of elements to process asynchronously in parallel.
             If not specified, elements will be processed sequentially.
+        val_path_generator : PathGenerator
+            Path generator for the validation data. Unlike the training one, its `next_element`
+            must be finite: the validation pass lasts until the generator is exhausted.
+            If specified, the layer uses a reinitializable iterator, so the same graph
+            can be switched between the training and the validation streams.
+            Note that the last incomplete validation batch is dropped.
+        val_map_operation : MapMethod
+            Method for mapping validation paths to the actual data. If not specified,
+            `map_operation` is used.
         """
         self.prefetch_size = prefetch_size
         self.batch_size = batch_size
-        self.iterator = self.build_iterator(path_generator, map_operation, num_parallel_calls)
+        self._train_init_op = None
+        self._val_init_op = None
+        self._current_stream = None
+        if val_path_generator is None:
+            self.iterator = self.build_iterator(path_generator, map_operation, num_parallel_calls)
+        else:
+            if val_map_operation is None:
+                val_map_operation = map_operation
+            self.iterator = self.build_reinitializable_iterator(
+                path_generator, map_operation, val_path_generator, val_map_operation, num_parallel_calls
+            )
         super().__init__(
             name=name,
             input_image=self.iterator[SegmentIterator.image]
         )
 
-    def build_iterator(self, gen: PathGenerator, map_operation: MapMethod, num_parallel_calls):
+    def build_dataset(self, gen: PathGenerator, map_operation: MapMethod, num_parallel_calls):
         dataset = tf.data.Dataset.from_generator(
             gen.next_element,
             output_types={
@@ -49,8 +72,66 @@ class InputGenLayer(GenLayer):
         # would be None. Example: [None, 1024, 1024, 3]
         dataset = dataset.batch(self.batch_size, drop_remainder=True)
         dataset = dataset.prefetch(self.prefetch_size)
+        return dataset
+
+    def build_iterator(self, gen: PathGenerator, map_operation: MapMethod, num_parallel_calls):
+        dataset = self.build_dataset(gen, map_operation, num_parallel_calls)
         iterator = dataset.make_one_shot_iterator()
         return iterator.get_next()
 
+    def build_reinitializable_iterator(
+            self, gen: PathGenerator, map_operation: MapMethod,
+            val_gen: PathGenerator, val_map_operation: MapMethod, num_parallel_calls
+    ):
+        train_dataset = self.build_dataset(gen, map_operation, num_parallel_calls)
+        val_dataset = self.build_dataset(val_gen, val_map_operation, num_parallel_calls)
+        # Both datasets must yield elements of the same structure, otherwise
+        # the iterator cannot be switched between them.
+        iterator = tf.data.Iterator.from_structure(
+            train_dataset.output_types,
+            train_dataset.output_shapes
+        )
+        self._train_init_op = iterator.make_initializer(train_dataset, name=self._get_init_op_name('train'))
+        self._val_init_op = iterator.make_initializer(val_dataset, name=self._get_init_op_name('val'))
+        return iterator.get_next()
+
+    def _get_init_op_name(self, stream):
+        return f'{stream}_iterator_init'
+
     def get_iterator(self):
         return self.iterator
+
+    def has_validation(self):
+        return self._val_init_op is not None
+
+    def switch_to_train(self, session):
+        """
+        Points the iterator to the training stream. The stream is (re)started only if
+        the iterator was pointing to the validation stream (or wasn't initialized at all),
+        so calling this method before every training epoch is cheap.
+
+        Parameters
+        ----------
+        session : tf.Session
+            Session of the model that uses this layer.
+        """
+        if self._train_init_op is None:
+            return
+        if self._current_stream != InputGenLayer.TRAIN:
+            session.run(self._train_init_op)
+            self._current_stream = InputGenLayer.TRAIN
+
+    def switch_to_val(self, session):
+        """
+        Restarts the validation stream and points the iterator to it. Fetching from the iterator
+        raises tf.errors.OutOfRangeError once the validation generator is exhausted.
+
+        Parameters
+        ----------
+        session : tf.Session
+            Session of the model that uses this layer.
+        """
+        if self._val_init_op is None:
+            raise RuntimeError('The validation generator was not specified.')
+        session.run(self._val_init_op)
+        self._current_stream = InputGenLayer.VAL
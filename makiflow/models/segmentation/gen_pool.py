@@ -0,0 +1,197 @@
+from __future__ import absolute_import
+import multiprocessing as mp
+import pickle
+import random
+import struct
+import traceback
+import os
+import numpy as np
+from makiflow.models.segmentation.gen_base import PathGenerator
+
+
+class SlotStatus:
+    DATA = 0
+    END = 1
+    ERROR = 2
+
+
+# Slot layout: [status: uint8][payload length: uint32][payload]
+_HEADER = struct.Struct('<BI')
+
+
+def _seed_worker(seed, worker_id):
+    # Forked workers inherit the RNG state of the parent process, so without
+    # reseeding every worker would produce the very same stream.
+    if seed is None:
+        worker_seed = int.from_bytes(os.urandom(4), 'little')
+    else:
+        worker_seed = (seed + worker_id) % 2**32
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+
+
+def _check_payload_size(payload, slot_size):
+    if _HEADER.size + len(payload) > slot_size:
+        raise ValueError(
+            f'Element takes {len(payload)} bytes, but the slot size is {slot_size - _HEADER.size} bytes. '
+            f'Increase `slot_size`.'
+        )
+
+
+def _write_slot(view, offset, status, payload):
+    view[offset: offset + _HEADER.size] = _HEADER.pack(status, len(payload))
+    view[offset + _HEADER.size: offset + _HEADER.size + len(payload)] = payload
+
+
+def _worker_loop(path_generator, worker_id, seed, ring, slot_size, num_slots, empty, full, notify_queue):
+    _seed_worker(seed, worker_id)
+    view = memoryview(ring).cast('B')
+    slot = 0
+
+    def put(status, payload):
+        nonlocal slot
+        # Checked before taking the slot, otherwise a failed write would never give it back
+        _check_payload_size(payload, slot_size)
+        empty.acquire()
+        _write_slot(view, slot * slot_size, status, payload)
+        full.release()
+        if notify_queue is not None:
+            notify_queue.put(worker_id)
+        slot = (slot + 1) % num_slots
+
+    try:
+        for element in path_generator.next_element():
+            put(SlotStatus.DATA, pickle.dumps(element, protocol=pickle.HIGHEST_PROTOCOL))
+        put(SlotStatus.END, b'')
+    except Exception:
+        message = traceback.format_exc().encode()
+        # Truncate the traceback so that it always fits the slot
+        put(SlotStatus.ERROR, message[-(slot_size - _HEADER.size):])
+
+
+class PoolPathGenerator(PathGenerator):
+    def __init__(self, path_generator: PathGenerator, num_workers=4, num_slots=256, slot_size=4096,
+                 ordered=False, seed=None):
+        """
+        Runs `path_generator` in several worker processes so that the generator logic
+        doesn't run under the GIL of the process that feeds the TensorFlow dataset.
+        Each worker has its own ring buffer in shared memory; elements are written into it
+        and read by the main process with no per-element inter-process pickling of the buffer.
+        Use it as a usual PathGenerator, i.e. pass it into the InputGenLayer.
+
+        Every worker runs its own copy of `path_generator`, so the generator is meant to be
+        an infinite random one. A finite generator would yield its elements `num_workers` times.
+
+        Parameters
+        ----------
+        path_generator : PathGenerator
+            The generator to run in the workers. It must be picklable if the `spawn`
+            start method is used.
+        num_workers : int
+            Number of worker processes.
+        num_slots : int
+            Number of elements each worker can prepare in advance.
+        slot_size : int
+            Maximum size of a pickled element in bytes.
+        ordered : bool
+            If True, elements are taken from the workers in round-robin order, so the resulting
+            stream is reproducible given `seed`. Otherwise elements are yielded as soon as any
+            worker prepares them.
+        seed : int
+            Worker `i` seeds `random` and `np.random` with `seed + i`. If None, every worker
+            is seeded with a random value.
+        """
+        self.path_generator = path_generator
+        self.num_workers = num_workers
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.ordered = ordered
+        self.seed = seed
+        self._workers = None
+
+    def _start(self):
+        if self._workers is not None:
+            return
+        self._rings = []
+        self._views = []
+        self._empty = []
+        self._full = []
+        self._read_slots = []
+        # In the ordered mode the workers are polled in turn, so notifications aren't needed
+        self._notify_queue = None if self.ordered else mp.Queue()
+        self._workers = []
+        for worker_id in range(self.num_workers):
+            ring = mp.RawArray('B', self.num_slots * self.slot_size)
+            empty = mp.Semaphore(self.num_slots)
+            full = mp.Semaphore(0)
+            worker = mp.Process(
+                target=_worker_loop,
+                args=(
+                    self.path_generator, worker_id, self.seed, ring, self.slot_size, self.num_slots,
+                    empty, full, self._notify_queue
+                ),
+                daemon=True
+            )
+            worker.start()
+            self._rings.append(ring)
+            self._views.append(memoryview(ring).cast('B'))
+            self._empty.append(empty)
+            self._full.append(full)
+            self._read_slots.append(0)
+            self._workers.append(worker)
+
+    def _read_slot(self, worker_id):
+        self._full[worker_id].acquire()
+        view = self._views[worker_id]
+        offset = self._read_slots[worker_id] * self.slot_size
+        status, length = _HEADER.unpack(view[offset: offset + _HEADER.size])
+        payload = bytes(view[offset + _HEADER.size: offset + _HEADER.size + length])
+        self._read_slots[worker_id] = (self._read_slots[worker_id] + 1) % self.num_slots
+        self._empty[worker_id].release()
+        return status, payload
+
+    def _ready_workers(self):
+        active = list(range(self.num_workers))
+        if self.ordered:
+            while len(active) > 0:
+                for worker_id in list(active):
+                    is_active = yield worker_id
+                    if not is_active:
+                        active.remove(worker_id)
+        else:
+            while len(active) > 0:
+                worker_id = self._notify_queue.get()
+                is_active = yield worker_id
+                if not is_active:
+                    active.remove(worker_id)
+
+    def next_element(self):
+        self._start()
+        ready_workers = self._ready_workers()
+        worker_id = next(ready_workers)
+        while True:
+            status, payload = self._read_slot(worker_id)
+            if status == SlotStatus.ERROR:
+                self.close()
+                raise RuntimeError(f'Worker {worker_id} failed:\n{payload.decode()}')
+            if status == SlotStatus.DATA:
+                yield pickle.loads(payload)
+            try:
+                worker_id = ready_workers.send(status == SlotStatus.DATA)
+            except StopIteration:
+                break
+        self.close()
+
+    def close(self):
+        """
+        Terminates the worker processes. The pool is restarted on the next `next_element` call.
+        """
+        if self._workers is None:
+            return
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
+        if self._notify_queue is not None:
+            self._notify_queue.close()
+        self._workers = None
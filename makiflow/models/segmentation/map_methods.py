@@ -214,3 +214,40 @@ class RGB2BGRPostMethod(PostMapMethod):
         # Swap channels
         element[SegmentIterator.image] = tf.reverse(img, axis=[-1], name='RGB2BGR')
         return element
+
+
+class RandomFlipPostMethod(PostMapMethod):
+    def __init__(self, horizontal=True, vertical=True):
+        """
+        Randomly flips the image and the mask together. Cheap on-the-fly replacement for
+        the materialised flipped copies.
+        Parameters
+        ----------
+        horizontal : bool
+            Flip along the width axis with probability 0.5.
+        vertical : bool
+            Flip along the height axis with probability 0.5.
+        """
+        super().__init__()
+        self.axes = []
+        if vertical:
+            self.axes.append(0)
+        if horizontal:
+            self.axes.append(1)
+
+    def load_data(self, data_paths):
+        element = self._parent_method.load_data(data_paths)
+        img = element[SegmentIterator.image]
+        mask = element[SegmentIterator.mask]
+
+        for axis in self.axes:
+            do_flip = tf.less(tf.random.uniform(shape=[]), 0.5)
+            img, mask = tf.cond(
+                do_flip,
+                lambda: (tf.reverse(img, axis=[axis]), tf.reverse(mask, axis=[axis])),
+                lambda: (img, mask)
+            )
+
+        element[SegmentIterator.image] = img
+        element[SegmentIterator.mask] = mask
+        return element
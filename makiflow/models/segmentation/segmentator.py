@@ -16,6 +16,7 @@ class Segmentator(MakiModel):
         graph_tensors.update(output.get_self_pair())
         super().__init__(graph_tensors, outputs=[output], inputs=[input_s])
         self._training_vars_are_ready = False
+        self._use_generator = False
 
     def predict(self, x):
         return self._session.run(
@@ -23,6 +24,30 @@ class Segmentator(MakiModel):
             feed_dict={self._input_data_tensors[0]: x}
         )
 
+    def genpredict_val(self):
+        """
+        Iterates over the validation stream of the generator. The whole validation set is
+        never held in memory: predictions are yielded batch by batch.
+        The generator is switched back to the training stream by the next `genfit_*` call.
+
+        Yields
+        ------
+        (np.ndarray, np.ndarray)
+            Predictions of shape [batch_sz, W, H, num_classes] and the corresponding masks.
+        """
+        assert (self._session is not None)
+        assert (self._use_generator and self._generator.has_validation())
+
+        self._generator.switch_to_val(self._session)
+        while True:
+            try:
+                predictions, labels = self._session.run(
+                    [self._output_data_tensors[0], self._labels]
+                )
+            except tf.errors.OutOfRangeError:
+                break
+            yield predictions, labels
+
     def _get_model_info(self):
         return {
             'name': self.name,
@@ -221,6 +246,7 @@ class Segmentator(MakiModel):
         assert (self._session is not None)
 
         train_op = self._minimize_focal_loss(optimizer, global_step)
+        self._generator.switch_to_train(self._session)
 
         train_focal_losses = []
         iterator = None
@@ -419,6 +445,7 @@ class Segmentator(MakiModel):
         assert (type(gamma) == int)
 
         train_op = self._minimize_maki_loss(optimizer, global_step, gamma)
+        self._generator.switch_to_train(self._session)
 
         train_maki_losses = []
         iterator = None
@@ -840,6 +867,7 @@ class Segmentator(MakiModel):
         assert (self._session is not None)
 
         train_op = self._minimize_quadratic_ce_loss(optimizer, global_step)
+        self._generator.switch_to_train(self._session)
 
         iterator = None
         train_total_losses = []
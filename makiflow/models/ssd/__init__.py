@@ -1,4 +1,5 @@
 from __future__ import absolute_import
 from makiflow.models.ssd.detector_classifier import DetectorClassifier
 from makiflow.models.ssd.ssd_model import SSDModel
+from makiflow.models.ssd.sparse_targets import SparseTargets
 from makiflow.models.ssd import ssd_utils
\ No newline at end of file
@@ -0,0 +1,147 @@
+from __future__ import absolute_import
+import numpy as np
+import os
+
+
+class SparseTargets:
+    INDPTR = 'indptr.npy'
+    INDICES = 'indices.npy'
+    LABELS = 'labels.npy'
+    GT_LOCS = 'gt_locs.npy'
+    NUM_PREDICTIONS = 'num_predictions.npy'
+
+    def __init__(self, indptr, indices, labels, gt_locs, num_predictions):
+        """
+        Compact storage of the SSD training targets in CSR format. Only positive default boxes are stored:
+        targets of the image i are `indices`, `labels` and `gt_locs` in the range [indptr[i], indptr[i + 1]).
+        Negative default boxes have zero labels, loc masks and locs, so the dense targets can be restored
+        exactly. Use `densify` to get a batch of dense targets.
+
+        Parameters
+        ----------
+        indptr : ndarray
+            Array of shape [num_images + 1].
+        indices : ndarray
+            Array of shape [num_positives]. Indices of the positive default boxes.
+        labels : ndarray
+            Array of shape [num_positives]. Labels of the positive default boxes.
+        gt_locs : ndarray
+            Array of shape [num_positives, 4]. Differences between ground truth boxes and default boxes.
+        num_predictions : int
+            Number of default boxes.
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.labels = labels
+        self.gt_locs = gt_locs
+        self.num_predictions = int(num_predictions)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @staticmethod
+    def from_dense(loc_masks, labels, gt_locs):
+        """
+        Creates SparseTargets from the dense arrays returned by DataPreparator.generate_masks_labels_locs.
+        """
+        builder = SparseTargetsBuilder(loc_masks.shape[1])
+        for loc_mask, label, gt_loc in zip(loc_masks, labels, gt_locs):
+            builder.append(loc_mask, label, gt_loc)
+        return builder.build()
+
+    def densify(self, image_indices):
+        """
+        Restores the dense targets for the given images.
+
+        Parameters
+        ----------
+        image_indices : array like
+            Indices of the images.
+
+        Returns
+        -------
+        loc_masks : numpy array
+            Array of shape [len(image_indices), num_predictions] of type float32.
+        labels : numpy array
+            Array of shape [len(image_indices), num_predictions] of type int32.
+        gt_locs : numpy array
+            Array of shape [len(image_indices), num_predictions, 4] of type float32.
+        """
+        image_indices = np.asarray(image_indices)
+        loc_masks = np.zeros((len(image_indices), self.num_predictions), dtype=np.float32)
+        labels = np.zeros((len(image_indices), self.num_predictions), dtype=np.int32)
+        gt_locs = np.zeros((len(image_indices), self.num_predictions, 4), dtype=np.float32)
+        for i, image_ind in enumerate(image_indices):
+            start, end = self.indptr[image_ind], self.indptr[image_ind + 1]
+            indices = self.indices[start: end]
+            loc_masks[i, indices] = 1.0
+            labels[i, indices] = self.labels[start: end]
+            gt_locs[i, indices] = self.gt_locs[start: end]
+        return loc_masks, labels, gt_locs
+
+    def save(self, path):
+        """
+        Saves the targets to the `path` folder as .npy files, so that they can be memory-mapped by `load`.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, SparseTargets.INDPTR), self.indptr)
+        np.save(os.path.join(path, SparseTargets.INDICES), self.indices)
+        np.save(os.path.join(path, SparseTargets.LABELS), self.labels)
+        np.save(os.path.join(path, SparseTargets.GT_LOCS), self.gt_locs)
+        np.save(os.path.join(path, SparseTargets.NUM_PREDICTIONS), np.array(self.num_predictions))
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        """
+        Loads the targets saved by `save`.
+
+        Parameters
+        ----------
+        path : str
+            Path to the folder with the targets.
+        mmap_mode : str
+            Memory-map mode passed to np.load. Set it to None to load the arrays into memory.
+        """
+        return SparseTargets(
+            np.load(os.path.join(path, SparseTargets.INDPTR), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, SparseTargets.INDICES), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, SparseTargets.LABELS), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, SparseTargets.GT_LOCS), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, SparseTargets.NUM_PREDICTIONS))
+        )
+
+
+class SparseTargetsBuilder:
+    def __init__(self, num_predictions):
+        """
+        Collects the targets image by image without creating the dense arrays for the whole data set.
+        """
+        self.num_predictions = num_predictions
+        self._indptr = [0]
+        self._indices = []
+        self._labels = []
+        self._gt_locs = []
+
+    def append(self, loc_mask, labels, gt_locs):
+        """
+        Adds dense targets of one image (see `ssd_utils.prepare_data`).
+        """
+        indices = np.nonzero(loc_mask)[0].astype(np.int32)
+        self._indices.append(indices)
+        self._labels.append(np.asarray(labels)[indices].astype(np.int32))
+        self._gt_locs.append(np.asarray(gt_locs)[indices].astype(np.float32))
+        self._indptr.append(self._indptr[-1] + len(indices))
+
+    def build(self):
+        if len(self._indices) == 0:
+            return SparseTargets(
+                np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                np.zeros((0, 4), dtype=np.float32), self.num_predictions
+            )
+        return SparseTargets(
+            np.array(self._indptr, dtype=np.int64),
+            np.concatenate(self._indices),
+            np.concatenate(self._labels),
+            np.concatenate(self._gt_locs),
+            self.num_predictions
+        )
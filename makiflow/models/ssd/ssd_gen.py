@@ -0,0 +1,359 @@
+from __future__ import absolute_import
+import numpy as np
+import tensorflow as tf
+from makiflow.models.segmentation.gen_base import PathGenerator, MapMethod, PostMapMethod, GenLayer
+
+
+class SSDIterator:
+    image = 'image'
+    bboxes = 'bboxes'
+    classes = 'classes'
+    num_bboxes = 'num_bboxes'
+
+
+class SSDPathGenerator(PathGenerator):
+    def __init__(self, annotations, class_name_to_num, path_to_data, seed=None):
+        """
+        Infinitely yields paths to the images together with their raw ground truth boxes
+        in random order.
+
+        Parameters
+        ----------
+        annotations : list
+            Contains labels, bboxes and etc for each image. (Uses the format of the dictionary XmlParser or JsonParser
+            produces)
+        class_name_to_num : dictionary
+            Maps class names with their indices. WARNING! INDICES MUST START COUNTING FROM 1!
+        path_to_data : str
+            Path to folder where images lie.
+        seed : int (optional)
+            Seed for the random generator.
+        """
+        self._random_state = np.random.RandomState(seed)
+        self._paths = []
+        self._bboxes = []
+        self._classes = []
+        for annotation in annotations:
+            self._paths.append(path_to_data + annotation['filename'])
+            self._bboxes.append(
+                np.array([gt_object['box'] for gt_object in annotation['objects']], dtype=np.float32).reshape(-1, 4)
+            )
+            self._classes.append(
+                np.array([class_name_to_num[gt_object['name']] for gt_object in annotation['objects']], dtype=np.int32)
+            )
+
+    def next_element(self):
+        while True:
+            for i in self._random_state.permutation(len(self._paths)):
+                yield {
+                    SSDIterator.image: self._paths[i],
+                    SSDIterator.bboxes: self._bboxes[i],
+                    SSDIterator.classes: self._classes[i]
+                }
+
+
+class LoadResizeSSDMethod(MapMethod):
+    def __init__(self, image_size, normalize=255.):
+        """
+        Loads the image (RGB), resizes it and scales the boxes accordingly.
+
+        Parameters
+        ----------
+        image_size : tuple
+            Contains new width and height. Example: (300, 300).
+        normalize : float
+            The image is divided by this value. Set it to None to skip normalization.
+        """
+        self.image_size = image_size
+        self.normalize = normalize
+
+    def load_data(self, data_paths):
+        img_file = tf.read_file(data_paths[SSDIterator.image])
+        img = tf.image.decode_image(img_file, channels=3)
+        img.set_shape([None, None, 3])
+
+        shape = tf.cast(tf.shape(img), tf.float32)
+        width, height = self.image_size
+        scale = tf.stack([width / shape[1], height / shape[0], width / shape[1], height / shape[0]])
+        bboxes = data_paths[SSDIterator.bboxes] * scale
+
+        img = tf.image.resize(images=img, size=[height, width], method=tf.image.ResizeMethod.BILINEAR)
+        if self.normalize is not None:
+            img = tf.divide(img, self.normalize)
+        return {
+            SSDIterator.image: img,
+            SSDIterator.bboxes: bboxes,
+            SSDIterator.classes: data_paths[SSDIterator.classes]
+        }
+
+
+class SSDRandomPhotometricPostMethod(PostMapMethod):
+    def __init__(self, max_brightness_delta=0.125, contrast_range=(0.5, 1.5),
+                 saturation_range=(0.5, 1.5), max_hue_delta=0.05):
+        """
+        Randomly changes brightness, contrast, saturation and hue of the (normalized) image.
+        Boxes aren't affected.
+        """
+        super().__init__()
+        self.max_brightness_delta = max_brightness_delta
+        self.contrast_range = contrast_range
+        self.saturation_range = saturation_range
+        self.max_hue_delta = max_hue_delta
+
+    def load_data(self, data_paths):
+        element = self._parent_method.load_data(data_paths)
+        img = element[SSDIterator.image]
+        img = tf.image.random_brightness(img, self.max_brightness_delta)
+        img = tf.image.random_contrast(img, *self.contrast_range)
+        img = tf.image.random_saturation(img, *self.saturation_range)
+        img = tf.image.random_hue(img, self.max_hue_delta)
+        element[SSDIterator.image] = tf.clip_by_value(img, 0.0, 1.0)
+        return element
+
+
+class SSDRandomFlipPostMethod(PostMapMethod):
+    def __init__(self):
+        """
+        Flips the image and the boxes horizontally with probability 0.5.
+        """
+        super().__init__()
+
+    def load_data(self, data_paths):
+        element = self._parent_method.load_data(data_paths)
+        img = element[SSDIterator.image]
+        bboxes = element[SSDIterator.bboxes]
+        width = tf.cast(tf.shape(img)[1], tf.float32)
+
+        def flip():
+            x1, y1, x2, y2 = tf.unstack(bboxes, axis=1)
+            return tf.reverse(img, axis=[1]), tf.stack([width - x2, y1, width - x1, y2], axis=1)
+
+        do_flip = tf.less(tf.random.uniform(shape=[]), 0.5)
+        img, bboxes = tf.cond(do_flip, flip, lambda: (img, bboxes))
+        element[SSDIterator.image] = img
+        element[SSDIterator.bboxes] = bboxes
+        return element
+
+
+class SSDRandomCropPostMethod(PostMapMethod):
+    def __init__(self, min_scale=0.5, probability=0.5):
+        """
+        With probability `probability` crops a random part of the image (the side is scaled by
+        a factor from [`min_scale`, 1]) and resizes it back. Boxes are clipped by the crop, the boxes whose
+        centers are outside of the crop are dropped.
+        """
+        super().__init__()
+        self.min_scale = min_scale
+        self.probability = probability
+
+    def load_data(self, data_paths):
+        element = self._parent_method.load_data(data_paths)
+        img = element[SSDIterator.image]
+        bboxes = element[SSDIterator.bboxes]
+        classes = element[SSDIterator.classes]
+        shape = tf.shape(img)
+        height = tf.cast(shape[0], tf.float32)
+        width = tf.cast(shape[1], tf.float32)
+
+        def crop():
+            scale = tf.random.uniform(shape=[], minval=self.min_scale, maxval=1.0)
+            crop_h = scale * height
+            crop_w = scale * width
+            top = tf.random.uniform(shape=[], maxval=height - crop_h)
+            left = tf.random.uniform(shape=[], maxval=width - crop_w)
+
+            centers_x = (bboxes[:, 0] + bboxes[:, 2]) / 2
+            centers_y = (bboxes[:, 1] + bboxes[:, 3]) / 2
+            keep = tf.logical_and(
+                tf.logical_and(centers_x > left, centers_x < left + crop_w),
+                tf.logical_and(centers_y > top, centers_y < top + crop_h)
+            )
+            offset = tf.stack([left, top, left, top])
+            limits = tf.stack([crop_w, crop_h, crop_w, crop_h])
+            new_bboxes = tf.clip_by_value(tf.boolean_mask(bboxes, keep) - offset, 0.0, limits)
+            # Back to the original image size
+            new_bboxes = new_bboxes / scale
+            new_classes = tf.boolean_mask(classes, keep)
+
+            box = tf.stack([top / height, left / width, (top + crop_h) / height, (left + crop_w) / width])
+            new_img = tf.image.crop_and_resize(
+                tf.expand_dims(img, axis=0), tf.expand_dims(box, axis=0), [0], crop_size=shape[:2]
+            )[0]
+            return new_img, new_bboxes, new_classes
+
+        do_crop = tf.less(tf.random.uniform(shape=[]), self.probability)
+        img, bboxes, classes = tf.cond(do_crop, crop, lambda: (img, bboxes, classes))
+        element[SSDIterator.image] = img
+        element[SSDIterator.bboxes] = bboxes
+        element[SSDIterator.classes] = classes
+        return element
+
+
+class SSDInputGenLayer(GenLayer):
+    def __init__(
+            self, prefetch_size, batch_size, path_generator: PathGenerator, name,
+            map_operation: MapMethod, image_size, max_bboxes=50, num_parallel_calls=None
+    ):
+        """
+        Input layer of the SSD that reads the images and the raw ground truth boxes.
+        Training targets are computed in the graph by `encode_targets`, so nothing of size
+        [num_images, total_predictions] is ever stored.
+
+        Parameters
+        ----------
+        prefetch_size : int
+            Number of batches to prepare before feeding into the network.
+        batch_size : int
+            The batch size.
+        path_generator : PathGenerator
+            The path generator, e.g. SSDPathGenerator.
+        name : str
+            Name of the input layer of the model.
+        map_operation : MapMethod
+            Method for mapping paths to the actual data, e.g. LoadResizeSSDMethod
+            (optionally followed by the augmentation post methods).
+        image_size : tuple
+            Width and height of the images produced by `map_operation`.
+        max_bboxes : int
+            Maximum number of boxes per image, the rest are dropped. Memory used for matching is
+            proportional to batch_size * max_bboxes * total_predictions.
+        num_parallel_calls : int
+            Represents the number of elements to process asynchronously in parallel.
+            If not specified, elements will be processed sequentially.
+        """
+        self.prefetch_size = prefetch_size
+        self.batch_size = batch_size
+        self.image_size = image_size
+        self.max_bboxes = max_bboxes
+        self.iterator = self.build_iterator(path_generator, map_operation, num_parallel_calls)
+        super().__init__(
+            name=name,
+            input_image=self.iterator[SSDIterator.image]
+        )
+
+    def _truncate(self, element):
+        num_bboxes = tf.minimum(tf.shape(element[SSDIterator.classes])[0], self.max_bboxes)
+        element[SSDIterator.bboxes] = element[SSDIterator.bboxes][:num_bboxes]
+        element[SSDIterator.classes] = element[SSDIterator.classes][:num_bboxes]
+        element[SSDIterator.num_bboxes] = num_bboxes
+        return element
+
+    def build_iterator(self, gen: PathGenerator, map_operation: MapMethod, num_parallel_calls):
+        dataset = tf.data.Dataset.from_generator(
+            gen.next_element,
+            output_types={
+                SSDIterator.image: tf.string,
+                SSDIterator.bboxes: tf.float32,
+                SSDIterator.classes: tf.int32
+            },
+            output_shapes={
+                SSDIterator.image: [],
+                SSDIterator.bboxes: [None, 4],
+                SSDIterator.classes: [None]
+            }
+        )
+        dataset = dataset.map(map_func=map_operation.load_data, num_parallel_calls=num_parallel_calls)
+        dataset = dataset.map(map_func=self._truncate, num_parallel_calls=num_parallel_calls)
+        width, height = self.image_size
+        dataset = dataset.padded_batch(
+            self.batch_size,
+            padded_shapes={
+                SSDIterator.image: [height, width, 3],
+                SSDIterator.bboxes: [self.max_bboxes, 4],
+                SSDIterator.classes: [self.max_bboxes],
+                SSDIterator.num_bboxes: []
+            },
+            drop_remainder=True
+        )
+        dataset = dataset.prefetch(self.prefetch_size)
+        iterator = dataset.make_one_shot_iterator()
+        return iterator.get_next()
+
+    def get_iterator(self):
+        return self.iterator
+
+    def encode_targets(self, default_boxes, iou_trashhold=0.5):
+        """
+        Matches the ground truth boxes of the batch with the default boxes in the graph.
+        Same matching as in `ssd_utils.prepare_data`.
+
+        Returns
+        -------
+        loc_masks : tf.Tensor
+            Tensor of shape [batch_size, total_predictions] of type float32.
+        labels : tf.Tensor
+            Tensor of shape [batch_size, total_predictions] of type int32.
+        gt_locs : tf.Tensor
+            Tensor of shape [batch_size, total_predictions, 4] of type float32.
+        """
+        return encode_targets(
+            self.iterator[SSDIterator.bboxes], self.iterator[SSDIterator.classes],
+            self.iterator[SSDIterator.num_bboxes], default_boxes, iou_trashhold
+        )
+
+
+def encode_targets(bboxes, classes, num_bboxes, default_boxes, iou_trashhold=0.5):
+    """
+    TensorFlow version of `ssd_utils.prepare_data` working on a batch of padded boxes.
+
+    Parameters
+    ----------
+    bboxes : tf.Tensor
+        Tensor of shape [batch_size, max_bboxes, 4]. Ground truth boxes in (x1, y1, x2, y2) format.
+    classes : tf.Tensor
+        Tensor of shape [batch_size, max_bboxes]. Classes of the ground truth boxes.
+    num_bboxes : tf.Tensor
+        Tensor of shape [batch_size]. Number of valid boxes for each image, the rest are padding.
+    default_boxes : ndarray
+        Default boxes array has taken from the SSD.
+    iou_trashhold : float
+        Jaccard index dbox must exceed to be marked as positive.
+
+    Returns
+    -------
+    loc_masks, labels, gt_locs
+    """
+    dboxes = tf.constant(default_boxes, dtype=tf.float32)
+    max_bboxes = bboxes.get_shape().as_list()[1]
+    num_dboxes = len(default_boxes)
+
+    # [batch_size, max_bboxes, num_dboxes]
+    gboxes = tf.expand_dims(bboxes, axis=2)
+    x_overlap = tf.maximum(
+        tf.minimum(gboxes[..., 2], dboxes[:, 2]) - tf.maximum(gboxes[..., 0], dboxes[:, 0]), 0.0
+    )
+    y_overlap = tf.maximum(
+        tf.minimum(gboxes[..., 3], dboxes[:, 3]) - tf.maximum(gboxes[..., 1], dboxes[:, 1]), 0.0
+    )
+    intersection = x_overlap * y_overlap
+    area_g = (gboxes[..., 2] - gboxes[..., 0]) * (gboxes[..., 3] - gboxes[..., 1])
+    area_d = (dboxes[:, 2] - dboxes[:, 0]) * (dboxes[:, 3] - dboxes[:, 1])
+    ious = intersection / (area_g + area_d - intersection)
+    # Padding boxes never match
+    is_valid = tf.sequence_mask(num_bboxes, maxlen=max_bboxes)
+    ious = tf.where(
+        tf.tile(tf.expand_dims(is_valid, axis=2), [1, 1, num_dboxes]), ious, -tf.ones_like(ious)
+    )
+
+    # Each dbox is matched with the gt box it overlaps most
+    best_gt = tf.argmax(ious, axis=1, output_type=tf.int32)
+    positives = tf.reduce_max(ious, axis=1) > iou_trashhold
+    # Each gt box gets at least its best dbox, even if the overlap is below `iou_trashhold`
+    has_overlap = tf.reduce_max(ious, axis=2) > 0
+    best_dbox = tf.argmax(ious, axis=2, output_type=tf.int32)
+    # [batch_size, max_bboxes, num_dboxes]
+    forced = tf.one_hot(best_dbox, depth=num_dboxes) * tf.expand_dims(tf.cast(has_overlap, tf.float32), axis=2)
+    is_forced = tf.reduce_max(forced, axis=1) > 0
+    # If several gt boxes force the same dbox, the last one wins as in `prepare_data`
+    gt_ids = tf.reshape(tf.range(1, max_bboxes + 1, dtype=tf.float32), [1, -1, 1])
+    forced_gt = tf.argmax(forced * gt_ids, axis=1, output_type=tf.int32)
+    best_gt = tf.where(is_forced, forced_gt, best_gt)
+    positives = tf.logical_or(positives, is_forced)
+
+    batch_ids = tf.tile(tf.expand_dims(tf.range(tf.shape(bboxes)[0]), axis=1), [1, num_dboxes])
+    # [batch_size, num_dboxes, 2]
+    gather_ids = tf.stack([batch_ids, best_gt], axis=2)
+    loc_masks = tf.cast(positives, tf.float32)
+    labels = tf.gather_nd(classes, gather_ids) * tf.cast(positives, tf.int32)
+    gt_locs = (tf.gather_nd(bboxes, gather_ids) - dboxes) * tf.expand_dims(loc_masks, axis=2)
+    return loc_masks, labels, gt_locs
@@ -1,8 +1,8 @@
 from __future__ import absolute_import
 from makiflow.layers import InputLayer, ConcatLayer, ActivationLayer
 from makiflow.base import MakiModel
+from makiflow.models.ssd.sparse_targets import SparseTargets
 import json
-from copy import copy
 
 import numpy as np
 import tensorflow as tf
@@ -11,7 +11,55 @@ from sklearn.utils import shuffle
 from tqdm import tqdm
 
 
+def hard_negative_loss(confidence_loss, loc_loss_masks, neg_samples_ratio):
+    """
+    Confidence loss of the hardest negatives, i.e. Hard Negative Mining. Each sample takes
+    `neg_samples_ratio` negatives per its own positive. All the samples are ranked at once:
+    top_k is taken with the largest k in the batch and the extra negatives of each sample are masked out.
+
+    Parameters
+    ----------
+    confidence_loss : tf.Tensor
+        Cross-entropy loss of the predictions of shape [batch_sz, total_predictions].
+    loc_loss_masks : tf.Tensor
+        Mask of the positive predictions of shape [batch_sz, total_predictions].
+    neg_samples_ratio : tf.Tensor
+        Number of the negatives taken per one positive.
+
+    Returns
+    -------
+    tf.Tensor
+        Sum of the losses of the chosen negatives divided by their number.
+    """
+    negative_confidence_loss = confidence_loss * (1.0 - loc_loss_masks)
+    total_predictions = tf.shape(confidence_loss)[1]
+
+    # [batch_sz]
+    num_positives_per_sample = tf.reduce_sum(loc_loss_masks, axis=1)
+    num_negatives_per_sample = tf.minimum(
+        tf.cast(num_positives_per_sample * neg_samples_ratio, dtype=tf.int32),
+        total_predictions - tf.cast(num_positives_per_sample, dtype=tf.int32)
+    )
+    max_num_negatives = tf.reduce_max(num_negatives_per_sample)
+    # [batch_sz, max_num_negatives]
+    top_k_negative_confidence_loss, _ = tf.nn.top_k(negative_confidence_loss, k=max_num_negatives)
+    rank_mask = tf.sequence_mask(num_negatives_per_sample, maxlen=max_num_negatives, dtype=tf.float32)
+
+    num_negatives = tf.maximum(tf.cast(tf.reduce_sum(num_negatives_per_sample), dtype=tf.float32), 1.0)
+    return tf.reduce_sum(top_k_negative_confidence_loss * rank_mask) / num_negatives
+
+
 class SSDModel(MakiModel):
+    # { (input width, input height, dc configs) : (default_boxes_wh, default_boxes) }
+    _DBOXES_CACHE = {}
+    # Default parameters of the in-graph detections filtering
+    CONF_TRASHHOLD = 0.4
+    IOU_TRASHHOLD = 0.1
+    # Number of the most confident boxes taken for NMS
+    PRE_NMS_TOP_K = 400
+    # Size of the padded detections output
+    MAX_DETECTIONS = 100
+
     def __init__(self, dcs: list, input_s: InputLayer, name='MakiSSD'):
         self.dcs = dcs
         self.name = str(name)
@@ -32,49 +80,58 @@ class SSDModel(MakiModel):
         self.input_shape = input_s.get_shape()
         self.batch_sz = self.input_shape[0]
 
+        # Get number of classes. It is needed for Focal Loss and the detections filtering
+        self._num_classes = self.dcs[0].class_number
         self._generate_default_boxes()
         self._prepare_inference_graph()
-        # Get number of classes. It is needed for Focal Loss
-        self._num_classes = self.dcs[0].class_number
         # For training
         self._training_vars_are_ready = False
+        # Set by `set_generator`, used by the `genfit_*` methods
+        self._generator = None
 
 # -------------------------------------------------------SETTING UP DEFAULT BOXES---------------------------------------
 
     def _generate_default_boxes(self):
-        self.default_boxes_wh = []
         # Also collect feature map sizes for later easy access to
         # particular bboxes
         self.dc_block_feature_map_sizes = []
+        dc_configs = []
         for dc in self.dcs:
             fmap_shape = dc.get_feature_map_shape()
             # [ batch_sz, width, height, feature_maps ]
             width = fmap_shape[1]
             height = fmap_shape[2]
             self.dc_block_feature_map_sizes.append((width, height))
-            dboxes = dc.get_dboxes()
-            default_boxes = self._default_box_generator(self.input_shape[1], self.input_shape[2],
-                                                        width, height, dboxes)
-            self.default_boxes_wh.append(default_boxes)
+            dc_configs.append((width, height, tuple(tuple(dbox) for dbox in dc.get_dboxes())))
 
-        self.default_boxes_wh = np.vstack(self.default_boxes_wh)
+        # The boxes depend only on the input shape and the dc configs, so they are computed once
+        # for each configuration and reused, e.g. when restoring the same model many times.
+        key = (self.input_shape[1], self.input_shape[2], tuple(dc_configs))
+        if key not in SSDModel._DBOXES_CACHE:
+            SSDModel._DBOXES_CACHE[key] = self._compute_default_boxes(key[0], key[1], dc_configs)
+        default_boxes_wh, default_boxes = SSDModel._DBOXES_CACHE[key]
+        self.default_boxes_wh = default_boxes_wh.copy()
+        self.default_boxes = default_boxes.copy()
+
+        self.total_predictions = len(self.default_boxes)
+
+    def _compute_default_boxes(self, image_width, image_height, dc_configs):
+        default_boxes_wh = np.vstack([
+            self._default_box_generator(image_width, image_height, width, height, dboxes)
+            for width, height, dboxes in dc_configs
+        ])
 
         # Converting default boxes to another format:
         # (x, y, w, h) -----> (x1, y1, x2, y2)
-        self.default_boxes = copy(self.default_boxes_wh)
-        # For navigation in self.default_boxes
-        i = 0
-        for dbox in self.default_boxes_wh:
-            self.default_boxes[i] = [dbox[0] - dbox[2] / 2,  # upper left x
-                                     dbox[1] - dbox[3] / 2,  # upper left y
-                                     dbox[0] + dbox[2] / 2,  # bottom right x
-                                     dbox[1] + dbox[3] / 2]  # bottom right y
-            i += 1
+        half_wh = default_boxes_wh[:, 2:] / 2
+        default_boxes = np.concatenate([
+            default_boxes_wh[:, :2] - half_wh,  # upper left x, y
+            default_boxes_wh[:, :2] + half_wh   # bottom right x, y
+        ], axis=1)
 
         # Adjusting dboxes
-        self._correct_default_boxes(self.default_boxes)
-
-        self.total_predictions = len(self.default_boxes)
+        self._correct_default_boxes(default_boxes)
+        return default_boxes_wh, default_boxes
 
     def get_dbox(self, dc_block_ind, dbox_category, x_pos, y_pos):
         dcblock_dboxes_to_pass = 0
@@ -95,13 +152,11 @@ class SSDModel(MakiModel):
         max_x = self.input_shape[1]
         max_y = self.input_shape[2]
 
-        for i in range(len(dboxes)):
-            # Check top left point
-            dboxes[i][0] = max(0, dboxes[i][0])
-            dboxes[i][1] = max(0, dboxes[i][1])
-            # Check bottom right point
-            dboxes[i][2] = min(max_x, dboxes[i][2])
-            dboxes[i][3] = min(max_y, dboxes[i][3])
+        # Check top left point
+        np.maximum(dboxes[:, :2], 0, out=dboxes[:, :2])
+        # Check bottom right point
+        np.minimum(dboxes[:, 2], max_x, out=dboxes[:, 2])
+        np.minimum(dboxes[:, 3], max_y, out=dboxes[:, 3])
 
     def _default_box_generator(self, image_width, image_height, width, height, dboxes):
         """
@@ -114,25 +169,24 @@ class SSDModel(MakiModel):
         :return Returns list of 4d-vectors(np.arrays) contain characteristics of the default boxes in absolute
         coordinates: center_x, center_y, height, width.
         """
-        box_count = width * height
-        boxes_list = []
-
         width_per_cell = image_width / width
         height_per_cell = image_height / height
 
+        # (x, y) coordinates of the centers of the default boxes, row by row
+        ys, xs = np.meshgrid(
+            np.arange(height) * height_per_cell + height_per_cell / 2,
+            np.arange(width) * width_per_cell + width_per_cell / 2,
+            indexing='ij'
+        )
+        centers = np.stack([xs.reshape(-1), ys.reshape(-1)], axis=1)
+
+        boxes_list = []
         for w, h in dboxes:
-            boxes = np.zeros((box_count, 4))
-
-            for i in range(height):
-                current_height = i * height_per_cell
-                for j in range(width):
-                    current_width = j * width_per_cell
-                    # (x, y) coordinates of the center of the default box
-                    boxes[i * width + j][0] = current_width + width_per_cell / 2  # x
-                    boxes[i * width + j][1] = current_height + height_per_cell / 2  # y
-                    # (w, h) width and height of the default box
-                    boxes[i * width + j][2] = width_per_cell * w  # width
-                    boxes[i * width + j][3] = height_per_cell * h  # height
+            boxes = np.empty((width * height, 4))
+            boxes[:, :2] = centers
+            # (w, h) width and height of the default box
+            boxes[:, 2] = width_per_cell * w
+            boxes[:, 3] = height_per_cell * h
             boxes_list.append(boxes)
 
         return np.vstack(boxes_list)
@@ -172,6 +226,71 @@ class SSDModel(MakiModel):
         confidences_tensor = self.confidences.get_data_tensor()
 
         self.predictions = [confidences_tensor, predicted_boxes]
+        self._prepare_detections(confidences_tensor, predicted_boxes)
+
+    def _prepare_detections(self, confidences, boxes):
+        # Filters the predictions inside the graph, so that only the final detections are fetched.
+        # Thresholds can be changed at run time, see `predict_detections`.
+        self._conf_trashhold = tf.placeholder_with_default(
+            SSDModel.CONF_TRASHHOLD, shape=[], name='ConfTrashhold' + self.name
+        )
+        self._iou_trashhold = tf.placeholder_with_default(
+            SSDModel.IOU_TRASHHOLD, shape=[], name='IouTrashhold' + self.name
+        )
+        self._background_class = tf.placeholder_with_default(0, shape=[], name='BackgroundClass' + self.name)
+        pre_nms_top_k = min(SSDModel.PRE_NMS_TOP_K, self.total_predictions)
+        max_detections = SSDModel.MAX_DETECTIONS
+
+        def detect(confs_boxes):
+            confs, boxes = confs_boxes
+            conf_values = tf.reduce_max(confs, axis=1)
+            conf_classes = tf.argmax(confs, axis=1, output_type=tf.int32)
+            # Get rid of the background class and the boxes with low confidence
+            is_positive = tf.logical_and(
+                conf_values > self._conf_trashhold, tf.not_equal(conf_classes, self._background_class)
+            )
+            scores = tf.where(is_positive, conf_values, -tf.ones_like(conf_values))
+
+            # Only the most confident boxes take part in NMS
+            scores, top_inds = tf.nn.top_k(scores, k=pre_nms_top_k)
+            boxes = tf.gather(boxes, top_inds)
+            conf_classes = tf.gather(conf_classes, top_inds)
+
+            # Boxes of different classes don't suppress each other.
+            # The background class has no positive boxes, so it yields no detections
+            chosen = []
+            for class_id in range(self._num_classes):
+                class_inds = tf.where(tf.logical_and(tf.equal(conf_classes, class_id), scores > 0))[:, 0]
+                nms_inds = tf.image.non_max_suppression(
+                    tf.gather(boxes, class_inds), tf.gather(scores, class_inds),
+                    max_output_size=min(max_detections, pre_nms_top_k), iou_threshold=self._iou_trashhold
+                )
+                chosen.append(tf.gather(class_inds, nms_inds))
+            chosen = tf.concat(chosen, axis=0)
+            is_chosen = tf.scatter_nd(
+                tf.expand_dims(chosen, axis=1), tf.ones_like(chosen, dtype=tf.int32), shape=[pre_nms_top_k]
+            ) > 0
+
+            # Sort the chosen boxes by confidence, the rest become padding
+            scores = tf.where(is_chosen, scores, -tf.ones_like(scores))
+            if pre_nms_top_k < max_detections:
+                # Pad up to `max_detections`, so that the output shape doesn't depend on the model
+                padding = max_detections - pre_nms_top_k
+                scores = tf.pad(scores, [[0, padding]], constant_values=-1.0)
+                boxes = tf.pad(boxes, [[0, padding], [0, 0]])
+                conf_classes = tf.pad(conf_classes, [[0, padding]])
+            scores, final_inds = tf.nn.top_k(scores, k=max_detections)
+            is_valid = scores > 0
+            num_detections = tf.reduce_sum(tf.cast(is_valid, tf.int32))
+            boxes = tf.where(is_valid, tf.gather(boxes, final_inds), tf.zeros([max_detections, 4]))
+            conf_classes = tf.where(is_valid, tf.gather(conf_classes, final_inds), tf.zeros_like(final_inds))
+            scores = tf.where(is_valid, scores, tf.zeros_like(scores))
+            return boxes, conf_classes, scores, num_detections
+
+        boxes = tf.cast(boxes, tf.float32)
+        self.detections = tf.map_fn(
+            detect, (confidences, boxes), dtype=(tf.float32, tf.int32, tf.float32, tf.int32), back_prop=False
+        )
 
     def predict(self, X):
         assert (self._session is not None)
@@ -180,10 +299,70 @@ class SSDModel(MakiModel):
             feed_dict={self._input_data_tensors[0]: X}
         )
 
+    def predict_detections(self, X, conf_trashhold=None, iou_trashhold=None, background_class=None):
+        """
+        Performs the same filtering as `ssd_utils.nms` but inside the graph, so that
+        only the final detections are transferred from the device. Only SSDModel.PRE_NMS_TOP_K most
+        confident boxes take part in NMS, and at most SSDModel.MAX_DETECTIONS boxes are returned.
+
+        Parameters
+        ----------
+        X : numpy ndarray
+            Batch of images.
+        conf_trashhold : float
+            All the predictions with the confidence less than `conf_trashhold` will be treated
+            as negatives. Defaults to SSDModel.CONF_TRASHHOLD.
+        iou_trashhold : float
+            Used for performing Non-Maximum Supression. Defaults to SSDModel.IOU_TRASHHOLD.
+        background_class : int
+            Index of the background class. Defaults to 0.
+
+        Returns
+        -------
+        boxes : numpy ndarray
+            Array of shape [batch_size, MAX_DETECTIONS, 4]. Detected boxes sorted by confidence.
+        classes : numpy ndarray
+            Array of shape [batch_size, MAX_DETECTIONS]. Classes of the detected boxes.
+        scores : numpy ndarray
+            Array of shape [batch_size, MAX_DETECTIONS]. Confidences of the detected boxes.
+        num_detections : numpy ndarray
+            Array of shape [batch_size]. Number of detections for each image, the rest are padding (zeros).
+        """
+        assert (self._session is not None)
+        feed_dict = {self._input_data_tensors[0]: X}
+        if conf_trashhold is not None:
+            feed_dict[self._conf_trashhold] = conf_trashhold
+        if iou_trashhold is not None:
+            feed_dict[self._iou_trashhold] = iou_trashhold
+        if background_class is not None:
+            feed_dict[self._background_class] = background_class
+        return self._session.run(self.detections, feed_dict=feed_dict)
+
 # ----------------------------------------------------------------------------------------------------------------------
 # ----------------------------------------------------------SETTING UP TRAINING-----------------------------------------
 
-    def _prepare_training_graph(self):
+    # noinspection PyAttributeOutsideInit
+    def set_generator(self, generator, iou_trashhold=0.5):
+        """
+        Sets the generator (SSDInputGenLayer the model is built on) for the `genfit_*` methods.
+        Training targets are computed from the generator's boxes in the graph.
+
+        Parameters
+        ----------
+        generator : SSDInputGenLayer
+            The input layer of the model.
+        iou_trashhold : float
+            Jaccard Index default box have to exceed to be marked as positive.
+        """
+        self._generator = generator
+        self._generator_iou_trashhold = iou_trashhold
+        if not self._set_for_training:
+            super()._setup_for_training()
+        # Always rebuild: the graph may have been built with the placeholder targets by a `fit_*` method.
+        # The losses are rebuilt on the next `genfit_*` call
+        self._prepare_training_graph(use_generator=True)
+
+    def _prepare_training_graph(self, use_generator=False):
         training_confidences = []
         training_offsets = []
         n_outs = len(self._training_outputs)
@@ -197,10 +376,16 @@ class SSDModel(MakiModel):
         self._train_confidences_ish = tf.concat(training_confidences, axis=1)
         self._train_offsets = tf.concat(training_offsets, axis=1)
 
-        # Create placeholders for the training data
-        self._input_labels = tf.placeholder(tf.int32, shape=[self.batch_sz, self.total_predictions])
-        self._input_loc_loss_masks = tf.placeholder(tf.float32, shape=[self.batch_sz, self.total_predictions])
-        self._input_loc = tf.placeholder(tf.float32, shape=[self.batch_sz, self.total_predictions, 4])
+        if use_generator:
+            # The targets are computed from the boxes the generator produces
+            self._input_loc_loss_masks, self._input_labels, self._input_loc = self._generator.encode_targets(
+                self.default_boxes, self._generator_iou_trashhold
+            )
+        else:
+            # Create placeholders for the training data
+            self._input_labels = tf.placeholder(tf.int32, shape=[self.batch_sz, self.total_predictions])
+            self._input_loc_loss_masks = tf.placeholder(tf.float32, shape=[self.batch_sz, self.total_predictions])
+            self._input_loc = tf.placeholder(tf.float32, shape=[self.batch_sz, self.total_predictions, 4])
         self._loc_loss_weight = tf.placeholder(tf.float32, shape=[], name='loc_loss_weight')
 
         # DEFINE VARIABLES NECESSARY FOR BUILDING LOSSES
@@ -214,6 +399,29 @@ class SSDModel(MakiModel):
         self._top_k_loss_is_build = False
         self._scan_loss_is_build = False
 
+    def _shuffled_batches(self, images, loc_masks, labels, gt_locs):
+        # Shuffles the data and yields tuples (images, loc masks, labels, gt locs) batch by batch.
+        # Only the index order is shuffled, so memory-mapped or lazily normalized images
+        # (see DataPreparator.load_resize_images) are read batch by batch and never copied as a whole.
+        order = shuffle(np.arange(len(images)))
+        for j in range(len(images) // self.batch_sz):
+            batch_indices = order[j * self.batch_sz:(j + 1) * self.batch_sz]
+            if isinstance(loc_masks, SparseTargets):
+                yield (SSDModel._take(images, batch_indices),) + loc_masks.densify(batch_indices)
+            else:
+                yield (
+                    SSDModel._take(images, batch_indices),
+                    SSDModel._take(loc_masks, batch_indices),
+                    SSDModel._take(labels, batch_indices),
+                    SSDModel._take(gt_locs, batch_indices)
+                )
+
+    @staticmethod
+    def _take(data, indices):
+        if isinstance(data, list):
+            return np.asarray([data[ind] for ind in indices])
+        return data[indices]
+
 # ----------------------------------------------------------------------------------------------------------------------
 # ----------------------------------------------------------FOCAL LOSS--------------------------------------------------
 
@@ -290,9 +498,11 @@ class SSDModel(MakiModel):
         ----------
         images : numpy ndarray
             Numpy array contains images with shape [batch_sz, image_w, image_h, color_channels].
-        loc_masks : numpy array
+        loc_masks : numpy array or SparseTargets
             Binary masks represent which default box matches ground truth box. In training loop it will be multiplied
             with confidence losses array in order to get only positive confidences.
+            If it is SparseTargets, `labels` and `gt_locs` are taken from it and the dense targets are
+            restored batch by batch.
         labels : numpy array
             Sparse(not one-hot encoded!) labels for classification loss. The array has a shape of [num_images].
         gt_locs : numpy ndarray
@@ -324,19 +534,13 @@ class SSDModel(MakiModel):
         train_total_losses = []
         try:
             for i in range(epochs):
-                print('Start shuffling...')
-                images, loc_masks, labels, gt_locs = shuffle(images, loc_masks, labels, gt_locs)
-                print('Finished shuffling.')
+                batches = self._shuffled_batches(images, loc_masks, labels, gt_locs)
                 loc_loss = 0
                 focal_loss = 0
                 total_loss = 0
-                iterator = tqdm(range(n_batches))
+                iterator = tqdm(batches, total=n_batches)
                 try:
-                    for j in iterator:
-                        img_batch = images[j * self.batch_sz:(j + 1) * self.batch_sz]
-                        loc_mask_batch = loc_masks[j * self.batch_sz:(j + 1) * self.batch_sz]
-                        labels_batch = labels[j * self.batch_sz:(j + 1) * self.batch_sz]
-                        gt_locs_batch = gt_locs[j * self.batch_sz:(j + 1) * self.batch_sz]
+                    for img_batch, loc_mask_batch, labels_batch, gt_locs_batch in iterator:
 
                         # Don't know how to fix it yet.
                         try:
@@ -463,9 +667,11 @@ class SSDModel(MakiModel):
         ----------
         images : numpy ndarray
             Numpy array contains images with shape [batch_sz, image_w, image_h, color_channels].
-        loc_masks : numpy array
+        loc_masks : numpy array or SparseTargets
             Binary masks represent which default box matches ground truth box. In training loop it will be multiplied
             with confidence losses array in order to get only positive confidences.
+            If it is SparseTargets, `labels` and `gt_locs` are taken from it and the dense targets are
+            restored batch by batch.
         labels : numpy array
             Sparse(not one-hot encoded!) labels for classification loss. The array has a shape of [num_images].
         gt_locs : numpy ndarray
@@ -497,20 +703,14 @@ class SSDModel(MakiModel):
         train_total_losses = []
         try:
             for i in range(epochs):
-                print('Start shuffling...')
-                images, loc_masks, labels, gt_locs = shuffle(images, loc_masks, labels, gt_locs)
-                print('Finished shuffling.')
+                batches = self._shuffled_batches(images, loc_masks, labels, gt_locs)
                 loc_loss = 0
                 neg_loss = 0
                 pos_loss = 0
                 total_loss = 0
-                iterator = tqdm(range(n_batches))
+                iterator = tqdm(batches, total=n_batches)
                 try:
-                    for j in iterator:
-                        img_batch = images[j * self.batch_sz:(j + 1) * self.batch_sz]
-                        loc_mask_batch = loc_masks[j * self.batch_sz:(j + 1) * self.batch_sz]
-                        labels_batch = labels[j * self.batch_sz:(j + 1) * self.batch_sz]
-                        gt_locs_batch = gt_locs[j * self.batch_sz:(j + 1) * self.batch_sz]
+                    for img_batch, loc_mask_batch, labels_batch, gt_locs_batch in iterator:
 
                         # Don't know how to fix it yet.
                         try:
@@ -576,31 +776,12 @@ class SSDModel(MakiModel):
         self._scan_positive_confidence_loss = positive_confidence_loss / self._num_positives
 
     def _build_scan_negative_loss(self):
-        # Calculate confidence loss for part of negative bboxes, i.e. Hard Negative Mining
-        # Create binary mask for negative loss
-        ones = tf.ones(shape=[self.batch_sz, self.total_predictions])
-        num_negatives = tf.cast(self._num_positives * self.__scan_neg_samples_ratio, dtype=tf.float32)
-        negative_loss_mask = ones - self._input_loc_loss_masks
-        negative_confidence_loss = self._ce_loss * negative_loss_mask
-        num_negatives_per_batch = tf.cast(
-            num_negatives / self.batch_sz,
-            dtype=tf.int32
+        # Calculate confidence loss for part of negative bboxes, i.e. Hard Negative Mining.
+        # The number of negatives is defined for each sample separately by its own number of positives.
+        self._scan_negative_confidence_loss = hard_negative_loss(
+            self._ce_loss, self._input_loc_loss_masks, self.__scan_neg_samples_ratio
         )
 
-        def sort_neg_losses_for_each_batch(_, batch_loss):
-            top_k_negative_confidence_loss, _ = tf.nn.top_k(
-                batch_loss, k=num_negatives_per_batch
-            )
-            return tf.reduce_sum(top_k_negative_confidence_loss)
-
-        neg_conf_losses = tf.scan(
-            fn=sort_neg_losses_for_each_batch,
-            elems=negative_confidence_loss,
-            infer_shape=False,
-            initializer=1.0
-        )
-        self._scan_negative_confidence_loss = tf.reduce_sum(neg_conf_losses) / num_negatives
-
     def _build_scan_loss(self):
         # BUILDS CROSS-ENTROPY LOSS WITH PER SAMPLE HARD NEGATIVE MINING
         self._build_scan_positive_loss()
@@ -654,9 +835,11 @@ class SSDModel(MakiModel):
         ----------
         images : numpy ndarray
             Numpy array contains images with shape [batch_sz, image_w, image_h, color_channels].
-        loc_masks : numpy array
+        loc_masks : numpy array or SparseTargets
             Binary masks represent which default box matches ground truth box. In training loop it will be multiplied
             with confidence losses array in order to get only positive confidences.
+            If it is SparseTargets, `labels` and `gt_locs` are taken from it and the dense targets are
+            restored batch by batch.
         labels : numpy array
             Sparse(not one-hot encoded!) labels for classification loss. The array has a shape of [num_images].
         gt_locs : numpy ndarray
@@ -689,20 +872,14 @@ class SSDModel(MakiModel):
         train_total_losses = []
         try:
             for i in range(epochs):
-                print('Start shuffling...')
-                images, loc_masks, labels, gt_locs = shuffle(images, loc_masks, labels, gt_locs)
-                print('Finished shuffling.')
+                batches = self._shuffled_batches(images, loc_masks, labels, gt_locs)
                 loc_loss = 0
                 neg_loss = 0
                 pos_loss = 0
                 total_loss = 0
-                iterator = tqdm(range(n_batches))
+                iterator = tqdm(batches, total=n_batches)
                 try:
-                    for j in iterator:
-                        img_batch = images[j * self.batch_sz:(j + 1) * self.batch_sz]
-                        loc_mask_batch = loc_masks[j * self.batch_sz:(j + 1) * self.batch_sz]
-                        labels_batch = labels[j * self.batch_sz:(j + 1) * self.batch_sz]
-                        gt_locs_batch = gt_locs[j * self.batch_sz:(j + 1) * self.batch_sz]
+                    for img_batch, loc_mask_batch, labels_batch, gt_locs_batch in iterator:
 
                         # Don't know how to fix it yet.
                         try:
@@ -758,3 +935,105 @@ class SSDModel(MakiModel):
                 'total losses': train_total_losses,
                 'loc losses': train_loc_losses,
             }
+
+# ----------------------------------------------------------------------------------------------------------------------
+# ----------------------------------------------------------GENERATOR TRAINING------------------------------------------
+
+    def _genfit(self, train_op, losses, feed_dict, epochs, iterations):
+        # `losses` is a dictionary { loss name : loss tensor }
+        names = list(losses.keys())
+        history = {name: [] for name in names}
+        iterator = None
+        try:
+            for i in range(epochs):
+                ema = {name: 0 for name in names}
+                iterator = tqdm(range(iterations))
+                for _ in iterator:
+                    batch_losses = self._session.run([losses[name] for name in names] + [train_op], feed_dict=feed_dict)
+                    # Calculate losses using exponential decay
+                    for name, batch_loss in zip(names, batch_losses):
+                        ema[name] = 0.1 * batch_loss + 0.9 * ema[name]
+
+                print('Epoch:', i, *[f'{name}: {ema[name]:0.4f}' for name in names])
+                for name in names:
+                    history[name].append(ema[name])
+        except Exception as ex:
+            print(ex)
+        finally:
+            if iterator is not None:
+                iterator.close()
+            return history
+
+    def genfit_focal(
+            self, optimizer, loc_loss_weight=1.0, gamma=2.0, epochs=1, iterations=10, global_step=None
+    ):
+        """
+        Same as `fit_focal`, but the data is taken from the generator (see `set_generator`).
+
+        Parameters
+        ----------
+        iterations : int
+            Number of batches in one epoch.
+        """
+        assert self._generator is not None, 'The generator is not set. Call `set_generator` first.'
+        train_op = self._minimize_focal_loss(optimizer, global_step)
+        losses = {
+            'focal losses': self._focal_loss,
+            'total losses': self._final_focal_loss,
+            'loc losses': self._loc_loss
+        }
+        feed_dict = {
+            self._loc_loss_weight: loc_loss_weight,
+            self._gamma: gamma
+        }
+        return self._genfit(train_op, losses, feed_dict, epochs, iterations)
+
+    def genfit_top_k(
+            self, optimizer, loc_loss_weight=1.0, neg_samples_ratio=3.0, epochs=1, iterations=10, global_step=None
+    ):
+        """
+        Same as `fit_top_k`, but the data is taken from the generator (see `set_generator`).
+
+        Parameters
+        ----------
+        iterations : int
+            Number of batches in one epoch.
+        """
+        assert self._generator is not None, 'The generator is not set. Call `set_generator` first.'
+        train_op = self._minimize_top_k_loss(optimizer, global_step)
+        losses = {
+            'positive losses': self._top_k_positive_confidence_loss,
+            'negative losses': self._top_k_negative_confidence_loss,
+            'total losses': self._final_top_k_loss,
+            'loc losses': self._loc_loss
+        }
+        feed_dict = {
+            self._loc_loss_weight: loc_loss_weight,
+            self._top_k_neg_samples_ratio: neg_samples_ratio
+        }
+        return self._genfit(train_op, losses, feed_dict, epochs, iterations)
+
+    def genfit_scan(
+            self, optimizer, loc_loss_weight=1.0, neg_samples_ratio=3.0, epochs=1, iterations=10, global_step=None
+    ):
+        """
+        Same as `fit_scan`, but the data is taken from the generator (see `set_generator`).
+
+        Parameters
+        ----------
+        iterations : int
+            Number of batches in one epoch.
+        """
+        assert self._generator is not None, 'The generator is not set. Call `set_generator` first.'
+        train_op = self.__minimize_scan_loss(optimizer, global_step)
+        losses = {
+            'positive losses': self._scan_positive_confidence_loss,
+            'negative losses': self._scan_negative_confidence_loss,
+            'total losses': self._final_scan_loss,
+            'loc losses': self._loc_loss
+        }
+        feed_dict = {
+            self._loc_loss_weight: loc_loss_weight,
+            self.__scan_neg_samples_ratio: neg_samples_ratio
+        }
+        return self._genfit(train_op, losses, feed_dict, epochs, iterations)
@@ -4,6 +4,8 @@ from copy import copy
 # For drawing predicted bounding boxes
 import cv2
 import numpy as np
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 
@@ -37,33 +39,40 @@ def jaccard_index(boxes_a, boxes_b):
 
     # Calculate intersection, i.e. area of overlap between the 2 boxes (could be 0)
     # http://math.stackexchange.com/a/99576
-    def np_min(a, b):
-        ab = np.vstack([a, b])
-        return np.min(ab, axis=0)
+    return _iou(np.asarray(boxes_a), np.asarray(boxes_b))
 
-    def np_max(a, b):
-        ab = np.vstack([a, b])
-        return np.max(ab, axis=0)
-
-    zeros = np.zeros(len(boxes_a))
-
-    x_overlap_prev = np_min(boxes_a[:, 2], boxes_b[:, 2]) - np_max(boxes_a[:, 0], boxes_b[:, 0])
-    x_overlap_prev = np.vstack([zeros, x_overlap_prev])
-    x_overlap = np.max(x_overlap_prev, axis=0)
-
-    y_overlap_prev = np_min(boxes_a[:, 3], boxes_b[:, 3]) - np_max(boxes_a[:, 1], boxes_b[:, 1])
-    y_overlap_prev = np.vstack([zeros, y_overlap_prev])
-    y_overlap = np.max(y_overlap_prev, axis=0)
 
+def jaccard_matrix(boxes_a, boxes_b):
+    """
+    Calculates Jaccard Index for all pairs of bounding boxes from `boxes_a` and `boxes_b` at once.
+    :param boxes_a - array of bboxes of shape [A, 4] in (x1, y1, x2, y2) format.
+    :param boxes_b - array of bboxes of shape [B, 4] in (x1, y1, x2, y2) format.
+    :return Returns array of shape [A, B]. Element (i, j) is the Jaccard Index of boxes_a[i] and boxes_b[j].
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    return _iou(boxes_a[:, None, :], boxes_b[None, :, :])
+
+
+def _iou(boxes_a, boxes_b):
+    # Works for any shapes of `boxes_a` and `boxes_b` that broadcast, the last axis contains the coordinates.
+    # The overlaps are computed in float64 whatever the type of the boxes is
+    x_overlap = np.maximum(
+        np.minimum(boxes_a[..., 2], boxes_b[..., 2]) - np.maximum(boxes_a[..., 0], boxes_b[..., 0]), 0,
+        dtype=np.float64
+    )
+    y_overlap = np.maximum(
+        np.minimum(boxes_a[..., 3], boxes_b[..., 3]) - np.maximum(boxes_a[..., 1], boxes_b[..., 1]), 0,
+        dtype=np.float64
+    )
     intersection = x_overlap * y_overlap
 
     # Calculate union
-    area_box_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
-    area_box_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    area_box_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    area_box_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
     union = area_box_a + area_box_b - intersection
 
-    iou = intersection / union
-    return iou
+    return intersection / union
 
 
 def prepare_data(image_info, dboxes, iou_trashhold=0.5):
@@ -85,7 +94,8 @@ def prepare_data(image_info, dboxes, iou_trashhold=0.5):
     dboxes : array like
         Default boxes array has taken from the SSD.
     iou_trashhold : float
-        Jaccard index dbox must exceed to be marked as positive.
+        Jaccard index dbox must exceed to be marked as positive. Each dbox is matched with the gt box
+        it has the highest Jaccard index with. The best dbox of each gt box is always marked as positive.
          
     Returns
     -------
@@ -97,28 +107,89 @@ def prepare_data(image_info, dboxes, iou_trashhold=0.5):
                     'labels'  : ...,
                     'gt_locs' : ...  }
     """
+    dboxes = np.asarray(dboxes)
     num_predictions = len(dboxes)
-    loc_mask = np.array([0] * num_predictions)
+    loc_mask = np.zeros(num_predictions, dtype=np.int64)
     labels = np.zeros(num_predictions)
     # Difference between ground true box and default box. Need it for the later loss calculation.
     locs = np.zeros((num_predictions, 4))
-    i = 0
-    for gbox in image_info['bboxes']:
-        j = 0
-        gbox_stack = np.vstack([gbox] * num_predictions)
-        jaccard_indexes = jaccard_index(gbox_stack, dboxes)
-        # Use logic "or"
-        jaccard_boolean = jaccard_indexes > iou_trashhold
-        loc_mask = jaccard_boolean | loc_mask
-        labels[jaccard_boolean] = image_info['classes'][i]
-        locs[jaccard_boolean] = gbox - dboxes[jaccard_boolean]
-        i += 1
+    if len(image_info['bboxes']) == 0:
+        return {'loc_mask': loc_mask,
+                'labels': labels,
+                'gt_locs': locs}
+
+    gboxes = np.asarray(image_info['bboxes'], dtype=np.float64).reshape(-1, 4)
+    # [num_gt, num_predictions]
+    ious = jaccard_matrix(gboxes, dboxes)
+
+    # Each dbox is matched with the gt box it overlaps most
+    best_gt = np.argmax(ious, axis=0)
+    positives = ious[best_gt, np.arange(num_predictions)] > iou_trashhold
+    # Each gt box gets at least its best dbox, even if the overlap is below `iou_trashhold`
+    best_dbox = np.argmax(ious, axis=1)
+    has_overlap = ious[np.arange(len(gboxes)), best_dbox] > 0
+    best_gt[best_dbox[has_overlap]] = np.arange(len(gboxes))[has_overlap]
+    positives[best_dbox[has_overlap]] = True
+
+    loc_mask[positives] = 1
+    labels[positives] = np.asarray(image_info['classes'])[best_gt[positives]]
+    locs[positives] = gboxes[best_gt[positives]] - dboxes[positives]
 
     return {'loc_mask': loc_mask,
             'labels': labels,
             'gt_locs': locs}
 
 
+def _init_prepare_data_worker(dboxes, iou_trashhold):
+    global _worker_dboxes, _worker_iou_trashhold
+    _worker_dboxes = dboxes
+    _worker_iou_trashhold = iou_trashhold
+
+
+def _prepare_data_worker(image_info):
+    prepared_data = prepare_data(image_info, _worker_dboxes, _worker_iou_trashhold)
+    return prepared_data['loc_mask'], prepared_data['labels'], prepared_data['gt_locs']
+
+
+def prepare_data_batch(images_info, dboxes, iou_trashhold=0.5, num_workers=None, chunksize=16):
+    """
+    Runs `prepare_data` for a list of images in a pool of processes.
+
+    Parameters
+    ----------
+    images_info : list
+        List of dictionaries of the same format as `image_info` in `prepare_data`.
+    dboxes : array like
+        Default boxes array has taken from the SSD.
+    iou_trashhold : float
+        Jaccard index dbox must exceed to be marked as positive.
+    num_workers : int
+        Number of processes. Defaults to the number of CPUs.
+    chunksize : int
+        Number of images sent to a worker at once.
+
+    Returns
+    -------
+    loc_masks : numpy array
+        Array of shape [num_images, num_predictions].
+    labels : numpy array
+        Array of shape [num_images, num_predictions].
+    gt_locs : numpy array
+        Array of shape [num_images, num_predictions, 4].
+    """
+    dboxes = np.asarray(dboxes)
+    loc_masks = np.empty((len(images_info), len(dboxes)), dtype=np.int64)
+    labels = np.empty((len(images_info), len(dboxes)))
+    gt_locs = np.empty((len(images_info), len(dboxes), 4))
+    with mp.Pool(num_workers, initializer=_init_prepare_data_worker, initargs=(dboxes, iou_trashhold)) as pool:
+        results = pool.imap(_prepare_data_worker, images_info, chunksize=chunksize)
+        for i, (loc_mask, label, gt_loc) in enumerate(tqdm(results, total=len(images_info))):
+            loc_masks[i] = loc_mask
+            labels[i] = label
+            gt_locs[i] = gt_loc
+    return loc_masks, labels, gt_locs
+
+
 def draw_bounding_boxes(image, bboxes_with_classes):
     """
     Draw bounding boxes on the image.
@@ -154,7 +225,7 @@ def draw_bounding_boxes(image, bboxes_with_classes):
     return image_copy
 
 
-def resize_images_and_bboxes(image_array, bboxes_array, new_size):
+def resize_images_and_bboxes(image_array, bboxes_array, new_size, num_workers=None):
     """
     Resizes images accordingly with new_size.
     image_array - list of images: [image1, image2, image3, ...]
@@ -172,30 +243,45 @@ def resize_images_and_bboxes(image_array, bboxes_array, new_size):
             ]
         ]
     :param new_size - tuple of numbers represent new size: (new_width, new_height)
+    :param num_workers - number of threads resizing the images. OpenCV releases the GIL, so the threads
+    run in parallel.
     """
-    new_image_array = copy(image_array)
-    new_bboxes_array = copy(bboxes_array)
-    # For navigation in new_image_array and new_bboxes_array
-    i = 0
-    for image, bboxes in tqdm(zip(image_array, bboxes_array)):
-        image_dims = image.shape[:2]
-        width_ratio = new_size[0] / image_dims[1]
-        height_ratio = new_size[1] / image_dims[0]
-        new_image_array[i] = cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
-        # For navigation in new_bboxes_array
-        j = 0
-        for bbox in bboxes:
-            new_bboxes_array[i][j][0] = round(bbox[0] * width_ratio)
-            new_bboxes_array[i][j][2] = round(bbox[2] * width_ratio)
-            new_bboxes_array[i][j][1] = round(bbox[1] * height_ratio)
-            new_bboxes_array[i][j][3] = round(bbox[3] * height_ratio)
-            j += 1
-        i += 1
-
+    with ThreadPoolExecutor(num_workers) as executor:
+        new_image_array = list(tqdm(
+            executor.map(lambda image: cv2.resize(image, new_size, interpolation=cv2.INTER_AREA), image_array),
+            total=len(image_array)
+        ))
+    image_shapes = [image.shape[:2] for image in image_array]
+    new_bboxes_array = rescale_bboxes(bboxes_array, image_shapes, new_size)
     return new_image_array, new_bboxes_array
 
 
-def nms(pred_bboxes, pred_confs, conf_trashhold=0.4, iou_trashhold=0.1, background_class=0):
+def rescale_bboxes(bboxes_array, image_shapes, new_size):
+    """
+    Scales the bboxes of all the images at once.
+    :param bboxes_array - list of bboxes of each image (see `resize_images_and_bboxes`).
+    :param image_shapes - list of tuples (height, width) of the original images.
+    :param new_size - tuple of numbers represent new size: (new_width, new_height)
+    :return Returns list of rescaled (and rounded) bboxes of each image.
+    """
+    counts = [len(bboxes) for bboxes in bboxes_array]
+    if sum(counts) == 0:
+        return [[] for _ in bboxes_array]
+    bboxes = np.concatenate([np.asarray(bboxes, dtype=np.float64).reshape(-1, 4) for bboxes in bboxes_array])
+    image_shapes = np.asarray(image_shapes, dtype=np.float64).reshape(-1, 2)
+    # [num_images, 4] ratios for (x1, y1, x2, y2)
+    ratios = np.stack([
+        new_size[0] / image_shapes[:, 1],
+        new_size[1] / image_shapes[:, 0],
+        new_size[0] / image_shapes[:, 1],
+        new_size[1] / image_shapes[:, 0]
+    ], axis=1)
+    # Integer coordinates as the python `round` gives
+    bboxes = np.round(bboxes * np.repeat(ratios, counts, axis=0)).astype(np.int64)
+    return [part.tolist() for part in np.split(bboxes, np.cumsum(counts)[:-1])]
+
+
+def nms(pred_bboxes, pred_confs, conf_trashhold=0.4, iou_trashhold=0.1, background_class=0, soft_nms_sigma=None):
     """
     Performs Non-Maximum Suppression on predicted bboxes.
     :param pred_bboxes - list of predicted bboxes. Numpy array of shape [num_predictions, 4].
@@ -210,65 +296,88 @@ def nms(pred_bboxes, pred_confs, conf_trashhold=0.4, iou_trashhold=0.1, backgrou
         than `iou_trashhold`. LESSER - LESS BBOXES LAST, MORE - MORE BBOXES LAST.
         
     :param background_class - index of the background class.
+    :param soft_nms_sigma - if specified, Soft-NMS is performed instead: confidences of the boxes overlapping
+    the chosen one are decayed by exp(-iou^2 / soft_nms_sigma) and the boxes are deleted only when their
+    confidence falls below `conf_trashhold`. `iou_trashhold` is not used in this case.
     :return Returns final predicted bboxes and confidences
     """
-    # TODO: backgroung_class is never used
-
     pred_conf_values = np.max(pred_confs, axis=1)
+    pred_conf_classes = np.argmax(pred_confs, axis=1)
+
+    # Take predicted boxes with confidence higher than conf_trash_hold and get rid of background class boxes
+    indexes = np.nonzero((pred_conf_values > conf_trashhold) & (pred_conf_classes != background_class))[0]
+
+    chosen_indexes = []
+    chosen_values = []
+    # Boxes of different classes don't suppress each other, so the classes are processed independently
+    for class_id in np.unique(pred_conf_classes[indexes]):
+        class_indexes = indexes[pred_conf_classes[indexes] == class_id]
+        # The most confident boxes go first, ties are resolved in favor of the lower index
+        class_indexes = class_indexes[np.argsort(-pred_conf_values[class_indexes], kind='stable')]
+        bboxes = pred_bboxes[class_indexes]
+        # [num_class_boxes, num_class_boxes], computed once for all the steps
+        ious = _iou(bboxes[:, None, :], bboxes[None, :, :])
+        if soft_nms_sigma is None:
+            keep = _greedy_suppression(ious, iou_trashhold)
+            chosen_indexes.append(class_indexes[keep])
+            chosen_values.append(pred_conf_values[class_indexes[keep]])
+        else:
+            keep, values = _soft_suppression(ious, pred_conf_values[class_indexes], conf_trashhold, soft_nms_sigma)
+            chosen_indexes.append(class_indexes[keep])
+            chosen_values.append(values)
+
+    if len(chosen_indexes) == 0:
+        return [], [], []
+
+    chosen_indexes = np.concatenate(chosen_indexes)
+    chosen_values = np.concatenate(chosen_values)
+    # Order the final predictions by confidence like the boxes were picked one by one
+    order = np.lexsort((chosen_indexes, -chosen_values))
+    chosen_indexes = chosen_indexes[order]
+    final_boxes = list(pred_bboxes[chosen_indexes])
+    final_conf_classes = list(pred_conf_classes[chosen_indexes])
+    final_conf_values = list(chosen_values[order])
+    return final_boxes, final_conf_classes, final_conf_values
 
-    # Take predicted boxes with confidence higher than conf_trash_hold
-    filtered_pred_boxes = pred_bboxes[pred_conf_values > conf_trashhold]
-    filtered_pred_confs = pred_confs[pred_conf_values > conf_trashhold]
-
-    # Get classes in order get rid of background class
-    pred_conf_classes = np.argmax(filtered_pred_confs, axis=1)
-
-    # Get rid of background class boxes
-    back_ground_class_mask = pred_conf_classes != 0
-    filtered_pred_boxes = filtered_pred_boxes[back_ground_class_mask]
-    filtered_pred_confs = filtered_pred_confs[back_ground_class_mask]
-
-    # Create array with indexes of bboxes for easier navigation later
-    indexes = np.arange(filtered_pred_confs.shape[0])
-
-    pred_conf_classes = np.argmax(filtered_pred_confs, axis=1)
-    pred_conf_values = np.max(filtered_pred_confs, axis=1)
-
-    usage_mask = pred_conf_values > conf_trashhold
-    final_boxes = []
-    final_conf_classes = []
-    final_conf_values = []
-    while True:
-        # Step 1: Choose the most confident box if possible
-        bboxes = filtered_pred_boxes[usage_mask]
-        conf_values = pred_conf_values[usage_mask]
-        conf_classes = pred_conf_classes[usage_mask]
-        unused_indexes = indexes[usage_mask]
-        if bboxes.shape[0] == 0:
-            break
-
-        id_most_confident = np.argmax(conf_values)
-        most_confident_box = bboxes[id_most_confident]
-
-        # Step 2: Mark the box as used in the mask, add to final predictions
-        usage_mask[unused_indexes[id_most_confident]] = False
-        final_boxes.append(most_confident_box)
-        final_conf_classes.append(conf_classes[id_most_confident])
-        final_conf_values.append(conf_values[id_most_confident])
-
-        # Step 3: Calculate Jaccard Index for the boxes with the same class
-
-        # Pick boxes with the same class
-        boxes_same_class = bboxes[conf_classes == conf_classes[id_most_confident]]
-        # Save indexes of these boxes
-        indexes_same_class = unused_indexes[conf_classes == conf_classes[id_most_confident]]
-        # Stack current boxes for the Jaccard Index calucaltion
-        most_confident_box_stack = np.vstack([most_confident_box] * len(boxes_same_class))
-        ious = jaccard_index(most_confident_box_stack, boxes_same_class)
-
-        # Step 4: Mark boxes as used which iou is greater than 0.1
-        boxes_to_mark = indexes_same_class[ious > iou_trashhold]
-        for box in boxes_to_mark:
-            usage_mask[box] = False
 
-    return final_boxes, final_conf_classes, final_conf_values
+def _greedy_suppression(ious, iou_trashhold):
+    # `ious` is ordered by confidence. Returns positions of the kept boxes.
+    keep = []
+    remaining = np.arange(len(ious))
+    while len(remaining) > 0:
+        current = remaining[0]
+        keep.append(current)
+        # Delete all the boxes overlapping the chosen one at once
+        remaining = remaining[1:][~(ious[current, remaining[1:]] > iou_trashhold)]
+    return np.array(keep, dtype=np.int64)
+
+
+def _soft_suppression(ious, conf_values, conf_trashhold, sigma):
+    # Returns positions of the kept boxes and their decayed confidences.
+    keep = []
+    values = []
+    conf_values = conf_values.astype(np.float64)
+    remaining = np.arange(len(ious))
+    while len(remaining) > 0:
+        current = remaining[np.argmax(conf_values[remaining])]
+        keep.append(current)
+        values.append(conf_values[current])
+        remaining = remaining[remaining != current]
+        conf_values[remaining] *= np.exp(-ious[current, remaining] ** 2 / sigma)
+        remaining = remaining[conf_values[remaining] > conf_trashhold]
+    return np.array(keep, dtype=np.int64), np.array(values)
+
+
+def batched_nms(pred_bboxes, pred_confs, conf_trashhold=0.4, iou_trashhold=0.1, background_class=0,
+                soft_nms_sigma=None):
+    """
+    Performs `nms` on a batch of predictions.
+    :param pred_bboxes - numpy array of shape [batch_size, num_predictions, 4].
+    :param pred_confs - numpy array of shape [batch_size, num_predictions, num_classes].
+    Other parameters are the same as in `nms`.
+    :return Returns list of tuples (final predicted bboxes, classes, confidences), one for each image.
+    """
+    return [
+        nms(bboxes, confs, conf_trashhold, iou_trashhold, background_class, soft_nms_sigma)
+        for bboxes, confs in zip(pred_bboxes, pred_confs)
+    ]
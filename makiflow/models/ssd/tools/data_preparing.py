@@ -1,9 +1,11 @@
 from __future__ import absolute_import
-from makiflow.models.ssd.ssd_utils import resize_images_and_bboxes, prepare_data
+from makiflow.models.ssd.ssd_utils import resize_images_and_bboxes, rescale_bboxes, prepare_data, prepare_data_batch
+from makiflow.models.ssd.sparse_targets import SparseTargetsBuilder
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import cv2
 import numpy as np
-
+import os
 
 
 """
@@ -16,6 +18,9 @@ Tip - use the following order to prepare your data:
 4) preparator.resize_images_and_bboxes((width, height))
 5) preparator.normalize_images()
 6) preparator.generate_masks_labels_locs(defalut_boxes)
+
+For the data sets that don't fit into memory replace steps 3 and 4 with
+preparator.load_resize_images((width, height), path_to_cache).
 """
 class DataPreparator:
     def __init__(self, annotation_dict, class_name_to_num, path_to_data):
@@ -67,6 +72,71 @@ class DataPreparator:
         print('Images, bboxes and labels are loaded.')
         
         
+    def __collect_bboxes_labels(self):
+        self.__bboxes = []
+        self.__labels = []
+        for annotation in self.__annotation_dict:
+            self.__bboxes.append([gt_object['box'] for gt_object in annotation['objects']])
+            self.__labels.append([self.__class_name_to_num[gt_object['name']] for gt_object in annotation['objects']])
+        
+        
+    def load_resize_images(self, new_size, path_to_cache=None, num_workers=None):
+        """
+        Loads and resizes the images in a pool of threads straight into one preallocated uint8 array
+        and rescales the bounding boxes. Replaces `load_images` + `resize_images_and_bboxes`.
+        If `path_to_cache` is given, the array is a memory-mapped .npy file. If the file already exists,
+        the images are not loaded again, so the data is prepared only once and reused across runs.
+        
+        Parameters
+        ----------
+        new_size : tuple
+            Contains new width and height. Example: (300, 300).
+        path_to_cache : str
+            Path to the .npy file the resized images are stored in. Leave it None to keep the images in memory.
+        num_workers : int
+            Number of threads loading the images.
+        """
+        self.__images_normalized = False
+        self.__collect_bboxes_labels()
+        width, height = new_size
+        shapes_path = None if path_to_cache is None else path_to_cache + '.shapes.npy'
+
+        if path_to_cache is not None and os.path.exists(path_to_cache) and os.path.exists(shapes_path):
+            print('Loading cached images...')
+            self.__images = np.load(path_to_cache, mmap_mode='r')
+            image_shapes = np.load(shapes_path)
+            assert self.__images.shape == (len(self.__annotation_dict), height, width, 3), \
+                'The cache was created for another data set or size.'
+        else:
+            print('Loading and resizing images...')
+            shape = (len(self.__annotation_dict), height, width, 3)
+            if path_to_cache is None:
+                self.__images = np.empty(shape, dtype=np.uint8)
+            else:
+                self.__images = np.lib.format.open_memmap(path_to_cache, mode='w+', dtype=np.uint8, shape=shape)
+
+            def load_resize(i):
+                filename = self.__path_to_data + self.__annotation_dict[i]['filename']
+                image = cv2.imread(filename)
+                if image is None:
+                    raise FileNotFoundError(f'Could not read the image {filename}.')
+                self.__images[i] = cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
+                return image.shape[:2]
+
+            with ThreadPoolExecutor(num_workers) as executor:
+                image_shapes = np.array(list(tqdm(
+                    executor.map(load_resize, range(len(self.__annotation_dict))),
+                    total=len(self.__annotation_dict)
+                )))
+            if path_to_cache is not None:
+                self.__images.flush()
+                np.save(shapes_path, image_shapes)
+
+        self.__bboxes = rescale_bboxes(self.__bboxes, image_shapes, new_size)
+        self.__collect_image_info()
+        print('Images, bboxes and labels are loaded.')
+        
+        
     def __collect_image_info(self):
         self.__images_info = []  # Used in prepare_data function
         for labels, bboxes in zip(self.__labels, self.__bboxes):
@@ -77,7 +147,7 @@ class DataPreparator:
             self.__images_info.append(image_info)
         
         
-    def resize_images_and_bboxes(self, new_size):
+    def resize_images_and_bboxes(self, new_size, num_workers=None):
         """ 
         Resizes loaded images and bounding boxes accordingly.
         
@@ -85,8 +155,10 @@ class DataPreparator:
         ----------
         new_size : tuple
             Contains new width and height. Example: (300, 300).
+        num_workers : int
+            Number of threads resizing the images.
         """
-        images, bboxes = resize_images_and_bboxes(self.__images, self.__bboxes, new_size)
+        images, bboxes = resize_images_and_bboxes(self.__images, self.__bboxes, new_size, num_workers)
         del self.__images
         del self.__bboxes
         self.__images = images
@@ -94,7 +166,7 @@ class DataPreparator:
         self.__collect_image_info()
     
     
-    def generate_masks_labels_locs(self, default_boxes, iou_trashhold=0.5):
+    def generate_masks_labels_locs(self, default_boxes, iou_trashhold=0.5, num_workers=1):
         """
         Generates masks, labels and locs for later usage in fit function of the SSD class.
         
@@ -106,6 +178,9 @@ class DataPreparator:
         iou_trashhold : float
             Jaccard Index default box have to exceed to be marked as positive. Used for 
             generating masks and labels.
+        num_workers : int
+            Number of processes used for generating. If it is greater than 1, the images are
+            processed in a pool of processes.
         
         Returns
         -------
@@ -117,6 +192,15 @@ class DataPreparator:
             Vector contain differences in coordinates between ground truth boxes and default boxes which
             will be used for the calculation of the localization loss.
         """
+        if num_workers > 1:
+            loc_masks, labels, gt_locs = prepare_data_batch(
+                self.__images_info, default_boxes, iou_trashhold, num_workers
+            )
+            self.__last_labels = labels.astype(np.int32)
+            self.__last_loc_masks = loc_masks.astype(np.float32)
+            self.__last_gt_locs = gt_locs.astype(np.float32)
+            return self.__last_loc_masks, self.__last_labels, self.__last_gt_locs
+
         labels = []
         loc_masks = []
         gt_locs = []
@@ -132,6 +216,23 @@ class DataPreparator:
         return self.__last_loc_masks, self.__last_labels, self.__last_gt_locs
     
     
+    def generate_sparse_targets(self, default_boxes, iou_trashhold=0.5):
+        """
+        Same as `generate_masks_labels_locs`, but the targets are stored in the compact SparseTargets
+        format, the dense arrays are never created for the whole data set. SparseTargets can be passed
+        to the fit methods of the SSD instead of `loc_masks` and saved to disk.
+        
+        Returns
+        -------
+        SparseTargets
+        """
+        builder = SparseTargetsBuilder(len(default_boxes))
+        for image_info in tqdm(self.__images_info):
+            prepared_data = prepare_data(image_info, default_boxes, iou_trashhold)
+            builder.append(prepared_data['loc_mask'], prepared_data['labels'], prepared_data['gt_locs'])
+        return builder.build()
+    
+    
     def get_last_masks_labels_locs(self):
         return self.__last_labels, self.__last_loc_masks, self.__last_gt_locs
     
@@ -139,6 +240,8 @@ class DataPreparator:
     def normalize_images(self):
         """
         Normalizes loaded images by dividing each one by 255.
+        If the images were loaded by `load_resize_images`, they are normalized lazily: a NormalizedImages
+        view is returned.
         
         Returns
         -------
@@ -149,6 +252,10 @@ class DataPreparator:
             raise Exception("Images are already normalized!")
             
         self.__images_normalized = True
+        if isinstance(self.__images, np.ndarray):
+            # Images loaded by `load_resize_images` are normalized lazily when accessed
+            self.__images = NormalizedImages(self.__images)
+            return self.__images
         for i in range(len(self.__images)):
             self.__images[i] = np.array(self.__images[i], dtype=np.float32) / 255
         return self.__images
@@ -166,6 +273,22 @@ class DataPreparator:
     def get_images_info(self):
         return self.__images_info
 
+
+class NormalizedImages:
+    def __init__(self, images, divider=255.):
+        """
+        Read-only view of an array of uint8 images that normalizes the images only when they are accessed,
+        e.g. batch by batch during training. Supports len() and indexing by ints, slices and index arrays.
+        """
+        self.images = images
+        self.divider = divider
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, key):
+        return np.asarray(self.images[key], dtype=np.float32) / self.divider
+
         
         
         
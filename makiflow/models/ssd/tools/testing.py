@@ -67,46 +67,141 @@ class SSDTester:
         list
             Contains two values: mAP and list AVs for each class.
         """
-            
         # Process all images
+        evaluator = MAPEvaluator(
+            self.class_name_to_num, num_classes=ssd.dcs[0].class_number - 1,
+            conf_trashhold=conf_trashhold, nms_iou_trashhold=iou_trashhold
+        )
         batch_size = ssd.input_shape[0]
-        num_batches = len(images) // batch_size
-        confidences_list = []
-        bboxes_list = []
+        # The last incomplete batch is padded in `update`
+        num_batches = (len(images) + batch_size - 1) // batch_size
         print('Processing images...')
         for i in tqdm(range(num_batches)):
-            image_batch = images[i*batch_size: (i+1)*batch_size]
-            confidences, bboxes = ssd.predict(image_batch)
-            confidences_list += [confidences]
-            bboxes_list += [bboxes]
-            
-        confidences_list = np.vstack(confidences_list)
-        bboxes_list = np.vstack(bboxes_list)
-            
-            
-        # Filter predictions with Non-Maximum Supression
-        print('Filtering detections with NMS...')
-        filtered_boxes = []
-        for i in tqdm(range(confidences_list.shape[0])):
-            filtered_boxes.append(nms(bboxes_list[i],
-                                                confidences_list[i],
-                                                conf_trashhold=conf_trashhold,
-                                                iou_trashhold=iou_trashhold))
-                
-        # Create list of marked detected boxes
-        detected_boxes = []
-        for i in range(confidences_list.shape[0]):
-            image_name = self.annotation_dict[i]['filename']
-            # No detections
-            if len(filtered_boxes[i][0]) == 0:
-                continue
+            evaluator.update(
+                ssd,
+                images[i*batch_size: (i+1)*batch_size],
+                self.annotation_dict[i*batch_size: (i+1)*batch_size]
+            )
+        print('Number of the SSD detections:', evaluator.num_detections)
+        return evaluator.result()
+
 
-            for j in range(len(filtered_boxes[i][0])):
-                bb_coords = filtered_boxes[i][0][j]
-                bb_class = filtered_boxes[i][1][j]-1
-                bb_confidence = filtered_boxes[i][2][j]
-                detected_boxes.append([image_name, bb_class, bb_confidence, bb_coords])
-        print('Number of the SSD detections:', len(detected_boxes))
-        return ODEvaluator.mean_average_precision(detected_boxes, self.gt_boxes, num_classes=ssd.num_classes-1)
+class MAPEvaluator:
+    def __init__(self, class_name_to_num, num_classes, conf_trashhold=0.5, nms_iou_trashhold=0.5,
+                 iou_trashhold=0.5):
+        """
+        Computes mean average precision batch by batch. The predictions are filtered with NMS and matched
+        with the ground truth boxes right away, so only a confidence and a true positive flag are kept
+        for each detection. Evaluators working on different parts of the data can be merged.
+        Gives the same result as SSDTester.mean_average_precision.
 
-        
\ No newline at end of file
+        Parameters
+        ----------
+        class_name_to_num : dictionary
+            Maps class names with their indices. WARNING! INDICES MUST START COUNTING FROM 1!
+        num_classes : int
+            Number of classes without the background one.
+        conf_trashhold : float
+            All the predictions with the confidence less than `conf_trashhold` will be treated
+            as negatives.
+        nms_iou_trashhold : float
+            IOU trashhold used for performing Non-Maximum Supression.
+        iou_trashhold : float
+            Jaccard Index a detection must have with a ground truth box to be true positive.
+        """
+        self.class_name_to_num = class_name_to_num
+        self.num_classes = num_classes
+        self.conf_trashhold = conf_trashhold
+        self.nms_iou_trashhold = nms_iou_trashhold
+        self.iou_trashhold = iou_trashhold
+        self.reset()
+
+    def reset(self):
+        # Lists of chunks of confidences and true positive flags for each class
+        self._confidences = [[] for _ in range(self.num_classes)]
+        self._tps = [[] for _ in range(self.num_classes)]
+        self._num_gt_bboxes = np.zeros(self.num_classes, dtype=np.int64)
+        self.num_detections = 0
+
+    def update(self, ssd, images_batch, annotations_batch):
+        """
+        Makes predictions for the batch of images and accumulates the results.
+
+        Parameters
+        ----------
+        ssd : MakiFlow SSDModel
+            SSDModel will be used for making predictions.
+        images_batch : list
+            Batch of images. May be smaller than the batch size of the SSD.
+        annotations_batch : list
+            Annotations of the images in the format of the xml or json parsers.
+        """
+        images_batch = np.asarray(images_batch)
+        batch_size = ssd.input_shape[0]
+        if len(images_batch) < batch_size:
+            # Pad the batch by repeating the last image, the extra predictions are skipped
+            padding = np.repeat(images_batch[-1:], batch_size - len(images_batch), axis=0)
+            images_batch = np.concatenate([images_batch, padding], axis=0)
+        confidences, bboxes = ssd.predict(images_batch)
+        self.update_predictions(confidences, bboxes, annotations_batch)
+
+    def update_predictions(self, confidences, bboxes, annotations_batch):
+        """
+        Same as `update`, but takes the predictions made by SSDModel.predict.
+        """
+        for confs, boxes, annotation in zip(confidences, bboxes, annotations_batch):
+            final_boxes, final_classes, final_confs = nms(
+                boxes, confs, conf_trashhold=self.conf_trashhold, iou_trashhold=self.nms_iou_trashhold
+            )
+            self.num_detections += len(final_boxes)
+            image_name = annotation['filename']
+
+            gt_bboxes_c = [[] for _ in range(self.num_classes)]
+            for gt_bb in annotation['objects']:
+                gt_bboxes_c[self.class_name_to_num[gt_bb['name']] - 1].append([image_name, gt_bb['box']])
+            detected_boxes_c = [[] for _ in range(self.num_classes)]
+            for box, class_id, conf in zip(final_boxes, final_classes, final_confs):
+                detected_boxes_c[class_id - 1].append([image_name, conf, box])
+
+            for class_id in range(self.num_classes):
+                self._num_gt_bboxes[class_id] += len(gt_bboxes_c[class_id])
+                if len(detected_boxes_c[class_id]) == 0:
+                    continue
+                # Matching depends only on the boxes of the same image
+                confs_c, tp_c = ODEvaluator.match_detections(
+                    detected_boxes_c[class_id], gt_bboxes_c[class_id], self.iou_trashhold
+                )
+                self._confidences[class_id].append(confs_c)
+                self._tps[class_id].append(tp_c)
+
+    def merge(self, other):
+        """
+        Adds the results accumulated by `other` evaluator. Data processed by `other` is treated
+        as going after the data processed by this evaluator.
+        """
+        assert self.num_classes == other.num_classes
+        for class_id in range(self.num_classes):
+            self._confidences[class_id] += other._confidences[class_id]
+            self._tps[class_id] += other._tps[class_id]
+        self._num_gt_bboxes += other._num_gt_bboxes
+        self.num_detections += other.num_detections
+
+    def result(self, verbose=False):
+        """
+        Returns
+        -------
+        list
+            Contains two values: mAP and list AVs for each class.
+        """
+        aps = []
+        for class_id in range(self.num_classes):
+            if len(self._confidences[class_id]) == 0:
+                confs_c, tp_c = np.zeros(0), np.zeros(0)
+            else:
+                confs_c = np.concatenate(self._confidences[class_id])
+                tp_c = np.concatenate(self._tps[class_id])
+            # The records are sorted by confidence the same way all the detections would be sorted at once
+            tp_c = tp_c[np.argsort(-confs_c, kind='stable')]
+            aps.append(ODEvaluator.average_precision_from_matches(tp_c, self._num_gt_bboxes[class_id], verbose))
+        mean_average_precision = np.mean(np.array([e[0] for e in aps]))
+        return [mean_average_precision, aps]
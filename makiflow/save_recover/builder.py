@@ -98,6 +98,8 @@ class Builder:
         chars = architecture_dict['chars']
         max_seq_length = architecture_dict['max_seq_length']
         decoder_type = architecture_dict['decoder_type']
+        # Older architectures don't have the buckets, the default ones are used then
+        width_buckets = architecture_dict.get('width_buckets')
 
         cnn_layers = []
         for layer in architecture_dict['cnn_layers']:
@@ -116,7 +118,8 @@ class Builder:
             chars=chars,
             max_seq_length=max_seq_length,
             decoder_type=decoder_type,
-            name=name
+            name=name,
+            width_buckets=width_buckets
         )
 
     @staticmethod
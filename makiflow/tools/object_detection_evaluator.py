@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 import numpy as np
-from makiflow.models.ssd.ssd_utils import jaccard_index
+from makiflow.models.ssd.ssd_utils import jaccard_matrix
+import multiprocessing as mp
 # For shared memory usage
 from ctypes import Structure, c_char_p, c_int32, c_double
 
@@ -25,9 +26,21 @@ class GTBHolder(Structure):
                 ('y2', c_double)]
 
 
+def _average_precision_args(args):
+    return ODEvaluator.average_precision(*args)
+
+
+class Interpolation:
+    # VOC 2010+ style, area under the whole precision envelope
+    ALL_POINT = 'all_point'
+    # COCO style, the envelope is sampled at 101 recall points
+    POINT_101 = '101_point'
+
+
 class ODEvaluator:   
     @staticmethod
-    def mean_average_precision(detected_bboxes, gt_bboxes, num_classes, iou_trashhold=0.5, verbose=False):
+    def mean_average_precision(detected_bboxes, gt_bboxes, num_classes, iou_trashhold=0.5, verbose=False,
+                               num_workers=1, interpolation=Interpolation.ALL_POINT):
         """
         Function for calculating mAP over all object categories.
         
@@ -39,38 +52,98 @@ class ODEvaluator:
         gt_bboxes : list
             Contains following values for each bouding box: [image_name, class, [x1, y1, x2, y2]]. 
             Namely `gt_bboxes` is a list of lists contain aforementiond values.
+        num_workers : int
+            Number of processes evaluating the classes in parallel.
+        interpolation : str
+            Interpolation of the precision-recall curve. Options are in `Interpolation`:
+            - 'all_point' - VOC 2010+ style;
+            - '101_point' - COCO style (at the given `iou_trashhold`).
         
         Returns
         -------
         float
             Mean average precision value.
         """
-        # Create container for the calculated average precisions by threads.
+        # Split the boxes by classes in one pass
+        detected_boxes_c = {}
+        for bbox in detected_bboxes:
+            detected_boxes_c.setdefault(bbox[1], []).append([bbox[0], bbox[2], bbox[3]])
+        gt_bboxes_c = {}
+        for bbox in gt_bboxes:
+            gt_bboxes_c.setdefault(bbox[1], []).append([bbox[0], bbox[2]])
+
+        args = [
+            (detected_boxes_c.get(i, []), gt_bboxes_c.get(i, []), iou_trashhold, verbose, interpolation)
+            for i in range(num_classes)
+        ]
         # Look of the items of the container: [average precision, recall, precision]
-        aps = []
-        for i in range(num_classes):
-            detected_boxes_c = [[bbox[0], bbox[2], bbox[3]] for bbox in detected_bboxes if bbox[1] == i]
-            gt_bboxes_c = [[bbox[0], bbox[2]] for bbox in gt_bboxes if bbox[1] == i]
-            aps.append(ODEvaluator.average_precision(
-                                                  # Arguments
-                                                    detected_boxes_c, 
-                                                    gt_bboxes_c,
-                                                    iou_trashhold,
-                                                    verbose))
-        
+        if num_workers > 1:
+            with mp.Pool(num_workers) as pool:
+                aps = pool.map(_average_precision_args, args)
+        else:
+            aps = [_average_precision_args(arg) for arg in args]
 
         av_pres = [e[0] for e in aps]
         av_pres = np.array(av_pres)
         mean_average_precision = np.mean(av_pres)
         return [mean_average_precision, aps]
-    
-    
-    
-        
-        
-    
+
     @staticmethod
-    def average_precision(detected_bboxes, gt_bboxes, iou_trashhold=0.5, verbose=False):
+    def match_detections(detected_bboxes, gt_bboxes, iou_trashhold=0.5):
+        """
+        Marks the detections of a particular object category as true or false positives.
+        Each detection is matched with the ground truth box of the same image it overlaps most.
+        The detection is true positive if the overlap is at least `iou_trashhold` and the ground truth box
+        has not been matched with a more confident detection yet.
+
+        Parameters
+        ----------
+        detected_boxes : list
+            Contains following values for each bouding box: [image_name, confidence, [x1, y1, x2, y2]].
+        gt_bboxes : list
+            Contains following values for each bouding box: [image_name, [x1, y1, x2, y2]].
+
+        Returns
+        -------
+        confidences : numpy ndarray
+            Confidences of the detections sorted in descending order.
+        TP : numpy ndarray
+            True positive flags of the sorted detections.
+        """
+        confidences = np.array([det[1] for det in detected_bboxes], dtype=np.float64)
+        # Sort all the detections in descending order
+        order = np.argsort(-confidences, kind='stable')
+        confidences = confidences[order]
+        TP = np.zeros(len(detected_bboxes))
+
+        # { image name : list of ground truth boxes }
+        gt_by_image = {}
+        for gt_bbox in gt_bboxes:
+            gt_by_image.setdefault(gt_bbox[0], []).append(gt_bbox[1])
+        # { image name : positions of the image's detections in the sorted order }
+        dets_by_image = {}
+        for i, det_ind in enumerate(order):
+            dets_by_image.setdefault(detected_bboxes[det_ind][0], []).append(i)
+
+        # Images don't affect each other, so the detections are matched image by image
+        for image_name, det_positions in dets_by_image.items():
+            if image_name not in gt_by_image:
+                continue
+            det_boxes = [detected_bboxes[order[i]][2] for i in det_positions]
+            # [num_detections, num_gt_boxes]
+            ious = jaccard_matrix(det_boxes, gt_by_image[image_name])
+            best_gt = np.argmax(ious, axis=1)
+            best_iou = ious[np.arange(len(det_positions)), best_gt]
+            gt_seen = np.zeros(ious.shape[1], dtype=bool)
+            for i, gt_ind, iou in zip(det_positions, best_gt, best_iou):
+                if iou >= iou_trashhold and not gt_seen[gt_ind]:
+                    TP[i] = 1
+                    gt_seen[gt_ind] = True
+        return confidences, TP
+
+    @staticmethod
+    def average_precision(detected_bboxes, gt_bboxes, iou_trashhold=0.5, verbose=False,
+                          interpolation=Interpolation.ALL_POINT):
         """
         Function for calculating average precision for a particular object category.
         
@@ -82,73 +155,53 @@ class ODEvaluator:
         gt_bboxes : list
             Contains following values for each bouding box: [image_name, [x1, y1, x2, y2]]. 
             Namely `gt_bboxes` is a list of lists contain aforementiond values.
+        interpolation : str
+            Interpolation of the precision-recall curve, see `mean_average_precision`.
         
         Returns
         -------
         list
             [average precision value, recall values, precision values]
         """
-        # Sort all the detections in descending order
-        detections = sorted(detected_bboxes, key=lambda det: det[1], reverse=True)
-        # True Positives
-        TP = np.zeros(len(detections))
-        # False Negatives
-        FP = np.zeros(len(detections))
-        # Ground truth boxes have been already seen
-        gt_seen = np.zeros(len(gt_bboxes))
-        
-        for i in range(len(detections)):
-            box = np.array([detections[i][2]])
-            for j in range(len(gt_bboxes)):
-                gt_box = np.array([gt_bboxes[j][1]])
-                # Check if detected box and gt box are from the same image
-                if detections[i][0] != gt_bboxes[j][0]:
-                    continue
-                    
-                if jaccard_index(box, gt_box)[0] >= iou_trashhold:
-                    if gt_seen[j] == 0:
-                        TP[i] = 1
-                        gt_seen[j] = 1
-                    else:
-                        FP[i] = 1
-                else:
-                    FP[i] = 1
-                    
+        _, TP = ODEvaluator.match_detections(detected_bboxes, gt_bboxes, iou_trashhold)
+        return ODEvaluator.average_precision_from_matches(TP, len(gt_bboxes), verbose, interpolation)
+
+    @staticmethod
+    def average_precision_from_matches(TP, num_gt_bboxes, verbose=False, interpolation=Interpolation.ALL_POINT):
+        """
+        Computes average precision given the true positive flags of the detections sorted by confidence.
+        Either all-point (VOC 2010+ style) or 101-point (COCO style) interpolation is used,
+        see `Interpolation`.
+
+        Returns
+        -------
+        list
+            [average precision value, recall values, precision values]
+        """
+        TP = np.asarray(TP, dtype=np.float64)
         # Compute precision and recall
         acc_TP = np.cumsum(TP)
-        acc_FP = np.cumsum(FP)
-        recall = acc_TP / len(gt_bboxes)
+        acc_FP = np.cumsum(1 - TP)
+        recall = acc_TP / num_gt_bboxes
         precision = np.divide(acc_TP, (acc_TP + acc_FP))
-        
+
         # COMPUTE AVERAGE PRECISION
-        # This code is taken from https://github.com/rafaelpadilla/Object-Detection-Metrics/blob/master/lib/Evaluator.py
-        def CalculateAveragePrecision(rec, prec):
-            mrec = []
-            mrec.append(0)
-            [mrec.append(e) for e in rec]
-            mrec.append(1)
-            mpre = []
-            mpre.append(0)
-            [mpre.append(e) for e in prec]
-            mpre.append(0)
-            for i in range(len(mpre) - 1, 0, -1):
-                mpre[i - 1] = max(mpre[i - 1], mpre[i])
-            ii = []
-            for i in range(len(mrec) - 1):
-                if mrec[1:][i] != mrec[0:-1][i]:
-                    ii.append(i + 1)
-            ap = 0
-            for i in ii:
-                ap = ap + np.sum((mrec[i] - mrec[i - 1]) * mpre[i])
-            return ap
+        # All-point interpolation as in https://github.com/rafaelpadilla/Object-Detection-Metrics
+        mrec = np.concatenate([[0], recall, [1]])
+        mpre = np.concatenate([[0], precision, [0]])
+        # Precision envelope
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
+        if interpolation == Interpolation.ALL_POINT:
+            ap = np.sum((mrec[1:] - mrec[:-1]) * mpre[1:])
+        elif interpolation == Interpolation.POINT_101:
+            # Precision at each recall point is the envelope at the first recall reaching it,
+            # zero if the recall is never reached (as in pycocotools)
+            recall_points = np.linspace(0, 1, 101)
+            inds = np.searchsorted(mrec[1:-1], recall_points, side='left')
+            ap = np.mean(np.concatenate([mpre[1:-1], [0]])[inds])
+        else:
+            raise ValueError(f'Unknown interpolation: {interpolation}')
         if verbose:
-            return [CalculateAveragePrecision(recall, precision), recall, precision]
+            return [ap, recall, precision]
         else:
-            return [CalculateAveragePrecision(recall, precision)]
-    
-    
-            
-            
-                
-                
-        
\ No newline at end of file
+            return [ap]
@@ -5,6 +5,8 @@ import tensorflow as tf
 import numpy as np
 import pandas as pd
 from makiflow.metrics import categorical_dice_coeff, confusion_mat
+from makiflow.metrics import categorical_dice_sums, dices_from_sums, plot_confusion_mat
+from sklearn.metrics import confusion_matrix
 from makiflow.trainers.optimizer_builder import OptimizerBuilder
 from sklearn.utils import shuffle
 from makiflow.save_recover.builder import Builder
@@ -128,7 +130,8 @@ class SegmentatorTrainer:
         Parameters
         ----------
         generator : GenLayer
-            The generator layer.
+            The generator layer. If it has a validation stream (see `InputGenLayer`),
+            the model is tested on that stream and the test data set via `set_test_data` is ignored.
         iterations : int
             Defines how long 1 epoch is. One iteration equals processing one batch.
         """
@@ -275,6 +278,10 @@ class SegmentatorTrainer:
 # -----------------------------------EXPERIMENT UTILITIES---------------------------------------------------------------
 
     def _perform_testing(self, model, exp_params, epoch):
+        if self.generator is not None and self.generator.has_validation():
+            self._perform_gen_testing(model, exp_params, epoch)
+            return
+
         # COLLECT PREDICTIONS
         print('Testing the model...')
         print('Collecting predictions...')
@@ -317,6 +324,39 @@ class SegmentatorTrainer:
         self.epochs_list.append(epoch)
         self.v_dice_test_list.append(v_dice_val)
 
+    def _perform_gen_testing(self, model, exp_params, epoch):
+        # Validation data is streamed by the generator, so only the accumulated
+        # dice sums and the confusion matrix are kept in memory.
+        print('Testing the model on the validation stream...')
+        class_names = exp_params[ExpField.class_names]
+        num_classes = len(class_names)
+        class_dices = np.zeros(num_classes)
+        class_counts = np.zeros(num_classes)
+        mat = np.zeros((num_classes, num_classes), dtype=np.float64)
+        num_samples = 0
+        for predictions, labels in tqdm(model.genpredict_val()):
+            b_dices, b_counts = categorical_dice_sums(predictions, labels, use_argmax=True)
+            class_dices += b_dices
+            class_counts += b_counts
+            num_samples += len(predictions)
+            mat += confusion_matrix(
+                labels.reshape(-1), predictions.argmax(axis=-1).reshape(-1),
+                labels=np.arange(num_classes)
+            )
+
+        v_dice_val, dices = dices_from_sums(class_dices, class_counts, num_samples)
+
+        print('V-Dice:', v_dice_val)
+        for i, class_name in enumerate(class_names):
+            self.dices_for_each_class[class_name] += [dices[i]]
+            print(f'{class_name}:', dices[i])
+
+        conf_mat_path = self.to_save_folder + f'/mat_epoch={epoch}.png'
+        plot_confusion_mat(mat, save_path=conf_mat_path, dpi=175)
+
+        self.epochs_list.append(epoch)
+        self.v_dice_test_list.append(v_dice_val)
+
 # ----------------------------------------------------------------------------------------------------------------------
 # ------------------------------------EXPERIMENT LOOP-------------------------------------------------------------------
 
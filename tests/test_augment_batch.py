@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip('tensorflow')
+
+import numpy as np
+from makiflow.augmentation.segmentation import Data, FlipAugment, RotateAugment, ElasticAugment, AffineAugment
+
+
+def _ops():
+    return [
+        FlipAugment([FlipAugment.FLIP_HORIZONTALLY, FlipAugment.FLIP_VERTICALLY, FlipAugment.FLIP_HV]),
+        RotateAugment([
+            RotateAugment.ROTATE_90_CLOCKWISE, RotateAugment.ROTATE_90_COUNTERCLOCKWISE, RotateAugment.ROTATE_180
+        ]),
+        ElasticAugment(num_maps=2, noise_invert_scale=4, seed=0),
+        AffineAugment(num_matrices=2, seed=0),
+        FlipAugment([FlipAugment.FLIP_HV], keep_old_data=False),
+    ]
+
+
+@pytest.mark.parametrize('op', _ops(), ids=lambda op: type(op).__name__)
+@pytest.mark.parametrize('mask_channels', [None, 1, 3])
+def test_batch_path_equals_list_path(op, mask_channels):
+    rng = np.random.RandomState(0)
+    # Not square, so that wrong axes of the rotations would be caught
+    imgs = [rng.randint(0, 256, size=(24, 32, 3), dtype=np.uint8) for _ in range(4)]
+    mask_shape = (24, 32) if mask_channels is None else (24, 32, mask_channels)
+    masks = [rng.randint(0, 5, size=mask_shape, dtype=np.uint8) for _ in range(4)]
+    op = op(Data(imgs, masks))
+
+    batch_imgs, batch_masks = op._get_data_batch(imgs, masks)
+    list_imgs, list_masks = op._get_data_list(imgs, masks)
+
+    assert len(batch_imgs) == len(list_imgs) and len(batch_masks) == len(list_masks)
+    for batch_img, list_img in zip(batch_imgs, list_imgs):
+        assert np.array_equal(batch_img, list_img)
+    for batch_mask, list_mask in zip(batch_masks, list_masks):
+        # OpenCV drops the trailing single channel, the batch path keeps it
+        assert np.array_equal(np.squeeze(batch_mask), np.squeeze(list_mask))
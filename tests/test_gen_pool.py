@@ -0,0 +1,35 @@
+import threading
+
+import pytest
+
+pytest.importorskip('tensorflow')
+
+import numpy as np
+from makiflow.models.segmentation.gen_base import PathGenerator
+from makiflow.models.segmentation.gen_pool import PoolPathGenerator
+
+
+class _OversizedGenerator(PathGenerator):
+    def next_element(self):
+        while True:
+            yield {PathGenerator.image: np.zeros(4096, dtype=np.uint8)}
+
+
+@pytest.mark.parametrize('num_slots', [1, 2])
+def test_oversized_element_raises(num_slots):
+    pool = PoolPathGenerator(_OversizedGenerator(), num_workers=1, num_slots=num_slots, slot_size=1024)
+    errors = []
+
+    def read():
+        try:
+            next(pool.next_element())
+        except RuntimeError as ex:
+            errors.append(ex)
+
+    # The read happens in a separate thread, so that a deadlocked pool fails the test instead of hanging it
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    reader.join(timeout=60)
+    pool.close()
+    assert not reader.is_alive(), 'The pool deadlocked on an oversized element.'
+    assert len(errors) == 1 and 'Increase `slot_size`' in str(errors[0])
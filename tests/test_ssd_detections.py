@@ -0,0 +1,58 @@
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import numpy as np
+from makiflow.models.ssd.ssd_model import SSDModel
+from makiflow.models.ssd.ssd_utils import nms
+
+
+def _random_predictions(rng, batch_sz, total_predictions, num_classes):
+    logits = rng.randn(batch_sz, total_predictions, num_classes) * 2
+    confs = np.exp(logits) / np.exp(logits).sum(axis=-1, keepdims=True)
+    xy = rng.rand(batch_sz, total_predictions, 2) * 100
+    wh = rng.rand(batch_sz, total_predictions, 2) * 40 + 5
+    boxes = np.concatenate([xy, xy + wh], axis=-1)
+    return confs.astype(np.float32), boxes.astype(np.float32)
+
+
+def _build_detections_model(batch_sz, total_predictions, num_classes):
+    # Only the detection head is built: the input holds the confidences and the boxes
+    model = SSDModel.__new__(SSDModel)
+    model.name = 'TestSSD'
+    model._num_classes = num_classes
+    model.total_predictions = total_predictions
+    inputs = tf.placeholder(tf.float32, shape=[batch_sz, total_predictions, num_classes + 4])
+    model._input_data_tensors = [inputs]
+    model._prepare_detections(inputs[..., :num_classes], inputs[..., num_classes:])
+    return model
+
+
+@pytest.mark.parametrize('background_class', [0, 2])
+def test_predict_detections_equals_nms(background_class):
+    batch_sz, total_predictions, num_classes = 3, 60, 4
+    conf_trashhold, iou_trashhold = 0.3, 0.3
+    rng = np.random.RandomState(0)
+    confs, boxes = _random_predictions(rng, batch_sz, total_predictions, num_classes)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        model = _build_detections_model(batch_sz, total_predictions, num_classes)
+        with tf.Session(graph=graph) as session:
+            model._session = session
+            det_boxes, det_classes, det_scores, num_detections = model.predict_detections(
+                np.concatenate([confs, boxes], axis=-1), conf_trashhold, iou_trashhold, background_class
+            )
+
+    assert det_boxes.shape == (batch_sz, SSDModel.MAX_DETECTIONS, 4)
+    for i in range(batch_sz):
+        exp_boxes, exp_classes, exp_scores = nms(
+            boxes[i], confs[i], conf_trashhold, iou_trashhold, background_class=background_class
+        )
+        n = num_detections[i]
+        assert n == len(exp_boxes)
+        assert np.allclose(det_boxes[i, :n], np.reshape(exp_boxes, (-1, 4)))
+        assert np.array_equal(det_classes[i, :n], exp_classes)
+        assert np.allclose(det_scores[i, :n], exp_scores)
+        # The rest is padding
+        assert np.all(det_scores[i, n:] == 0)
@@ -0,0 +1,36 @@
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import numpy as np
+from makiflow.models.ssd.ssd_model import hard_negative_loss
+
+
+def test_hard_negative_loss_equals_per_sample_top_k():
+    # Every sample has the same number of positives, so every sample takes the same k
+    batch_sz, total_predictions, num_positives, neg_samples_ratio = 4, 50, 3, 3.0
+    k = int(num_positives * neg_samples_ratio)
+    rng = np.random.RandomState(0)
+    ce_loss = rng.rand(batch_sz, total_predictions).astype(np.float32)
+    masks = np.zeros((batch_sz, total_predictions), dtype=np.float32)
+    for mask in masks:
+        mask[rng.choice(total_predictions, num_positives, replace=False)] = 1.0
+
+    # Reference: top_k of the negatives taken sample by sample
+    negative_loss = ce_loss * (1.0 - masks)
+    top_k_inds = np.argsort(-negative_loss, axis=1, kind='stable')[:, :k]
+    expected_loss = np.take_along_axis(negative_loss, top_k_inds, axis=1).sum() / (batch_sz * k)
+    # The gradient flows only into the chosen negatives
+    expected_grad = np.zeros_like(ce_loss)
+    np.put_along_axis(expected_grad, top_k_inds, 1.0 / (batch_sz * k), axis=1)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        ce_loss_t = tf.constant(ce_loss)
+        loss = hard_negative_loss(ce_loss_t, tf.constant(masks), tf.constant(neg_samples_ratio))
+        grad = tf.gradients(loss, ce_loss_t)[0]
+        with tf.Session(graph=graph) as session:
+            loss_value, grad_value = session.run([loss, grad])
+
+    assert np.isclose(loss_value, expected_loss, rtol=1e-5)
+    assert np.allclose(grad_value, expected_grad, rtol=1e-5)